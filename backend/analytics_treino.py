@@ -0,0 +1,254 @@
+"""
+Analytics de treino (volume, intensidade e 1RM estimado) vetorizado com NumPy.
+
+Assim como contratos_pdf, este módulo é síncrono e não depende do servidor:
+recebe as séries já lidas do MongoDB (acumuladas em ColunasTreino, uma linha
+por exercício realizado numa sessão) e devolve estruturas prontas para JSON.
+O servidor monta as colunas e executa a análise em threads.
+
+Semanas começam na segunda-feira e são identificadas pela data (ISO) da segunda.
+"""
+
+from array import array
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+FORMULAS_1RM = ("epley", "brzycki")
+# Acima disso as fórmulas perdem precisão: a série conta para volume, não para o 1RM
+REPETICOES_MAXIMAS_1RM = 12
+GRUPO_DESCONHECIDO = "outros"
+
+# 1970-01-01 foi uma quinta-feira: (dia + 3) // 7 numera semanas iniciadas na segunda
+_DESLOCAMENTO_SEGUNDA = 3
+
+
+def estimar_1rm(cargas, repeticoes, formula: str = "epley") -> np.ndarray:
+    """1RM estimado por série; NaN quando a série não serve para a estimativa."""
+    cargas = np.asarray(cargas, dtype=np.float64)
+    repeticoes = np.asarray(repeticoes, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if formula == "epley":
+            estimado = cargas * (1 + repeticoes / 30)
+        elif formula == "brzycki":
+            estimado = cargas * 36 / (37 - repeticoes)
+        else:
+            raise ValueError(f"Fórmula de 1RM desconhecida: {formula}")
+    estimado = np.where(repeticoes == 1, cargas, estimado)
+    validas = (cargas > 0) & (repeticoes >= 1) & (repeticoes <= REPETICOES_MAXIMAS_1RM)
+    return np.where(validas, estimado, np.nan)
+
+
+def segunda_da_semana(semana: np.ndarray) -> np.ndarray:
+    return (semana * 7 - _DESLOCAMENTO_SEGUNDA).astype("datetime64[D]").astype(str)
+
+
+def variacao_percentual(atual: np.ndarray, anterior: np.ndarray) -> List[Optional[float]]:
+    """Variação semana a semana; None quando a semana anterior não tem dado."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        variacao = np.round((atual - anterior) / anterior * 100, 1)
+    return [float(v) if np.isfinite(v) else None for v in variacao]
+
+
+class ColunasTreino:
+    """
+    Acumula as séries lidas do banco já em colunas, com ids e dias codificados
+    como inteiros, para que a análise trabalhe apenas com arrays numéricos.
+    """
+
+    def __init__(self):
+        self.alunos: Dict[str, int] = {}
+        self.exercicios: Dict[str, int] = {}
+        self.dias: Dict[str, int] = {}
+        # Buffers tipados: viram arrays NumPy sem cópia (np.frombuffer)
+        self._aluno = array("q")
+        self._exercicio = array("q")
+        self._dia = array("q")
+        self._tamanho = array("q")
+        self._repeticoes = array("d")
+        self._cargas = array("d")
+
+    def __len__(self) -> int:
+        return len(self._tamanho)
+
+    def adicionar(self, aluno_id: str, dia: str, exercicio_id: str,
+                  repeticoes: Sequence[int], cargas: Sequence[float]):
+        """Um exercício realizado numa sessão; dia no formato YYYY-MM-DD."""
+        if not repeticoes:
+            return
+        self._aluno.append(self.alunos.setdefault(aluno_id, len(self.alunos)))
+        self._exercicio.append(self.exercicios.setdefault(exercicio_id, len(self.exercicios)))
+        self._dia.append(self.dias.setdefault(dia, len(self.dias)))
+        self._tamanho.append(len(repeticoes))
+        self._repeticoes.extend(repeticoes)
+        self._cargas.extend(cargas)
+
+    def adicionar_lote(self, linhas: Iterable[dict]):
+        """
+        Várias linhas como vêm do $unwind do servidor (aluno_id, data_treino,
+        exercicio_id, repeticoes, cargas). Pensado para rodar numa thread,
+        fora do loop de eventos.
+        """
+        adicionar = self.adicionar
+        for linha in linhas:
+            adicionar(
+                linha["aluno_id"], linha["data_treino"][:10], linha["exercicio_id"],
+                linha.get("repeticoes", []), linha.get("cargas", [])
+            )
+
+
+def montar_sessoes(colunas: ColunasTreino, grupos_por_exercicio: Dict[str, str], formula: str) -> Optional[dict]:
+    """
+    Monta os arrays por série e reduz a uma linha por (sessão, exercício)
+    com volume, repetições e melhor 1RM estimado.
+    """
+    if not len(colunas):
+        return None
+    tamanhos = np.frombuffer(colunas._tamanho, dtype=np.int64)
+    reps = np.frombuffer(colunas._repeticoes, dtype=np.float64)
+    carga = np.frombuffer(colunas._cargas, dtype=np.float64)
+    inicios = np.concatenate(([0], np.cumsum(tamanhos)[:-1]))
+
+    exercicio_ids = np.array(list(colunas.exercicios))
+    grupo_ids, grupo_do_exercicio = np.unique(
+        np.array([grupos_por_exercicio.get(e) or GRUPO_DESCONHECIDO for e in exercicio_ids]),
+        return_inverse=True
+    )
+    semana_do_dia = (np.array(list(colunas.dias), dtype="datetime64[D]").astype(np.int64) + _DESLOCAMENTO_SEGUNDA) // 7
+    semana = semana_do_dia[np.frombuffer(colunas._dia, dtype=np.int64)]
+    semana_inicial = int(semana_do_dia.min())
+    exercicio = np.frombuffer(colunas._exercicio, dtype=np.int64)
+
+    return {
+        "aluno_ids": np.array(list(colunas.alunos)),
+        "exercicio_ids": exercicio_ids,
+        "grupo_ids": grupo_ids,
+        "semana_inicial": semana_inicial,
+        "total_semanas": int(semana_do_dia.max()) - semana_inicial + 1,
+        "aluno": np.frombuffer(colunas._aluno, dtype=np.int64),
+        "exercicio": exercicio,
+        "grupo": grupo_do_exercicio[exercicio],
+        "semana": semana - semana_inicial,
+        "series": tamanhos,
+        "repeticoes": np.add.reduceat(reps, inicios),
+        "repeticoes_com_carga": np.add.reduceat(np.where(carga > 0, reps, 0), inicios),
+        "volume": np.add.reduceat(reps * carga, inicios),
+        "e1rm": np.fmax.reduceat(estimar_1rm(carga, reps, formula), inicios),
+    }
+
+
+def referencia_1rm(sessoes: dict) -> np.ndarray:
+    """Melhor 1RM estimado de cada (aluno, exercício) no período, por linha."""
+    chave = sessoes["aluno"] * len(sessoes["exercicio_ids"]) + sessoes["exercicio"]
+    unicas, indice = np.unique(chave, return_inverse=True)
+    melhor = np.full(len(unicas), np.nan)
+    np.fmax.at(melhor, indice, sessoes["e1rm"])
+    return melhor[indice]
+
+
+def volume_por_grupo(sessoes: dict) -> List[dict]:
+    """Volume, séries, carga média e intensidade relativa por (semana, grupo muscular)."""
+    n_grupos = len(sessoes["grupo_ids"])
+    tamanho = sessoes["total_semanas"] * n_grupos
+    celula = sessoes["semana"] * n_grupos + sessoes["grupo"]
+
+    def somar(pesos):
+        return np.bincount(celula, weights=pesos, minlength=tamanho).reshape(-1, n_grupos)
+
+    series = somar(sessoes["series"])
+    volume = somar(sessoes["volume"])
+    repeticoes = somar(sessoes["repeticoes"])
+    repeticoes_com_carga = somar(sessoes["repeticoes_com_carga"])
+
+    # Intensidade relativa: carga média ponderada por repetição / melhor 1RM do exercício
+    referencia = referencia_1rm(sessoes)
+    com_referencia = np.isfinite(referencia) & (referencia > 0)
+    volume_referenciado = somar(np.where(com_referencia, sessoes["volume"], 0))
+    carga_referencia = somar(
+        np.where(com_referencia, sessoes["repeticoes_com_carga"] * np.nan_to_num(referencia), 0)
+    )
+
+    alunos_chave = np.unique(sessoes["aluno"] * tamanho + celula) % tamanho
+    alunos = np.bincount(alunos_chave, minlength=tamanho).reshape(-1, n_grupos)
+
+    volume_anterior = np.vstack((np.zeros((1, n_grupos)), volume[:-1]))
+    semanas, grupos = np.nonzero(series)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        carga_media = np.round(volume / repeticoes_com_carga, 2)
+        intensidade = np.round(volume_referenciado / carga_referencia, 3)
+    variacoes = variacao_percentual(volume[semanas, grupos], volume_anterior[semanas, grupos])
+    datas = segunda_da_semana(semanas + sessoes["semana_inicial"])
+
+    return [
+        {
+            "semana": datas[i],
+            "grupo_muscular": str(sessoes["grupo_ids"][g]),
+            "volume": round(float(volume[s, g]), 2),
+            "series": int(series[s, g]),
+            "repeticoes": int(repeticoes[s, g]),
+            "alunos": int(alunos[s, g]),
+            "carga_media": float(carga_media[s, g]) if np.isfinite(carga_media[s, g]) else None,
+            "intensidade_relativa": float(intensidade[s, g]) if np.isfinite(intensidade[s, g]) else None,
+            "variacao_volume_pct": variacoes[i],
+        }
+        for i, (s, g) in enumerate(zip(semanas, grupos))
+    ]
+
+
+def tendencia_1rm(sessoes: dict) -> List[dict]:
+    """
+    1RM estimado por (exercício, semana): melhor série de cada aluno na semana,
+    com média entre alunos (para um único aluno é o próprio melhor 1RM).
+    """
+    n_exercicios = len(sessoes["exercicio_ids"])
+    n_semanas = sessoes["total_semanas"]
+    validas = np.isfinite(sessoes["e1rm"])
+    chave = (sessoes["aluno"] * n_exercicios + sessoes["exercicio"]) * n_semanas + sessoes["semana"]
+    unicas, indice = np.unique(chave[validas], return_inverse=True)
+    melhor = np.full(len(unicas), np.nan)
+    np.fmax.at(melhor, indice, sessoes["e1rm"][validas])
+
+    celula = (unicas // n_semanas % n_exercicios) * n_semanas + unicas % n_semanas
+    tamanho = n_exercicios * n_semanas
+    alunos = np.bincount(celula, minlength=tamanho).reshape(n_exercicios, n_semanas)
+    soma = np.bincount(celula, weights=melhor, minlength=tamanho).reshape(n_exercicios, n_semanas)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        media = soma / alunos
+
+    anterior = np.hstack((np.full((n_exercicios, 1), np.nan), media[:, :-1]))
+    exercicios, semanas = np.nonzero(alunos)
+    variacoes = variacao_percentual(media[exercicios, semanas], anterior[exercicios, semanas])
+    datas = segunda_da_semana(semanas + sessoes["semana_inicial"])
+
+    return [
+        {"exercicio_id": exercicio_id, "semana": semana, "e1rm": e1rm, "alunos": n, "variacao_pct": variacao}
+        for exercicio_id, semana, e1rm, n, variacao in zip(
+            sessoes["exercicio_ids"][exercicios].tolist(),
+            datas.tolist(),
+            np.round(media[exercicios, semanas], 2).tolist(),
+            alunos[exercicios, semanas].tolist(),
+            variacoes
+        )
+    ]
+
+
+def analisar(colunas: ColunasTreino, grupos_por_exercicio: Dict[str, str], formula: str = "epley") -> dict:
+    sessoes = montar_sessoes(colunas, grupos_por_exercicio, formula)
+    if sessoes is None:
+        return {
+            "formula": formula,
+            "totais": {"alunos": 0, "sessoes_exercicio": 0, "series": 0, "volume": 0.0},
+            "volume_por_grupo": [],
+            "e1rm_por_exercicio": [],
+        }
+    return {
+        "formula": formula,
+        "totais": {
+            "alunos": len(sessoes["aluno_ids"]),
+            "sessoes_exercicio": len(sessoes["series"]),
+            "series": int(sessoes["series"].sum()),
+            "volume": round(float(sessoes["volume"].sum()), 2),
+        },
+        "volume_por_grupo": volume_por_grupo(sessoes),
+        "e1rm_por_exercicio": tendencia_1rm(sessoes),
+    }
@@ -0,0 +1,137 @@
+"""
+Geração de PDF de contratos (HTML → PDF) totalmente local.
+
+As funções deste módulo são síncronas e sem dependência do servidor para
+poderem rodar dentro de um ProcessPoolExecutor. O pool usa o método `spawn`:
+o processo filho começa um interpretador limpo e importa apenas este arquivo,
+sem herdar o servidor nem a conexão com o MongoDB (com `fork`, o filho seria
+uma cópia do processo inteiro).
+"""
+
+import hashlib
+import html
+import io
+import os
+import re
+from pathlib import Path
+from typing import Optional
+
+from xhtml2pdf import pisa
+
+ESTILO_PDF = """
+<style>
+    @page { size: a4 portrait; margin: 2cm; }
+    body { font-family: Helvetica; font-size: 11pt; line-height: 1.4; }
+    .assinaturas { margin-top: 40px; }
+    .assinatura { margin-top: 24px; }
+    .assinatura img { height: 80px; }
+    .assinatura p { margin: 0; font-size: 9pt; color: #444; }
+</style>
+"""
+
+
+# Assinaturas vêm do cliente: só imagens embutidas (data URI), nunca caminhos ou URLs
+# que o renderizador leria do disco ou da rede
+PADRAO_ASSINATURA = re.compile(r"data:image/(png|jpeg);base64,[A-Za-z0-9+/]+={0,2}")
+
+
+def assinatura_valida(valor: str) -> bool:
+    return PADRAO_ASSINATURA.fullmatch(valor) is not None
+
+
+def somente_data_uri(uri: str, rel: str) -> str:
+    """link_callback do xhtml2pdf: recursos que não sejam data: são ignorados."""
+    return uri if uri.startswith("data:") else ""
+
+
+def montar_html_contrato(
+    conteudo_gerado: str,
+    numero_contrato: str,
+    aluno_nome: str,
+    assinatura_aluno: Optional[str] = None,
+    assinatura_responsavel: Optional[str] = None,
+    data_assinatura: Optional[str] = None,
+    hash_conteudo: Optional[str] = None,
+) -> str:
+    """
+    Monta o documento HTML completo (conteúdo + bloco de assinaturas).
+
+    Assinaturas fora do formato aceito (contratos gravados antes da validação)
+    são omitidas.
+    """
+    blocos = []
+    if assinatura_aluno and assinatura_valida(assinatura_aluno):
+        blocos.append(
+            f'<div class="assinatura"><img src="{html.escape(assinatura_aluno)}"/>'
+            f"<p>{html.escape(aluno_nome)}</p></div>"
+        )
+    if assinatura_responsavel and assinatura_valida(assinatura_responsavel):
+        blocos.append(
+            f'<div class="assinatura"><img src="{html.escape(assinatura_responsavel)}"/>'
+            "<p>Responsável</p></div>"
+        )
+    rodape = ""
+    if data_assinatura:
+        rodape += f"<p>Assinado em {html.escape(data_assinatura)}</p>"
+    if hash_conteudo:
+        rodape += f"<p>SHA-256: {html.escape(hash_conteudo)}</p>"
+
+    return (
+        f"<html><head><meta charset=\"utf-8\"/><title>{html.escape(numero_contrato)}</title>"
+        f"{ESTILO_PDF}</head><body>{conteudo_gerado}"
+        f'<div class="assinaturas">{"".join(blocos)}{rodape}</div></body></html>'
+    )
+
+
+def hash_documento(documento_html: str) -> str:
+    return hashlib.sha256(documento_html.encode("utf-8")).hexdigest()
+
+
+def renderizar_pdf(documento_html: str, destino: str) -> str:
+    """
+    Converte o HTML em PDF e grava em `destino` (escrita atômica).
+
+    Executado nos processos do pool; retorna o caminho gravado.
+    """
+    buffer = io.BytesIO()
+    resultado = pisa.CreatePDF(
+        documento_html, dest=buffer, encoding="utf-8", link_callback=somente_data_uri
+    )
+    if resultado.err:
+        raise RuntimeError(f"Falha ao gerar PDF ({resultado.err} erros)")
+
+    caminho = Path(destino)
+    temporario = caminho.with_suffix(f".{os.getpid()}.tmp")
+    temporario.write_bytes(buffer.getvalue())
+    temporario.replace(caminho)
+    return str(caminho)
+
+
+def limpar_cache(diretorio: str, max_arquivos: int) -> int:
+    """
+    Remove os PDFs mais antigos (por mtime) além de `max_arquivos`.
+
+    Acertos do cache renovam o mtime, então os removidos são os menos usados.
+    Retorna quantos arquivos foram removidos.
+    """
+    arquivos = []
+    for entrada in os.scandir(diretorio):
+        if not entrada.name.endswith(".pdf"):
+            continue
+        try:
+            arquivos.append((entrada.stat().st_mtime, entrada.path))
+        except FileNotFoundError:
+            continue
+    excedentes = len(arquivos) - max_arquivos
+    if excedentes <= 0:
+        return 0
+
+    arquivos.sort()
+    removidos = 0
+    for _, caminho in arquivos[:excedentes]:
+        try:
+            os.remove(caminho)
+            removidos += 1
+        except FileNotFoundError:
+            pass
+    return removidos
@@ -1,19 +1,35 @@
 from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, Request
+from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import DeleteMany, DeleteOne, ReturnDocument, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 import os
+import time
+import asyncio
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, EmailStr, ConfigDict
 from typing import List, Optional
 from enum import Enum
 import uuid
+import hashlib
+import json
+import math
+import bisect
+import multiprocessing
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timezone, timedelta, date
+from zoneinfo import ZoneInfo
 import jwt
 from passlib.context import CryptContext
 
+import analytics_treino
+import contratos_pdf
+
 # Logging Setup
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -30,6 +46,7 @@ db = client[os.environ['DB_NAME']]
 SECRET_KEY = os.environ.get('JWT_SECRET_KEY', 'your-secret-key-change-in-production')
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24  # 24 hours
+STREAM_TOKEN_EXPIRE_SECONDS = 60  # only needs to outlive opening the SSE connection
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
@@ -113,6 +130,7 @@ class Aluno(BaseModel):
     foto_url: Optional[str] = None
     status: str = "ativo"  # ativo, inativo, pendente
     plano_id: Optional[str] = None
+    indicado_por: Optional[str] = None  # aluno_id de quem indicou
     data_matricula: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     observacoes: Optional[str] = None
     criado_em: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
@@ -126,6 +144,7 @@ class AlunoCreate(BaseModel):
     endereco: Optional[str] = None
     foto_url: Optional[str] = None
     plano_id: Optional[str] = None
+    indicado_por: Optional[str] = None
     observacoes: Optional[str] = None
 
 class AlunoUpdate(BaseModel):
@@ -278,15 +297,27 @@ class DespesaCreate(BaseModel):
 # WhatsApp Models
 class MensagemWhatsApp(BaseModel):
     model_config = ConfigDict(extra="ignore")
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))  # id da campanha
     destinatarios: List[str]  # lista de aluno_ids
     mensagem: str
-    status: str = "enviada"
+    status: str = "enviada"  # preparando, enfileirada, concluida, concluida_com_falhas, falhou (legado: enviada)
+    segmento: Optional[dict] = None
+    erro: Optional[str] = None  # expansão do segmento interrompida (status "falhou")
+    total_destinatarios: int = 0
+    enviados: int = 0
+    falhas: int = 0
     enviado_em: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+class SegmentoAlunos(BaseModel):
+    status: Optional[str] = "ativo"
+    plano_id: Optional[str] = None
+    inadimplente: Optional[bool] = None  # com pagamento vencido em aberto
+    inativos_dias: Optional[int] = None  # sem check-in há N dias ou mais
+
 class MensagemWhatsAppCreate(BaseModel):
-    destinatarios: List[str]
-    mensagem: str
+    destinatarios: List[str] = []
+    segmento: Optional[SegmentoAlunos] = None  # alternativa a destinatarios para envios em massa
+    mensagem: str  # aceita {{nome}}, {{primeiro_nome}} e {{valor_devido}}
 
 # Avaliacao Fisica Models
 class AvaliacaoFisica(BaseModel):
@@ -400,6 +431,12 @@ class ExercicioFicha(BaseModel):
     descanso: Optional[str] = None  # "60s", "90s"
     tecnica: Optional[str] = None  # "dropset", "rest-pause", "superset"
     observacoes: Optional[str] = None
+    # Preenchidos nas respostas pelo catálogo de exercícios
+    exercicio_nome: Optional[str] = None
+    grupo_muscular: Optional[str] = None
+    equipamento: Optional[str] = None
+    video_url: Optional[str] = None
+    imagem_url: Optional[str] = None
 
 # Ficha de Treino
 class FichaTreino(BaseModel):
@@ -626,8 +663,113 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         return User(**user)
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
-    except jwt.JWTError:
+    except jwt.InvalidTokenError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+def criar_token_stream(aluno_id: str) -> str:
+    """
+    Token curto para streams SSE (EventSource não envia cabeçalhos, o token vai na URL).
+    Sem "sub": não serve como token de login, só abre o stream do aluno.
+    """
+    expira = datetime.now(timezone.utc) + timedelta(seconds=STREAM_TOKEN_EXPIRE_SECONDS)
+    return jwt.encode(
+        {"escopo": "notificacoes", "aluno_id": aluno_id, "exp": expira}, SECRET_KEY, algorithm=ALGORITHM
+    )
+
+def validar_token_stream(token: str, aluno_id: str):
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Token expired")
+    except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
+    if payload.get("escopo") != "notificacoes" or payload.get("aluno_id") != aluno_id:
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+_tarefas_background: set = set()
+
+def iniciar_tarefa_background(coro):
+    """Agenda uma corrotina mantendo referência até terminar."""
+    tarefa = asyncio.create_task(coro)
+    _tarefas_background.add(tarefa)
+    tarefa.add_done_callback(_tarefas_background.discard)
+    return tarefa
+
+# ==================== SEQUÊNCIAS NUMÉRICAS ====================
+
+class SequenciaNumerica:
+    """
+    Numeração atômica de documentos (contratos, recibos, notas) na coleção `contadores`.
+    
+    Cada ida ao banco reserva `bloco` números com um único find_one_and_update($inc).
+    Com bloco > 1 o processo distribui os números da reserva em memória e só volta ao
+    banco quando ela acaba; números reservados e não usados se perdem num restart.
+    """
+    
+    def __init__(self, bloco: int = 1):
+        self.bloco = max(1, bloco)
+        self._reservas: dict = {}  # chave -> [proximo, ultimo]
+        self._locks: dict = {}
+    
+    async def _reservar(self, chave: str) -> int:
+        try:
+            doc = await db.contadores.find_one_and_update(
+                {"_id": chave},
+                {"$inc": {"valor": self.bloco}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # Dois upserts simultâneos no primeiro uso da chave: o perdedor repete
+            doc = await db.contadores.find_one_and_update(
+                {"_id": chave},
+                {"$inc": {"valor": self.bloco}},
+                return_document=ReturnDocument.AFTER
+            )
+        return doc["valor"]
+    
+    async def proximo(self, chave: str) -> int:
+        lock = self._locks.setdefault(chave, asyncio.Lock())
+        async with lock:
+            reserva = self._reservas.get(chave)
+            if reserva is None or reserva[0] > reserva[1]:
+                ultimo = await self._reservar(chave)
+                reserva = [ultimo - self.bloco + 1, ultimo]
+                self._reservas[chave] = reserva
+            numero = reserva[0]
+            reserva[0] += 1
+            return numero
+    
+    async def garantir_minimo(self, chave: str, valor: int):
+        """Garante que a sequência continue a partir de `valor` (ex.: dados legados)."""
+        try:
+            await db.contadores.update_one({"_id": chave}, {"$max": {"valor": valor}}, upsert=True)
+        except DuplicateKeyError:
+            await db.contadores.update_one({"_id": chave}, {"$max": {"valor": valor}})
+
+sequencia_contratos = SequenciaNumerica(bloco=int(os.environ.get('CONTRATO_SEQUENCIA_BLOCO', '1')))
+_sequencias_contrato_migradas: set = set()
+
+async def gerar_numero_contrato() -> str:
+    """Próximo número no formato CTRT-AAAA-NNNN, sequencial por ano."""
+    ano = datetime.now().year
+    chave = f"contrato-{ano}"
+    
+    if chave not in _sequencias_contrato_migradas:
+        # A numeração antiga usava count_documents: continua do maior número já emitido,
+        # comparado como número ("-9999" ordenado como texto viria depois de "-10000")
+        resultado = await db.contratos.aggregate([
+            {"$match": {"numero_contrato": {"$regex": f"^CTRT-{ano}-[0-9]+$"}}},
+            {"$group": {"_id": None, "maior": {"$max": {
+                "$toLong": {"$arrayElemAt": [{"$split": ["$numero_contrato", "-"]}, -1]}
+            }}}}
+        ]).to_list(1)
+        if resultado:
+            await sequencia_contratos.garantir_minimo(chave, int(resultado[0]["maior"]))
+        _sequencias_contrato_migradas.add(chave)
+    
+    numero = await sequencia_contratos.proximo(chave)
+    return f"CTRT-{ano}-{str(numero).zfill(4)}"
 
 # ==================== AUTH ROUTES ====================
 
@@ -681,6 +823,10 @@ async def create_aluno(aluno: AlunoCreate, current_user: User = Depends(get_curr
     doc['criado_em'] = doc['criado_em'].isoformat()
     
     await db.alunos.insert_one(doc)
+    if aluno_obj.indicado_por:
+        await incrementar_contador(aluno_obj.indicado_por, "indicacoes", 1)
+    if aluno_obj.plano_id:
+        await sincronizar_segmentos_alunos([aluno_obj.id])
     return aluno_obj
 
 @api_router.get("/alunos", response_model=List[Aluno])
@@ -716,6 +862,9 @@ async def update_aluno(aluno_id: str, aluno_update: AlunoUpdate, current_user: U
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Aluno not found")
+    cache_nomes_alunos.invalidar(aluno_id)
+    if "plano_id" in update_data:
+        await sincronizar_segmentos_alunos([aluno_id])
     
     aluno = await db.alunos.find_one({"id": aluno_id}, {"_id": 0})
     if isinstance(aluno['data_matricula'], str):
@@ -726,9 +875,15 @@ async def update_aluno(aluno_id: str, aluno_update: AlunoUpdate, current_user: U
 
 @api_router.delete("/alunos/{aluno_id}")
 async def delete_aluno(aluno_id: str, current_user: User = Depends(get_current_user)):
-    result = await db.alunos.delete_one({"id": aluno_id})
-    if result.deleted_count == 0:
+    aluno = await db.alunos.find_one_and_delete({"id": aluno_id}, projection={"_id": 0, "indicado_por": 1})
+    if not aluno:
         raise HTTPException(status_code=404, detail="Aluno not found")
+    cache_nomes_alunos.invalidar(aluno_id)
+    ranking_alunos.remover(aluno_id)
+    await db.ranking_segmentos.delete_many({"aluno_id": aluno_id})
+    await db.recordes_pessoais.delete_many({"aluno_id": aluno_id})
+    if aluno.get("indicado_por"):
+        await incrementar_contador(aluno["indicado_por"], "indicacoes", -1)
     return {"message": "Aluno deleted successfully"}
 
 # ==================== PLANOS ROUTES ====================
@@ -765,6 +920,8 @@ async def delete_plano(plano_id: str, current_user: User = Depends(get_current_u
     result = await db.planos.delete_one({"id": plano_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Plano not found")
+    # Alunos do plano saem dos segmentos do plano e de suas modalidades
+    iniciar_tarefa_background(sincronizar_segmentos_por_filtro({"plano_id": plano_id}))
     return {"message": "Plano deleted successfully"}
 
 # ==================== PAGAMENTOS ROUTES ====================
@@ -781,6 +938,8 @@ async def create_pagamento(pagamento: PagamentoCreate, current_user: User = Depe
     doc['criado_em'] = doc['criado_em'].isoformat()
     
     await db.pagamentos.insert_one(doc)
+    if pagamento_obj.status == "pago":
+        await registrar_pagamento_contador(doc)
     return pagamento_obj
 
 @api_router.get("/pagamentos", response_model=List[Pagamento])
@@ -798,12 +957,20 @@ async def update_pagamento(pagamento_id: str, pagamento_update: PagamentoUpdate,
     if not update_data:
         raise HTTPException(status_code=400, detail="No data to update")
     
-    result = await db.pagamentos.update_one({"id": pagamento_id}, {"$set": update_data})
+    anterior = await db.pagamentos.find_one_and_update(
+        {"id": pagamento_id},
+        {"$set": update_data},
+        projection={"_id": 0, "status": 1}
+    )
     
-    if result.matched_count == 0:
+    if anterior is None:
         raise HTTPException(status_code=404, detail="Pagamento not found")
     
     pagamento = await db.pagamentos.find_one({"id": pagamento_id}, {"_id": 0})
+    if anterior.get("status") != "pago" and pagamento["status"] == "pago":
+        await registrar_pagamento_contador(pagamento)
+    elif anterior.get("status") == "pago" and pagamento["status"] != "pago":
+        await desfazer_pagamento_contador(pagamento)
     if isinstance(pagamento['criado_em'], str):
         pagamento['criado_em'] = datetime.fromisoformat(pagamento['criado_em'])
     return Pagamento(**pagamento)
@@ -879,6 +1046,7 @@ async def create_checkin(checkin: CheckInCreate, current_user: User = Depends(ge
     doc['data_hora'] = doc['data_hora'].isoformat()
     
     await db.checkins.insert_one(doc)
+    await incrementar_contador_atividade(checkin_obj.aluno_id, "checkins", checkin_obj.data_hora)
     return checkin_obj
 
 @api_router.get("/checkins", response_model=List[CheckIn])
@@ -934,34 +1102,395 @@ async def get_despesas(current_user: User = Depends(get_current_user)):
             despesa['criado_em'] = datetime.fromisoformat(despesa['criado_em'])
     return despesas
 
+# ==================== WHATSAPP - FILA DE ENVIO ====================
+
+WHATSAPP_PROVEDOR = os.environ.get('WHATSAPP_PROVIDER', 'fake')
+WHATSAPP_WORKERS = int(os.environ.get('WHATSAPP_WORKERS', '4'))
+WHATSAPP_TAXA_POR_SEGUNDO = float(os.environ.get('WHATSAPP_RATE_PER_SECOND', '10'))
+WHATSAPP_RAJADA = int(os.environ.get('WHATSAPP_BURST', '20'))
+WHATSAPP_MAX_TENTATIVAS = 5
+WHATSAPP_BACKOFF_SEGUNDOS = 30
+WHATSAPP_POLL_SEGUNDOS = 5
+WHATSAPP_TRAVA_SEGUNDOS = 300  # mensagem "enviando" há mais tempo volta para a fila
+# Bem abaixo da trava: uma chamada lenta termina (ou falha) antes de a mensagem ser reivindicada
+WHATSAPP_ENVIO_TIMEOUT_SEGUNDOS = 60
+WHATSAPP_FAKE_HISTORICO = 1000  # últimas mensagens guardadas pelo provedor fake
+
+class ProvedorWhatsApp:
+    """Interface de envio; `enviar` retorna o id da mensagem no provedor ou levanta exceção."""
+    
+    async def enviar(self, telefone: str, mensagem: str) -> str:
+        raise NotImplementedError
+
+class ProvedorWhatsAppFake(ProvedorWhatsApp):
+    """Provedor local para desenvolvimento e testes: apenas registra as últimas mensagens."""
+    
+    def __init__(self):
+        self.enviadas: deque = deque(maxlen=WHATSAPP_FAKE_HISTORICO)
+    
+    async def enviar(self, telefone: str, mensagem: str) -> str:
+        provedor_id = f"fake-{uuid.uuid4()}"
+        self.enviadas.append({"id": provedor_id, "telefone": telefone, "mensagem": mensagem})
+        logger.info(f"[WhatsApp fake] {telefone}: {mensagem[:50]}")
+        return provedor_id
+
+class ProvedorWhatsAppTwilio(ProvedorWhatsApp):
+    def __init__(self):
+        from twilio.http.http_client import TwilioHttpClient
+        from twilio.rest import Client
+        self.client = Client(
+            os.environ['TWILIO_ACCOUNT_SID'],
+            os.environ['TWILIO_AUTH_TOKEN'],
+            http_client=TwilioHttpClient(timeout=WHATSAPP_ENVIO_TIMEOUT_SEGUNDOS)
+        )
+        self.remetente = os.environ.get('TWILIO_WHATSAPP_FROM', 'whatsapp:+14155238886')
+    
+    async def enviar(self, telefone: str, mensagem: str) -> str:
+        # O SDK da Twilio é síncrono
+        resposta = await asyncio.to_thread(
+            self.client.messages.create,
+            from_=self.remetente,
+            body=mensagem,
+            to=f'whatsapp:{telefone}'
+        )
+        return resposta.sid
+
+def criar_provedor_whatsapp() -> ProvedorWhatsApp:
+    if WHATSAPP_PROVEDOR == "twilio":
+        return ProvedorWhatsAppTwilio()
+    return ProvedorWhatsAppFake()
+
+class TokenBucket:
+    """Limitador de taxa compartilhado pelos workers (token bucket)."""
+    
+    def __init__(self, taxa_por_segundo: float, capacidade: int):
+        self.taxa = taxa_por_segundo
+        self.capacidade = capacidade
+        self.tokens = float(capacidade)
+        self.atualizado = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    async def adquirir(self):
+        async with self._lock:
+            while True:
+                agora = time.monotonic()
+                self.tokens = min(self.capacidade, self.tokens + (agora - self.atualizado) * self.taxa)
+                self.atualizado = agora
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.taxa)
+
+provedor_whatsapp: Optional[ProvedorWhatsApp] = None
+limitador_whatsapp = TokenBucket(WHATSAPP_TAXA_POR_SEGUNDO, WHATSAPP_RAJADA)
+_whatsapp_sinal = asyncio.Event()
+_whatsapp_workers: List[asyncio.Task] = []
+
+async def enfileirar_mensagens_whatsapp(campanha_id: str, itens: List[dict]):
+    """Grava as mensagens individuais na outbox e acorda os workers."""
+    if not itens:
+        return
+    agora = datetime.now(timezone.utc).isoformat()
+    await db.whatsapp_outbox.insert_many([
+        {
+            "id": str(uuid.uuid4()),
+            "campanha_id": campanha_id,
+            "aluno_id": item["aluno_id"],
+            "aluno_nome": item["nome"],
+            "telefone": item["telefone"],
+            "mensagem": item["mensagem"],
+            "status": "pendente",  # pendente, enviando, enviada, falhou
+            "tentativas": 0,
+            "proxima_tentativa": agora,
+            "criado_em": agora
+        }
+        for item in itens
+    ], ordered=False)
+    _whatsapp_sinal.set()
+
+async def reivindicar_mensagem_whatsapp() -> Optional[dict]:
+    """
+    Trava atomicamente a próxima mensagem pronta para envio.
+    
+    Retomar uma mensagem presa em "enviando" conta como tentativa: uma mensagem
+    que derruba ou trava o worker acaba em "falhou" em vez de voltar para sempre.
+    """
+    agora = datetime.now(timezone.utc)
+    limite_trava = (agora - timedelta(seconds=WHATSAPP_TRAVA_SEGUNDOS)).isoformat()
+    return await db.whatsapp_outbox.find_one_and_update(
+        {"$or": [
+            {"status": "pendente", "proxima_tentativa": {"$lte": agora.isoformat()}},
+            {"status": "enviando", "travado_em": {"$lt": limite_trava}}
+        ]},
+        [{"$set": {
+            "tentativas": {"$add": [
+                {"$ifNull": ["$tentativas", 0]}, {"$cond": [{"$eq": ["$status", "enviando"]}, 1, 0]}
+            ]},
+            "status": "enviando",
+            "travado_em": agora.isoformat()
+        }}],
+        sort=[("proxima_tentativa", 1)],
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+
+async def finalizar_campanha_se_completa(campanha: dict):
+    if campanha.get("enviados", 0) + campanha.get("falhas", 0) >= campanha.get("total_destinatarios", 0):
+        # Campanhas por segmento ficam em "preparando" até a expansão terminar
+        await db.mensagens_whatsapp.update_one(
+            {"id": campanha["id"], "status": "enfileirada"},
+            {"$set": {"status": "concluida_com_falhas" if campanha.get("falhas") else "concluida"}}
+        )
+
+async def registrar_resultado_campanha(campanha_id: str, campo: str):
+    campanha = await db.mensagens_whatsapp.find_one_and_update(
+        {"id": campanha_id},
+        {"$inc": {campo: 1}},
+        projection={"_id": 0, "id": 1, "total_destinatarios": 1, "enviados": 1, "falhas": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if campanha:
+        await finalizar_campanha_se_completa(campanha)
+
+async def concluir_envio_whatsapp(mensagem: dict, provedor_id: str):
+    """Marca a mensagem como enviada e conta na campanha (uma vez, mesmo se reivindicada de novo)."""
+    agora = datetime.now(timezone.utc).isoformat()
+    resultado = await db.whatsapp_outbox.update_one(
+        {"id": mensagem["id"], "status": "enviando"},
+        {"$set": {
+            "status": "enviada",
+            "provedor_id": provedor_id,
+            "enviado_em": agora,
+            "atualizado_em": agora
+        }, "$inc": {"tentativas": 1}}
+    )
+    if resultado.modified_count:
+        await registrar_resultado_campanha(mensagem["campanha_id"], "enviados")
+
+async def entregar_mensagem_whatsapp(mensagem: dict):
+    """Envia uma mensagem da outbox, com retentativa e backoff exponencial."""
+    if mensagem.get("provedor_id"):
+        # Reivindicada depois de o provedor já ter aceitado o envio: só conclui, não reenvia
+        await concluir_envio_whatsapp(mensagem, mensagem["provedor_id"])
+        return
+    agora = datetime.now(timezone.utc)
+    if mensagem.get("tentativas", 0) >= WHATSAPP_MAX_TENTATIVAS:
+        # Só retomadas chegam aqui (falhas comuns já param no limite abaixo)
+        resultado = await db.whatsapp_outbox.update_one(
+            {"id": mensagem["id"], "status": "enviando"},
+            {"$set": {
+                "status": "falhou",
+                "erro": "Envio interrompido em todas as tentativas",
+                "atualizado_em": agora.isoformat()
+            }}
+        )
+        if resultado.modified_count:
+            await registrar_resultado_campanha(mensagem["campanha_id"], "falhas")
+        return
+    try:
+        provedor_id = await provedor_whatsapp.enviar(mensagem["telefone"], mensagem["mensagem"])
+    except Exception as e:
+        tentativas = mensagem.get("tentativas", 0) + 1
+        if tentativas >= WHATSAPP_MAX_TENTATIVAS:
+            await db.whatsapp_outbox.update_one(
+                {"id": mensagem["id"]},
+                {"$set": {"status": "falhou", "tentativas": tentativas, "erro": str(e), "atualizado_em": agora.isoformat()}}
+            )
+            await registrar_resultado_campanha(mensagem["campanha_id"], "falhas")
+        else:
+            espera = WHATSAPP_BACKOFF_SEGUNDOS * (2 ** (tentativas - 1))
+            await db.whatsapp_outbox.update_one(
+                {"id": mensagem["id"]},
+                {"$set": {
+                    "status": "pendente",
+                    "tentativas": tentativas,
+                    "erro": str(e),
+                    "proxima_tentativa": (agora + timedelta(seconds=espera)).isoformat(),
+                    "atualizado_em": agora.isoformat()
+                }}
+            )
+        return
+    
+    # O id do provedor é gravado antes de tudo: se o worker cair daqui em diante,
+    # quem reivindicar a mensagem encontra o id e não a envia de novo
+    await db.whatsapp_outbox.update_one({"id": mensagem["id"]}, {"$set": {"provedor_id": provedor_id}})
+    await concluir_envio_whatsapp(mensagem, provedor_id)
+
+WHATSAPP_SEGMENTO_LOTE = 500
+
+def renderizar_mensagens_whatsapp(mensagem: str, alunos: List[dict], valores_devidos: dict) -> List[dict]:
+    """Personaliza a mensagem para um lote de alunos ({{nome}}, {{primeiro_nome}}, {{valor_devido}})."""
+    itens = []
+    for aluno in alunos:
+        variaveis = {
+            "nome": aluno["nome"],
+            "primeiro_nome": aluno["nome"].split(" ")[0],
+            "valor_devido": formatar_moeda(valores_devidos.get(aluno["id"], 0)),
+        }
+        itens.append({
+            "aluno_id": aluno["id"],
+            "nome": aluno["nome"],
+            "telefone": aluno["telefone"],
+            "mensagem": renderizar_template(mensagem, variaveis)
+        })
+    return itens
+
+async def calcular_valores_devidos(aluno_ids: Optional[List[str]] = None) -> dict:
+    """Soma dos pagamentos vencidos em aberto por aluno, numa única agregação."""
+    hoje = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    match = {"status": {"$in": ["pendente", "atrasado"]}, "data_vencimento": {"$lt": hoje}}
+    if aluno_ids is not None:
+        match["aluno_id"] = {"$in": aluno_ids}
+    resultado = await db.pagamentos.aggregate([
+        {"$match": match},
+        {"$group": {"_id": "$aluno_id", "valor": {"$sum": "$valor"}}}
+    ]).to_list(None)
+    return {r["_id"]: r["valor"] for r in resultado}
+
+def montar_query_segmento(segmento: SegmentoAlunos) -> dict:
+    """Filtros do segmento que são campos do próprio aluno (o cursor de alunos usa só estes)."""
+    query = {"telefone": {"$nin": [None, ""]}}
+    if segmento.status:
+        query["status"] = segmento.status
+    if segmento.plano_id:
+        query["plano_id"] = segmento.plano_id
+    return query
+
+async def filtrar_lote_segmento(segmento: SegmentoAlunos, alunos: List[dict], com_valores: bool) -> tuple:
+    """
+    Aplica a um lote do cursor os filtros que dependem de outras coleções.
+    
+    Inadimplência e check-ins recentes são consultados só para os ids do lote,
+    em vez de carregar as listas da academia inteira num $in/$nin. Retorna
+    (alunos do lote que ficam, valores devidos por aluno).
+    """
+    valores = {}
+    if segmento.inadimplente is not None or com_valores:
+        valores = await calcular_valores_devidos([a["id"] for a in alunos])
+    if segmento.inadimplente is not None:
+        alunos = [a for a in alunos if (a["id"] in valores) == segmento.inadimplente]
+    if segmento.inativos_dias and alunos:
+        limite = (datetime.now(timezone.utc) - timedelta(days=segmento.inativos_dias)).isoformat()
+        recentes = set(await db.checkins.distinct(
+            "aluno_id", {"aluno_id": {"$in": [a["id"] for a in alunos]}, "data_hora": {"$gte": limite}}
+        ))
+        alunos = [a for a in alunos if a["id"] not in recentes]
+    return alunos, valores
+
+async def expandir_segmento_whatsapp(campanha_id: str, segmento: SegmentoAlunos, mensagem: str):
+    """Percorre o cursor do segmento em lotes, enfileirando as mensagens personalizadas."""
+    usa_valor_devido = "{{valor_devido}}" in mensagem
+    try:
+        cursor = db.alunos.find(
+            montar_query_segmento(segmento), {"_id": 0, "id": 1, "nome": 1, "telefone": 1}
+        ).batch_size(WHATSAPP_SEGMENTO_LOTE)
+        
+        lote = []
+        
+        async def enfileirar_lote(alunos: List[dict]):
+            alunos, valores = await filtrar_lote_segmento(segmento, alunos, usa_valor_devido)
+            if not alunos:
+                return
+            await enfileirar_mensagens_whatsapp(campanha_id, renderizar_mensagens_whatsapp(mensagem, alunos, valores))
+            await db.mensagens_whatsapp.update_one(
+                {"id": campanha_id},
+                {"$inc": {"total_destinatarios": len(alunos)}}
+            )
+        
+        async for aluno in cursor:
+            lote.append(aluno)
+            if len(lote) >= WHATSAPP_SEGMENTO_LOTE:
+                await enfileirar_lote(lote)
+                lote = []
+        if lote:
+            await enfileirar_lote(lote)
+    except Exception as e:
+        # Mensagens já enfileiradas seguem para os workers; a campanha fica marcada como incompleta
+        logger.error(f"Expansão do segmento da campanha {campanha_id} falhou: {str(e)}")
+        await db.mensagens_whatsapp.update_one(
+            {"id": campanha_id},
+            {"$set": {"status": "falhou", "erro": f"Expansão do segmento interrompida: {str(e)}"}}
+        )
+        return
+    
+    campanha = await db.mensagens_whatsapp.find_one_and_update(
+        {"id": campanha_id},
+        {"$set": {"status": "enfileirada"}},
+        projection={"_id": 0, "id": 1, "total_destinatarios": 1, "enviados": 1, "falhas": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    # Os workers podem ter terminado antes da expansão acabar
+    await finalizar_campanha_se_completa(campanha)
+
+async def worker_whatsapp(indice: int):
+    while True:
+        try:
+            _whatsapp_sinal.clear()
+            mensagem = await reivindicar_mensagem_whatsapp()
+            if mensagem is None:
+                try:
+                    await asyncio.wait_for(_whatsapp_sinal.wait(), timeout=WHATSAPP_POLL_SEGUNDOS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _whatsapp_sinal.set()  # pode haver mais mensagens para os outros workers
+            await limitador_whatsapp.adquirir()
+            await entregar_mensagem_whatsapp(mensagem)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Worker WhatsApp {indice} falhou: {str(e)}")
+            await asyncio.sleep(WHATSAPP_POLL_SEGUNDOS)
+
+
 # ==================== WHATSAPP ROUTES ====================
 
 @api_router.post("/whatsapp/enviar", response_model=MensagemWhatsApp)
 async def enviar_whatsapp(mensagem: MensagemWhatsAppCreate, current_user: User = Depends(get_current_user)):
-    # Get alunos info
-    alunos_info = []
-    for aluno_id in mensagem.destinatarios:
-        aluno = await db.alunos.find_one({"id": aluno_id}, {"_id": 0})
-        if aluno and aluno.get('telefone'):
-            alunos_info.append({"nome": aluno['nome'], "telefone": aluno['telefone']})
-    
-    # TODO: Integrate with Twilio WhatsApp API
-    # For now, just save to database
-    # In production, you would call Twilio API here:
-    # from twilio.rest import Client
-    # client = Client(account_sid, auth_token)
-    # message = client.messages.create(
-    #     from_='whatsapp:+14155238886',
-    #     body=mensagem.mensagem,
-    #     to=f'whatsapp:{telefone}'
-    # )
-    
-    mensagem_obj = MensagemWhatsApp(**mensagem.model_dump())
+    if not mensagem.destinatarios and not mensagem.segmento:
+        raise HTTPException(status_code=400, detail="Informe destinatarios ou segmento")
+    
+    if mensagem.segmento:
+        # Envio em massa: o servidor expande o segmento em segundo plano
+        mensagem_obj = MensagemWhatsApp(
+            destinatarios=[],
+            mensagem=mensagem.mensagem,
+            segmento=mensagem.segmento.model_dump(),
+            status="preparando"
+        )
+        doc = mensagem_obj.model_dump()
+        doc['enviado_em'] = doc['enviado_em'].isoformat()
+        await db.mensagens_whatsapp.insert_one(doc)
+        
+        iniciar_tarefa_background(expandir_segmento_whatsapp(mensagem_obj.id, mensagem.segmento, mensagem.mensagem))
+        return mensagem_obj
+    
+    # Resolve todos os destinatários numa única consulta
+    alunos = await db.alunos.find(
+        {"id": {"$in": mensagem.destinatarios}, "telefone": {"$nin": [None, ""]}},
+        {"_id": 0, "id": 1, "nome": 1, "telefone": 1}
+    ).to_list(len(mensagem.destinatarios))
+    
+    mensagem_obj = MensagemWhatsApp(
+        destinatarios=mensagem.destinatarios,
+        mensagem=mensagem.mensagem,
+        status="enfileirada" if alunos else "concluida",
+        total_destinatarios=len(alunos)
+    )
     doc = mensagem_obj.model_dump()
     doc['enviado_em'] = doc['enviado_em'].isoformat()
-    doc['alunos_info'] = alunos_info
+    doc['alunos_info'] = [{"nome": a['nome'], "telefone": a['telefone']} for a in alunos]
     
     await db.mensagens_whatsapp.insert_one(doc)
+    
+    # O envio acontece nos workers; a requisição retorna com o id da campanha
+    valores = {}
+    if "{{valor_devido}}" in mensagem.mensagem:
+        valores = await calcular_valores_devidos([a['id'] for a in alunos])
+    await enfileirar_mensagens_whatsapp(
+        mensagem_obj.id,
+        renderizar_mensagens_whatsapp(mensagem.mensagem, alunos, valores)
+    )
     return mensagem_obj
 
 @api_router.get("/whatsapp/historico", response_model=List[MensagemWhatsApp])
@@ -972,6 +1501,30 @@ async def get_historico_whatsapp(current_user: User = Depends(get_current_user))
             mensagem['enviado_em'] = datetime.fromisoformat(mensagem['enviado_em'])
     return mensagens
 
+@api_router.get("/whatsapp/campanhas/{campanha_id}")
+async def get_campanha_whatsapp(campanha_id: str, current_user: User = Depends(get_current_user)):
+    campanha = await db.mensagens_whatsapp.find_one({"id": campanha_id}, {"_id": 0, "alunos_info": 0})
+    if not campanha:
+        raise HTTPException(status_code=404, detail="Campanha não encontrada")
+    
+    por_status = await db.whatsapp_outbox.aggregate([
+        {"$match": {"campanha_id": campanha_id}},
+        {"$group": {"_id": "$status", "total": {"$sum": 1}}}
+    ]).to_list(10)
+    campanha['mensagens_por_status'] = {s['_id']: s['total'] for s in por_status}
+    return campanha
+
+@api_router.get("/whatsapp/campanhas/{campanha_id}/mensagens")
+async def get_mensagens_campanha_whatsapp(
+    campanha_id: str,
+    status: Optional[str] = None,
+    current_user: User = Depends(get_current_user)
+):
+    query = {"campanha_id": campanha_id}
+    if status:
+        query['status'] = status
+    return await db.whatsapp_outbox.find(query, {"_id": 0}).to_list(1000)
+
 
 # ==================== AVALIACOES FISICAS ROUTES ====================
 
@@ -1196,6 +1749,87 @@ async def upload_foto(avaliacao_id: str, foto: FotoUpload, current_user: User =
     return {"message": "Foto adicionada com sucesso", "total_fotos": len(fotos)}
 
 
+# ==================== CATÁLOGO DE EXERCÍCIOS ====================
+
+# Biblioteca de exercícios mantida no processo (id -> dados de exibição).
+# Invalidada pelas rotas de exercícios; recarregada após o TTL ou quando aparece
+# um id desconhecido (exercício criado por outro processo), no máximo a cada
+# CATALOGO_EXERCICIOS_RECARGA_MINIMA_SEGUNDOS. Depois de uma invalidação o mapa
+# fica vazio e a próxima leitura recarrega sem esse limite.
+CATALOGO_EXERCICIOS_TTL_SEGUNDOS = int(os.environ.get('CATALOGO_EXERCICIOS_TTL_SEGUNDOS', '300'))
+CATALOGO_EXERCICIOS_RECARGA_MINIMA_SEGUNDOS = 5
+CAMPOS_CATALOGO_EXERCICIO = ("nome", "grupo_muscular", "equipamento", "video_url", "imagem_url")
+# Campos de ExercicioFicha preenchidos pelo catálogo na resposta (não são gravados)
+CAMPOS_HIDRATADOS_EXERCICIO = {"exercicio_nome", "grupo_muscular", "equipamento", "video_url", "imagem_url"}
+
+class CatalogoExercicios:
+    def __init__(self):
+        self._por_id: Optional[dict] = None
+        self._carregado_em = 0.0
+        self._lock = asyncio.Lock()
+        self.versao = 0
+    
+    def invalidar(self):
+        self._por_id = None
+        self.versao += 1
+    
+    def _valido(self) -> bool:
+        return self._por_id is not None and time.monotonic() - self._carregado_em <= CATALOGO_EXERCICIOS_TTL_SEGUNDOS
+    
+    async def _carregar(self, forcar: bool = False):
+        """
+        Recarrega o catálogo. Uma leitura que cruzou uma invalidação é descartada
+        e refeita: instalada, ela pareceria recente e seguraria (pela recarga
+        mínima) o exercício que acabou de ser criado.
+        """
+        async with self._lock:
+            projecao = {"_id": 0, "id": 1, **{campo: 1 for campo in CAMPOS_CATALOGO_EXERCICIO}}
+            while not self._valido() or (
+                forcar and time.monotonic() - self._carregado_em >= CATALOGO_EXERCICIOS_RECARGA_MINIMA_SEGUNDOS
+            ):
+                versao = self.versao
+                por_id = {ex["id"]: ex async for ex in db.exercicios.find({}, projecao)}
+                if self.versao != versao:
+                    continue
+                self._por_id = por_id
+                self._carregado_em = time.monotonic()
+                self.versao += 1
+    
+    async def obter(self, exercicio_ids) -> dict:
+        """id -> dados dos exercícios encontrados (ids inexistentes ficam de fora)."""
+        if not self._valido():
+            await self._carregar()
+        if any(exercicio_id not in self._por_id for exercicio_id in exercicio_ids):
+            await self._carregar(forcar=True)
+        return {
+            exercicio_id: self._por_id[exercicio_id]
+            for exercicio_id in exercicio_ids if exercicio_id in self._por_id
+        }
+    
+    async def obter_um(self, exercicio_id: str) -> Optional[dict]:
+        return (await self.obter([exercicio_id])).get(exercicio_id)
+
+catalogo_exercicios = CatalogoExercicios()
+
+async def validar_exercicios_existentes(exercicio_ids: List[str]):
+    encontrados = await catalogo_exercicios.obter(exercicio_ids)
+    for exercicio_id in exercicio_ids:
+        if exercicio_id not in encontrados:
+            raise HTTPException(status_code=404, detail=f"Exercício {exercicio_id} não encontrado")
+
+async def hidratar_exercicios_fichas(fichas: List[dict]) -> List[dict]:
+    """Preenche nome, grupo muscular, equipamento e mídia dos exercícios das fichas (in place)."""
+    ids = {ex["exercicio_id"] for ficha in fichas for ex in ficha.get("exercicios", [])}
+    catalogo = await catalogo_exercicios.obter(ids)
+    for ficha in fichas:
+        for ex in ficha.get("exercicios", []):
+            dados = catalogo.get(ex["exercicio_id"])
+            if dados:
+                ex["exercicio_nome"] = dados["nome"]
+                ex.update({campo: dados.get(campo) for campo in CAMPOS_CATALOGO_EXERCICIO if campo != "nome"})
+    return fichas
+
+
 # ==================== EXERCICIOS ROUTES ====================
 
 @api_router.post("/exercicios", response_model=Exercicio)
@@ -1210,6 +1844,7 @@ async def create_exercicio(exercicio: ExercicioCreate, current_user: User = Depe
     doc['criado_em'] = doc['criado_em'].isoformat()
     
     await db.exercicios.insert_one(doc)
+    catalogo_exercicios.invalidar()
     return exercicio_obj
 
 @api_router.get("/exercicios", response_model=List[Exercicio])
@@ -1263,6 +1898,7 @@ async def update_exercicio(exercicio_id: str, exercicio_update: ExercicioUpdate,
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Exercício não encontrado")
+    catalogo_exercicios.invalidar()
     
     exercicio = await db.exercicios.find_one({"id": exercicio_id}, {"_id": 0})
     if isinstance(exercicio['criado_em'], str):
@@ -1274,6 +1910,7 @@ async def delete_exercicio(exercicio_id: str, current_user: User = Depends(get_c
     result = await db.exercicios.delete_one({"id": exercicio_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Exercício não encontrado")
+    catalogo_exercicios.invalidar()
     return {"message": "Exercício deletado com sucesso"}
 
 
@@ -1281,13 +1918,13 @@ async def delete_exercicio(exercicio_id: str, current_user: User = Depends(get_c
 
 @api_router.post("/fichas", response_model=FichaTreino)
 async def create_ficha(ficha: FichaTreinoCreate, current_user: User = Depends(get_current_user)):
-    # Validar aluno
-    aluno = await db.alunos.find_one({"id": ficha.aluno_id}, {"_id": 0})
+    # Validar aluno e professor
+    aluno, professor = await asyncio.gather(
+        db.alunos.find_one({"id": ficha.aluno_id}, {"_id": 0}),
+        db.professores.find_one({"id": ficha.professor_id}, {"_id": 0})
+    )
     if not aluno:
         raise HTTPException(status_code=404, detail="Aluno não encontrado")
-    
-    # Validar professor
-    professor = await db.professores.find_one({"id": ficha.professor_id}, {"_id": 0})
     if not professor:
         raise HTTPException(status_code=404, detail="Professor não encontrado")
     
@@ -1298,10 +1935,7 @@ async def create_ficha(ficha: FichaTreinoCreate, current_user: User = Depends(ge
     for ex in ficha.exercicios:
         if ex.series < 1 or ex.series > 10:
             raise HTTPException(status_code=400, detail="O número de séries deve estar entre 1 e 10")
-        
-        exercicio_exists = await db.exercicios.find_one({"id": ex.exercicio_id}, {"_id": 0})
-        if not exercicio_exists:
-            raise HTTPException(status_code=404, detail=f"Exercício {ex.exercicio_id} não encontrado")
+    await validar_exercicios_existentes([ex.exercicio_id for ex in ficha.exercicios])
     
     # Validar datas
     if ficha.data_fim and ficha.data_fim < ficha.data_inicio:
@@ -1312,11 +1946,14 @@ async def create_ficha(ficha: FichaTreinoCreate, current_user: User = Depends(ge
     ficha_data['professor_nome'] = professor['nome']
     
     ficha_obj = FichaTreino(**ficha_data)
-    doc = ficha_obj.model_dump()
+    doc = ficha_obj.model_dump(exclude={"exercicios": {"__all__": CAMPOS_HIDRATADOS_EXERCICIO}})
     doc['criado_em'] = doc['criado_em'].isoformat()
     
     await db.fichas_treino.insert_one(doc)
-    return ficha_obj
+    await sincronizar_segmentos_alunos([ficha_obj.aluno_id])
+    resposta = ficha_obj.model_dump()
+    await hidratar_exercicios_fichas([resposta])
+    return resposta
 
 @api_router.get("/fichas", response_model=List[FichaTreino])
 async def get_fichas(
@@ -1337,7 +1974,7 @@ async def get_fichas(
     for ficha in fichas:
         if isinstance(ficha['criado_em'], str):
             ficha['criado_em'] = datetime.fromisoformat(ficha['criado_em'])
-    return fichas
+    return await hidratar_exercicios_fichas(fichas)
 
 @api_router.get("/fichas/{ficha_id}", response_model=FichaTreino)
 async def get_ficha(ficha_id: str, current_user: User = Depends(get_current_user)):
@@ -1347,6 +1984,7 @@ async def get_ficha(ficha_id: str, current_user: User = Depends(get_current_user
     
     if isinstance(ficha['criado_em'], str):
         ficha['criado_em'] = datetime.fromisoformat(ficha['criado_em'])
+    await hidratar_exercicios_fichas([ficha])
     return FichaTreino(**ficha)
 
 @api_router.put("/fichas/{ficha_id}", response_model=FichaTreino)
@@ -1358,16 +1996,16 @@ async def update_ficha(ficha_id: str, ficha_update: FichaTreinoUpdate, current_u
     
     # Validar exercícios se estiverem sendo atualizados
     if 'exercicios' in update_data:
-        exercicios = update_data['exercicios']
+        exercicios = ficha_update.exercicios
         if len(exercicios) == 0:
             raise HTTPException(status_code=400, detail="A ficha deve ter pelo menos 1 exercício")
         
         for ex in exercicios:
             if ex.series < 1 or ex.series > 10:
                 raise HTTPException(status_code=400, detail="O número de séries deve estar entre 1 e 10")
+        await validar_exercicios_existentes([ex.exercicio_id for ex in exercicios])
         
-        # Converter ExercicioFicha para dict
-        update_data['exercicios'] = [ex.model_dump() if hasattr(ex, 'model_dump') else ex for ex in exercicios]
+        update_data['exercicios'] = [ex.model_dump(exclude=CAMPOS_HIDRATADOS_EXERCICIO) for ex in exercicios]
     
     result = await db.fichas_treino.update_one({"id": ficha_id}, {"$set": update_data})
     
@@ -1375,15 +2013,19 @@ async def update_ficha(ficha_id: str, ficha_update: FichaTreinoUpdate, current_u
         raise HTTPException(status_code=404, detail="Ficha não encontrada")
     
     ficha = await db.fichas_treino.find_one({"id": ficha_id}, {"_id": 0})
+    if 'ativo' in update_data:
+        await sincronizar_segmentos_alunos([ficha['aluno_id']])
     if isinstance(ficha['criado_em'], str):
         ficha['criado_em'] = datetime.fromisoformat(ficha['criado_em'])
+    await hidratar_exercicios_fichas([ficha])
     return FichaTreino(**ficha)
 
 @api_router.delete("/fichas/{ficha_id}")
 async def delete_ficha(ficha_id: str, current_user: User = Depends(get_current_user)):
-    result = await db.fichas_treino.delete_one({"id": ficha_id})
-    if result.deleted_count == 0:
+    ficha = await db.fichas_treino.find_one_and_delete({"id": ficha_id}, projection={"_id": 0, "aluno_id": 1})
+    if not ficha:
         raise HTTPException(status_code=404, detail="Ficha não encontrada")
+    await sincronizar_segmentos_alunos([ficha["aluno_id"]])
     return {"message": "Ficha deletada com sucesso"}
 
 @api_router.get("/fichas/aluno/{aluno_id}/ativas", response_model=List[FichaTreino])
@@ -1403,7 +2045,7 @@ async def get_fichas_ativas_aluno(aluno_id: str, current_user: User = Depends(ge
         if isinstance(ficha['criado_em'], str):
             ficha['criado_em'] = datetime.fromisoformat(ficha['criado_em'])
     
-    return fichas
+    return await hidratar_exercicios_fichas(fichas)
 
 @api_router.post("/fichas/{ficha_id}/duplicar", response_model=FichaTreino)
 async def duplicar_ficha(ficha_id: str, aluno_id: Optional[str] = None, current_user: User = Depends(get_current_user)):
@@ -1431,21 +2073,660 @@ async def duplicar_ficha(ficha_id: str, aluno_id: Optional[str] = None, current_
     doc['criado_em'] = doc['criado_em'].isoformat()
     
     await db.fichas_treino.insert_one(doc)
+    await sincronizar_segmentos_alunos([ficha_original['aluno_id']])
     
+    await hidratar_exercicios_fichas([ficha_original])
     return FichaTreino(**ficha_original)
 
 @api_router.post("/fichas/{ficha_id}/arquivar")
 async def arquivar_ficha(ficha_id: str, current_user: User = Depends(get_current_user)):
-    result = await db.fichas_treino.update_one(
+    ficha = await db.fichas_treino.find_one_and_update(
         {"id": ficha_id},
-        {"$set": {"ativo": False}}
+        {"$set": {"ativo": False}},
+        projection={"_id": 0, "aluno_id": 1}
     )
     
-    if result.matched_count == 0:
+    if not ficha:
         raise HTTPException(status_code=404, detail="Ficha não encontrada")
+    await sincronizar_segmentos_alunos([ficha["aluno_id"]])
     
     return {"message": "Ficha arquivada com sucesso"}
 
+@api_router.get("/fichas/{ficha_id}/recomendacoes")
+async def get_recomendacoes_ficha(ficha_id: str, current_user: User = Depends(get_current_user)):
+    """Carga e repetições sugeridas para todos os exercícios da ficha, a partir do histórico do aluno."""
+    ficha = await db.fichas_treino.find_one({"id": ficha_id}, {"_id": 0, "id": 1, "aluno_id": 1, "exercicios": 1})
+    if not ficha:
+        raise HTTPException(status_code=404, detail="Ficha não encontrada")
+    return {
+        "ficha_id": ficha_id,
+        "aluno_id": ficha['aluno_id'],
+        "recomendacoes": await recomendacoes_ficha(ficha)
+    }
+
+
+# ==================== PROGRESSÃO DE CARGA ====================
+
+# progressao_exercicio: um documento por (aluno, exercício) com a série de sessões
+# em ordem de data_treino. Mantido a cada registro criado/removido, para que a
+# progressão seja uma leitura indexada em vez de varrer todos os registros do aluno.
+PROGRESSAO_LOTE_ESCRITA = 1000
+
+def entrada_progressao(registro_id: str, data_treino, ex_realizado: dict) -> Optional[dict]:
+    """Resumo de um exercício numa sessão; None se nenhuma série teve carga."""
+    series = ex_realizado.get('series_realizadas', [])
+    cargas = [s['carga'] for s in series if s.get('carga', 0) > 0]
+    if not cargas:
+        return None
+    return {
+        "registro_id": registro_id,
+        "data_treino": como_datetime_utc(data_treino).isoformat(),
+        "carga_media": round(sum(cargas) / len(cargas), 2),
+        "carga_maxima": max(cargas),
+        "volume": round(sum(s.get('repeticoes', 0) * s.get('carga', 0) for s in series), 2),
+        "total_series": len(series),
+        "total_reps": sum(s.get('repeticoes', 0) for s in series)
+    }
+
+def entradas_progressao_registro(registro: dict) -> dict:
+    """exercicio_id -> entradas do registro (um exercício pode aparecer mais de uma vez)."""
+    entradas = defaultdict(list)
+    for ex_realizado in registro.get('exercicios_realizados', []):
+        entrada = entrada_progressao(registro['id'], registro['data_treino'], ex_realizado)
+        if entrada:
+            entradas[ex_realizado['exercicio_id']].append(entrada)
+    return entradas
+
+async def registrar_progressao_registro(registro: dict):
+    agora = datetime.now(timezone.utc).isoformat()
+    operacoes = [
+        UpdateOne(
+            {"aluno_id": registro['aluno_id'], "exercicio_id": exercicio_id},
+            {
+                "$push": {"serie": {"$each": entradas, "$sort": {"data_treino": 1}}},
+                "$set": {"atualizado_em": agora}
+            },
+            upsert=True
+        )
+        for exercicio_id, entradas in entradas_progressao_registro(registro).items()
+    ]
+    if operacoes:
+        await db.progressao_exercicio.bulk_write(operacoes, ordered=False)
+
+async def remover_progressao_registro(registro_id: str, aluno_id: str, exercicio_ids: List[str]):
+    if exercicio_ids:
+        await db.progressao_exercicio.update_many(
+            {"aluno_id": aluno_id, "exercicio_id": {"$in": exercicio_ids}},
+            {
+                "$pull": {"serie": {"registro_id": registro_id}},
+                "$set": {"atualizado_em": datetime.now(timezone.utc).isoformat()}
+            }
+        )
+
+async def reconstruir_progressao_exercicios(job_id: Optional[str] = None) -> dict:
+    """
+    Reconstrói progressao_exercicio a partir de registros_treino numa única passada
+    ordenada por (aluno_id, data_treino), gravando em lotes com bulk_write.
+    
+    Registros criados ou removidos durante a passada atualizam a série na hora e
+    carimbam atualizado_em; séries carimbadas depois do início do job não são
+    sobrescritas nem removidas por ele (o cursor pode não ter visto a mudança).
+    """
+    marca = datetime.now(timezone.utc).isoformat()
+    sem_escrita_concorrente = {"atualizado_em": {"$not": {"$gt": marca}}}
+    if job_id:
+        await db.jobs_gamificacao.update_one(
+            {"id": job_id}, {"$set": {"total": await db.registros_treino.count_documents({})}}
+        )
+    
+    operacoes = []
+    processados = 0
+    
+    async def gravar():
+        nonlocal operacoes
+        if operacoes:
+            try:
+                await db.progressao_exercicio.bulk_write(operacoes, ordered=False)
+            except BulkWriteError as e:
+                # Upsert barrado pelo índice único: a série foi escrita durante a passada
+                if any(erro.get("code") != 11000 for erro in e.details.get("writeErrors", [])):
+                    raise
+            operacoes = []
+        if job_id:
+            await db.jobs_gamificacao.update_one({"id": job_id}, {"$set": {"processados": processados}})
+    
+    def finalizar_aluno(aluno_id: str, series: dict):
+        operacoes.extend(
+            UpdateOne(
+                {"aluno_id": aluno_id, "exercicio_id": exercicio_id, **sem_escrita_concorrente},
+                {"$set": {"serie": serie, "reconstruido_em": marca}},
+                upsert=True
+            )
+            for exercicio_id, serie in series.items()
+        )
+    
+    aluno_atual, series = None, defaultdict(list)
+    cursor = db.registros_treino.find(
+        {},
+        {"_id": 0, "id": 1, "aluno_id": 1, "data_treino": 1, "exercicios_realizados": 1}
+    ).sort([("aluno_id", 1), ("data_treino", 1)])
+    async for registro in cursor:
+        if registro['aluno_id'] != aluno_atual:
+            if aluno_atual is not None:
+                finalizar_aluno(aluno_atual, series)
+                if len(operacoes) >= PROGRESSAO_LOTE_ESCRITA:
+                    await gravar()
+            aluno_atual, series = registro['aluno_id'], defaultdict(list)
+        for exercicio_id, entradas in entradas_progressao_registro(registro).items():
+            series[exercicio_id].extend(entradas)
+        processados += 1
+    if aluno_atual is not None:
+        finalizar_aluno(aluno_atual, series)
+    await gravar()
+    
+    # Séries de alunos/exercícios que não têm mais registros
+    removidas = await db.progressao_exercicio.delete_many(
+        {"reconstruido_em": {"$ne": marca}, **sem_escrita_concorrente}
+    )
+    return {"registros": processados, "series_removidas": removidas.deleted_count}
+
+
+# ==================== ANALYTICS DE TREINO ====================
+
+# Volume semanal por grupo muscular e tendência de 1RM estimado, calculados com
+# NumPy em analytics_treino. Aqui ficam a leitura do banco (uma linha por
+# exercício realizado, já projetada pelo $unwind) e a junção com o catálogo.
+ANALYTICS_SEMANAS_PADRAO = 12
+ANALYTICS_SEMANAS_MAXIMO = 53
+ANALYTICS_ACADEMIA_CACHE_MAX = 32
+ANALYTICS_ACADEMIA_CACHE_TTL_SEGUNDOS = int(os.environ.get('ANALYTICS_ACADEMIA_CACHE_TTL_SEGUNDOS', '600'))
+ANALYTICS_ALUNO_CACHE_MAX = 2000
+ANALYTICS_ALUNO_CACHE_TTL_SEGUNDOS = int(os.environ.get('ANALYTICS_ALUNO_CACHE_TTL_SEGUNDOS', '600'))
+ANALYTICS_LOTE_LEITURA = 5000
+_cache_analytics_academia: OrderedDict = OrderedDict()
+# aluno_id -> {(semanas, formula): (calculado_em, resultado)}; descartado a cada registro do aluno
+_cache_analytics_aluno: OrderedDict = OrderedDict()
+
+def invalidar_analytics_aluno(aluno_id: str):
+    _cache_analytics_aluno.pop(aluno_id, None)
+
+def validar_parametros_analytics(semanas: int, formula: str):
+    if not 1 <= semanas <= ANALYTICS_SEMANAS_MAXIMO:
+        raise HTTPException(status_code=400, detail=f"semanas deve estar entre 1 e {ANALYTICS_SEMANAS_MAXIMO}")
+    if formula not in analytics_treino.FORMULAS_1RM:
+        raise HTTPException(status_code=400, detail=f"Fórmula inválida. Use: {', '.join(analytics_treino.FORMULAS_1RM)}")
+
+async def calcular_analytics_treino(filtro: dict, semanas: int, formula: str) -> dict:
+    # Janela alinhada à segunda-feira para que a primeira semana venha completa
+    hoje = datetime.now(timezone.utc).date()
+    inicio = hoje - timedelta(days=hoje.weekday(), weeks=semanas - 1)
+    pipeline = [
+        {"$match": {**filtro, "data_treino": {"$gte": inicio.isoformat()}}},
+        {"$unwind": "$exercicios_realizados"},
+        {"$project": {
+            "_id": 0,
+            "aluno_id": 1,
+            "data_treino": 1,
+            "exercicio_id": "$exercicios_realizados.exercicio_id",
+            "repeticoes": "$exercicios_realizados.series_realizadas.repeticoes",
+            "cargas": "$exercicios_realizados.series_realizadas.carga"
+        }}
+    ]
+    # Lidas em lotes; a montagem das colunas (laço Python por linha) roda numa thread
+    colunas = analytics_treino.ColunasTreino()
+    cursor = db.registros_treino.aggregate(pipeline, allowDiskUse=True, batchSize=ANALYTICS_LOTE_LEITURA)
+    while True:
+        linhas = await cursor.to_list(ANALYTICS_LOTE_LEITURA)
+        if not linhas:
+            break
+        await asyncio.to_thread(colunas.adicionar_lote, linhas)
+    
+    catalogo = await catalogo_exercicios.obter(list(colunas.exercicios))
+    grupos = {exercicio_id: dados.get("grupo_muscular") for exercicio_id, dados in catalogo.items()}
+    resultado = await asyncio.to_thread(analytics_treino.analisar, colunas, grupos, formula)
+    for item in resultado["e1rm_por_exercicio"]:
+        item["exercicio_nome"] = catalogo.get(item["exercicio_id"], {}).get("nome")
+    return {"inicio": inicio.isoformat(), "semanas": semanas, **resultado}
+
+
+# ==================== RECORDES PESSOAIS ====================
+
+# recordes_pessoais: um documento por (aluno, exercício) com a melhor carga, o melhor
+# 1RM estimado e as melhores repetições em cada carga. Cada marca é um subdocumento
+# iniciado por "valor": o $max do MongoDB compara subdocumentos campo a campo, então
+# valor e registro de origem sobem juntos num único update condicional (em empate
+# completo de valor e repetições, fica o registro mais recente).
+RECORDES_FORMULA_1RM = "epley"
+TIPOS_RECORDE = ("carga", "e1rm")
+RECORDES_QUADRO_LIMITE_MAXIMO = 100
+RECORDES_RECALCULO_TENTATIVAS = 3
+
+def chave_carga(carga: float) -> str:
+    """Carga como nome de campo ("42,5"): o ponto seria lido como caminho pelo MongoDB."""
+    return f"{carga:g}".replace(".", ",")
+
+def marcas_exercicio(registro_id: str, data_treino, series: List[dict]) -> Optional[dict]:
+    """Melhores marcas de um exercício numa sessão (só séries concluídas, com carga)."""
+    series = [
+        s for s in series
+        if s.get('concluida', True) and s.get('carga', 0) > 0 and s.get('repeticoes', 0) > 0
+    ]
+    if not series:
+        return None
+    origem = {"data_treino": como_datetime_utc(data_treino).isoformat(), "registro_id": registro_id}
+    
+    # Na mesma carga, mais repetições vencem
+    melhor = max(series, key=lambda s: (s['carga'], s['repeticoes']))
+    marcas = {
+        "carga": {"valor": melhor['carga'], "repeticoes": melhor['repeticoes'], **origem},
+        "repeticoes_por_carga": {}
+    }
+    estimados = analytics_treino.estimar_1rm(
+        [s['carga'] for s in series], [s['repeticoes'] for s in series], RECORDES_FORMULA_1RM
+    ).tolist()
+    candidatos = [(e1rm, s) for e1rm, s in zip(estimados, series) if not math.isnan(e1rm)]
+    if candidatos:
+        e1rm, serie = max(candidatos, key=lambda candidato: candidato[0])
+        marcas["e1rm"] = {
+            "valor": round(e1rm, 2), "carga": serie['carga'], "repeticoes": serie['repeticoes'], **origem
+        }
+    for s in series:
+        chave = chave_carga(s['carga'])
+        marcas["repeticoes_por_carga"][chave] = max(marcas["repeticoes_por_carga"].get(chave, 0), s['repeticoes'])
+    return marcas
+
+def mesclar_marcas(atual: Optional[dict], novas: dict) -> dict:
+    """Mesma regra do $max: subdocumentos comparados campo a campo."""
+    if atual is None:
+        return novas
+    mescladas = {"repeticoes_por_carga": dict(atual["repeticoes_por_carga"])}
+    for tipo in TIPOS_RECORDE:
+        presentes = [marcas[tipo] for marcas in (atual, novas) if marcas.get(tipo)]
+        if presentes:
+            mescladas[tipo] = max(presentes, key=lambda marca: tuple(marca.values()))
+    for chave, repeticoes in novas["repeticoes_por_carga"].items():
+        mescladas["repeticoes_por_carga"][chave] = max(mescladas["repeticoes_por_carga"].get(chave, 0), repeticoes)
+    return mescladas
+
+def acumular_marcas(marcas: dict, registro: dict, exercicio_ids: Optional[set] = None):
+    """Mescla em `marcas` (exercicio_id -> marcas) as marcas do registro."""
+    for ex_realizado in registro.get('exercicios_realizados', []):
+        exercicio_id = ex_realizado['exercicio_id']
+        if exercicio_ids is not None and exercicio_id not in exercicio_ids:
+            continue
+        novas = marcas_exercicio(registro['id'], registro['data_treino'], ex_realizado.get('series_realizadas', []))
+        if novas:
+            marcas[exercicio_id] = mesclar_marcas(marcas.get(exercicio_id), novas)
+
+def recordes_batidos(anterior: Optional[dict], novas: dict) -> List[dict]:
+    """Marcas que superam os recordes anteriores (a primeira sessão de um exercício não conta)."""
+    if not anterior:
+        return []
+    batidos = [
+        {"tipo": tipo, "anterior": anterior[tipo]["valor"], "novo": novas[tipo]["valor"]}
+        for tipo in TIPOS_RECORDE
+        if novas.get(tipo) and anterior.get(tipo) and novas[tipo]["valor"] > anterior[tipo]["valor"]
+    ]
+    repeticoes_anteriores = anterior.get("repeticoes_por_carga", {})
+    for chave, repeticoes in novas["repeticoes_por_carga"].items():
+        if chave in repeticoes_anteriores and repeticoes > repeticoes_anteriores[chave]:
+            batidos.append({
+                "tipo": "repeticoes",
+                "carga": float(chave.replace(",", ".")),
+                "anterior": repeticoes_anteriores[chave],
+                "novo": repeticoes
+            })
+    return batidos
+
+def operacao_recordes(aluno_id: str, exercicio_id: str, marcas: Optional[dict], campos: dict, desde: str):
+    """
+    Substitui os recordes de (aluno, exercício) pelas marcas informadas; sem marcas, remove.
+    
+    Recordes com atualizado_em posterior a `desde` (o $max de um registro gravado
+    depois da leitura das marcas) ficam intactos; o upsert barrado nesse caso
+    falha com chave duplicada (11000).
+    """
+    filtro = {"aluno_id": aluno_id, "exercicio_id": exercicio_id, "atualizado_em": {"$not": {"$gt": desde}}}
+    if not marcas:
+        return DeleteOne(filtro)
+    atualizacao = {"$set": {**marcas, **campos}}
+    if "e1rm" not in marcas:
+        atualizacao["$unset"] = {"e1rm": ""}
+    return UpdateOne(filtro, atualizacao, upsert=True)
+
+async def registrar_recordes_registro(registro: dict):
+    """Aplica as marcas do registro com $max; recordes batidos viram eventos de gamificação."""
+    marcas = {}
+    acumular_marcas(marcas, registro)
+    if not marcas:
+        return
+    aluno_id = registro['aluno_id']
+    anteriores = {
+        recorde["exercicio_id"]: recorde
+        async for recorde in db.recordes_pessoais.find(
+            {"aluno_id": aluno_id, "exercicio_id": {"$in": list(marcas)}},
+            {"_id": 0, "exercicio_id": 1, "carga": 1, "e1rm": 1, "repeticoes_por_carga": 1}
+        )
+    }
+    
+    agora = datetime.now(timezone.utc).isoformat()
+    operacoes = []
+    for exercicio_id, novas in marcas.items():
+        maximos = {tipo: novas[tipo] for tipo in TIPOS_RECORDE if novas.get(tipo)}
+        maximos.update({
+            f"repeticoes_por_carga.{chave}": repeticoes
+            for chave, repeticoes in novas["repeticoes_por_carga"].items()
+        })
+        operacoes.append(UpdateOne(
+            {"aluno_id": aluno_id, "exercicio_id": exercicio_id},
+            {"$max": maximos, "$set": {"aluno_nome": registro['aluno_nome'], "atualizado_em": agora}},
+            upsert=True
+        ))
+    await db.recordes_pessoais.bulk_write(operacoes, ordered=False)
+    
+    nomes = {ex['exercicio_id']: ex.get('exercicio_nome') for ex in registro.get('exercicios_realizados', [])}
+    eventos = []
+    for exercicio_id, novas in marcas.items():
+        batidos = recordes_batidos(anteriores.get(exercicio_id), novas)
+        if batidos:
+            eventos.append(EventoGamificacao(
+                tipo_evento="recorde_pessoal",
+                aluno_id=aluno_id,
+                dados_evento={
+                    "registro_id": registro['id'],
+                    "exercicio_id": exercicio_id,
+                    "exercicio_nome": nomes.get(exercicio_id),
+                    "recordes": batidos
+                },
+                chave_idempotencia=f"recorde:{registro['id']}:{exercicio_id}"
+            ))
+    if eventos:
+        await enfileirar_eventos_gamificacao(eventos)
+
+async def gravar_operacoes_recordes(operacoes: list):
+    try:
+        await db.recordes_pessoais.bulk_write(operacoes, ordered=False)
+    except BulkWriteError as e:
+        if any(erro.get("code") != 11000 for erro in e.details.get("writeErrors", [])):
+            raise
+
+async def recalcular_recordes(aluno_id: str, exercicio_ids: List[str]):
+    """
+    Refaz os recordes dos exercícios a partir dos registros restantes do aluno.
+    
+    Um exercício que recebeu um registro novo durante o recálculo não é
+    sobrescrito; é recalculado de novo, agora com esse registro na leitura.
+    """
+    pendentes = list(exercicio_ids)
+    for _ in range(RECORDES_RECALCULO_TENTATIVAS):
+        if not pendentes:
+            return
+        inicio = datetime.now(timezone.utc).isoformat()
+        marcas = {}
+        async for registro in db.registros_treino.find(
+            {"aluno_id": aluno_id, "exercicios_realizados.exercicio_id": {"$in": pendentes}},
+            {"_id": 0, "id": 1, "data_treino": 1, "exercicios_realizados": 1}
+        ):
+            acumular_marcas(marcas, registro, set(pendentes))
+        agora = datetime.now(timezone.utc).isoformat()
+        await gravar_operacoes_recordes([
+            operacao_recordes(aluno_id, exercicio_id, marcas.get(exercicio_id), {"atualizado_em": agora}, inicio)
+            for exercicio_id in pendentes
+        ])
+        pendentes = [
+            recorde["exercicio_id"]
+            async for recorde in db.recordes_pessoais.find(
+                {
+                    "aluno_id": aluno_id,
+                    "exercicio_id": {"$in": pendentes},
+                    "atualizado_em": {"$gt": inicio, "$ne": agora}
+                },
+                {"_id": 0, "exercicio_id": 1}
+            )
+        ]
+    if pendentes:
+        logger.warning(f"Recordes de {aluno_id} não recalculados (escritas concorrentes): {pendentes}")
+
+async def reconstruir_recordes_pessoais(job_id: Optional[str] = None) -> dict:
+    """
+    Reconstrói recordes_pessoais numa passada por (aluno_id, data_treino), sem emitir eventos.
+    
+    Recordes atualizados por registros gravados durante a passada (atualizado_em
+    depois do início) não são sobrescritos nem removidos.
+    """
+    marca = datetime.now(timezone.utc).isoformat()
+    if job_id:
+        await db.jobs_gamificacao.update_one(
+            {"id": job_id}, {"$set": {"total": await db.registros_treino.count_documents({})}}
+        )
+    
+    operacoes = []
+    processados = 0
+    
+    async def gravar():
+        nonlocal operacoes
+        if operacoes:
+            await gravar_operacoes_recordes(operacoes)
+            operacoes = []
+        if job_id:
+            await db.jobs_gamificacao.update_one({"id": job_id}, {"$set": {"processados": processados}})
+    
+    def finalizar_aluno(aluno_id: str, aluno_nome: str, marcas: dict):
+        campos = {"aluno_nome": aluno_nome, "atualizado_em": marca, "reconstruido_em": marca}
+        operacoes.extend(
+            operacao_recordes(aluno_id, exercicio_id, marcas_exercicio_aluno, campos, marca)
+            for exercicio_id, marcas_exercicio_aluno in marcas.items()
+        )
+    
+    aluno_atual, aluno_nome, marcas = None, None, {}
+    cursor = db.registros_treino.find(
+        {},
+        {"_id": 0, "id": 1, "aluno_id": 1, "aluno_nome": 1, "data_treino": 1, "exercicios_realizados": 1}
+    ).sort([("aluno_id", 1), ("data_treino", 1)])
+    async for registro in cursor:
+        if registro['aluno_id'] != aluno_atual:
+            if aluno_atual is not None:
+                finalizar_aluno(aluno_atual, aluno_nome, marcas)
+                if len(operacoes) >= PROGRESSAO_LOTE_ESCRITA:
+                    await gravar()
+            aluno_atual, marcas = registro['aluno_id'], {}
+        aluno_nome = registro.get('aluno_nome')
+        acumular_marcas(marcas, registro)
+        processados += 1
+    if aluno_atual is not None:
+        finalizar_aluno(aluno_atual, aluno_nome, marcas)
+    await gravar()
+    
+    removidos = await db.recordes_pessoais.delete_many(
+        {"reconstruido_em": {"$ne": marca}, "atualizado_em": {"$not": {"$gt": marca}}}
+    )
+    return {"registros": processados, "recordes_removidos": removidos.deleted_count}
+
+def formatar_recordes(recorde: dict, exercicio_nome: Optional[str]) -> dict:
+    return {
+        "exercicio_id": recorde["exercicio_id"],
+        "exercicio_nome": exercicio_nome,
+        "carga": recorde.get("carga"),
+        "e1rm": recorde.get("e1rm"),
+        "repeticoes_por_carga": sorted(
+            (
+                {"carga": float(chave.replace(",", ".")), "repeticoes": repeticoes}
+                for chave, repeticoes in recorde.get("repeticoes_por_carga", {}).items()
+            ),
+            key=lambda item: item["carga"]
+        ),
+        "atualizado_em": recorde.get("atualizado_em")
+    }
+
+
+# ==================== RECOMENDAÇÃO DE CARGA ====================
+
+# Dupla progressão sobre as últimas sessões do aluno em cada exercício da ficha,
+# olhando a carga de trabalho (a maior da sessão) e as repetições feitas nela:
+# - todas as séries no topo da faixa -> sobe a carga e volta ao início da faixa;
+# - todas dentro da faixa -> mesma carga, uma repetição a mais;
+# - abaixo da faixa em RECOMENDACAO_SESSOES_ESTAGNACAO sessões seguidas na mesma
+#   carga -> descarga; abaixo da faixa uma vez -> repete a carga.
+RECOMENDACAO_HISTORICO_LOTE = 30  # registros lidos por consulta ao buscar o histórico
+RECOMENDACAO_SESSOES_ESTAGNACAO = 2
+RECOMENDACAO_INCREMENTO_PERCENTUAL = 0.025
+RECOMENDACAO_INCREMENTO_MINIMO_KG = 1.0
+RECOMENDACAO_DESCARGA_PERCENTUAL = 0.10
+RECOMENDACAO_ARREDONDAMENTO_KG = 0.5
+RECOMENDACOES_CACHE_MAX = 5000
+RECOMENDACOES_CACHE_TTL_SEGUNDOS = int(os.environ.get('RECOMENDACOES_CACHE_TTL_SEGUNDOS', '600'))
+# aluno_id -> {ficha_id: (calculado_em, prescrição, recomendações)}; descartado a cada registro do aluno
+_cache_recomendacoes: OrderedDict = OrderedDict()
+
+def invalidar_recomendacoes_aluno(aluno_id: str):
+    _cache_recomendacoes.pop(aluno_id, None)
+
+def faixa_repeticoes(repeticoes: str) -> Optional[tuple]:
+    """"8-12" -> (8, 12); "10" -> (10, 10); "AMRAP", "20 segundos" -> None."""
+    partes = repeticoes.replace(" ", "").split("-")
+    if len(partes) > 2 or not all(parte.isdigit() for parte in partes):
+        return None
+    minimo, maximo = int(partes[0]), int(partes[-1])
+    return (minimo, maximo) if 0 < minimo <= maximo else None
+
+def carga_prescrita(carga: Optional[str]) -> Optional[float]:
+    """Carga numérica do texto livre da ficha ("20kg", "22,5 kg"); None para "livre", "dropset"..."""
+    texto = (carga or "").lower().replace("kg", "").replace(",", ".").strip()
+    try:
+        valor = float(texto)
+    except ValueError:
+        return None
+    return valor if valor > 0 else None
+
+def arredondar_carga(carga: float) -> float:
+    return round(round(carga / RECOMENDACAO_ARREDONDAMENTO_KG) * RECOMENDACAO_ARREDONDAMENTO_KG, 2)
+
+def sessao_de_trabalho(data_treino, series: List[dict]) -> Optional[dict]:
+    """Carga de trabalho da sessão e as repetições das séries concluídas com ela."""
+    series = [s for s in series if s.get('concluida', True) and s.get('carga', 0) > 0]
+    if not series:
+        return None
+    carga = max(s['carga'] for s in series)
+    return {
+        "data_treino": como_datetime_utc(data_treino).isoformat()[:10],
+        "carga": carga,
+        "repeticoes": [s['repeticoes'] for s in series if s['carga'] == carga]
+    }
+
+def recomendar_exercicio(prescricao: dict, sessoes: List[dict]) -> dict:
+    """Sugestão para um exercício da ficha; `sessoes` da mais recente para a mais antiga."""
+    faixa = faixa_repeticoes(prescricao['repeticoes'])
+    recomendacao = {
+        "exercicio_id": prescricao['exercicio_id'],
+        "series": prescricao['series'],
+        "repeticoes_prescritas": prescricao['repeticoes'],
+        "ultima_sessao": sessoes[0] if sessoes else None
+    }
+    if not sessoes:
+        return {
+            **recomendacao,
+            "acao": "sem_historico",
+            "carga_sugerida": carga_prescrita(prescricao.get('carga')),
+            "repeticoes_sugeridas": faixa[0] if faixa else None,
+            "motivo": "Sem histórico no exercício: usar a carga da ficha"
+        }
+    
+    carga = sessoes[0]['carga']
+    repeticoes = sessoes[0]['repeticoes']
+    if faixa is None:
+        acao, carga_sugerida, repeticoes_sugeridas = "manter", carga, None
+        motivo = "Repetições sem faixa numérica: manter a carga"
+    else:
+        minimo, maximo = faixa
+        if len(repeticoes) >= prescricao['series'] and min(repeticoes) >= maximo:
+            incremento = max(RECOMENDACAO_INCREMENTO_MINIMO_KG, carga * RECOMENDACAO_INCREMENTO_PERCENTUAL)
+            acao, carga_sugerida, repeticoes_sugeridas = "aumentar_carga", arredondar_carga(carga + incremento), minimo
+            motivo = f"{maximo} repetições em todas as séries com {carga:g} kg"
+        elif min(repeticoes) >= minimo:
+            acao, carga_sugerida, repeticoes_sugeridas = "aumentar_repeticoes", carga, min(maximo, min(repeticoes) + 1)
+            motivo = "Dentro da faixa: buscar mais repetições na mesma carga"
+        elif len(sessoes) >= RECOMENDACAO_SESSOES_ESTAGNACAO and all(
+            sessao['carga'] == carga and min(sessao['repeticoes']) < minimo
+            for sessao in sessoes[:RECOMENDACAO_SESSOES_ESTAGNACAO]
+        ):
+            carga_sugerida = arredondar_carga(carga * (1 - RECOMENDACAO_DESCARGA_PERCENTUAL))
+            acao, repeticoes_sugeridas = "reduzir_carga", minimo
+            motivo = f"Abaixo de {minimo} repetições em {RECOMENDACAO_SESSOES_ESTAGNACAO} sessões seguidas com {carga:g} kg"
+        else:
+            acao, carga_sugerida, repeticoes_sugeridas = "manter", carga, minimo
+            motivo = f"Abaixo de {minimo} repetições: repetir a carga"
+    
+    return {
+        **recomendacao,
+        "acao": acao,
+        "carga_sugerida": carga_sugerida,
+        "repeticoes_sugeridas": repeticoes_sugeridas,
+        "motivo": motivo
+    }
+
+async def sessoes_recentes(aluno_id: str, exercicio_ids: List[str]) -> dict:
+    """
+    exercicio_id -> últimas sessões de trabalho (mais recente primeiro).
+    
+    Lê o histórico do mais recente para trás, em lotes, até cada exercício ter
+    as sessões necessárias; cada lote só procura os exercícios ainda
+    incompletos, então um exercício raro não fica sem histórico por causa dos
+    frequentes.
+    """
+    pendentes = set(exercicio_ids)
+    sessoes = defaultdict(list)
+    ultimo = None
+    while pendentes:
+        filtro = {"aluno_id": aluno_id, "exercicios_realizados.exercicio_id": {"$in": list(pendentes)}}
+        if ultimo:
+            filtro["$or"] = [
+                {"data_treino": {"$lt": ultimo["data_treino"]}},
+                {"data_treino": ultimo["data_treino"], "id": {"$lt": ultimo["id"]}}
+            ]
+        registros = await db.registros_treino.find(
+            filtro, {"_id": 0, "id": 1, "data_treino": 1, "exercicios_realizados": 1}
+        ).sort([("data_treino", -1), ("id", -1)]).limit(RECOMENDACAO_HISTORICO_LOTE).to_list(RECOMENDACAO_HISTORICO_LOTE)
+        for registro in registros:
+            for ex_realizado in registro.get('exercicios_realizados', []):
+                exercicio_id = ex_realizado['exercicio_id']
+                if exercicio_id not in pendentes:
+                    continue
+                sessao = sessao_de_trabalho(registro['data_treino'], ex_realizado.get('series_realizadas', []))
+                if sessao:
+                    sessoes[exercicio_id].append(sessao)
+                    if len(sessoes[exercicio_id]) >= RECOMENDACAO_SESSOES_ESTAGNACAO:
+                        pendentes.discard(exercicio_id)
+        if len(registros) < RECOMENDACAO_HISTORICO_LOTE:
+            break
+        ultimo = registros[-1]
+    return sessoes
+
+async def recomendacoes_ficha(ficha: dict) -> List[dict]:
+    aluno_id = ficha['aluno_id']
+    prescricao = tuple(
+        (ex['exercicio_id'], ex['series'], ex['repeticoes'], ex.get('carga')) for ex in ficha['exercicios']
+    )
+    # O dicionário do aluno entra no cache antes do cálculo: se um registro o invalidar
+    # no meio do caminho, o resultado é gravado num dicionário já descartado.
+    por_ficha = _cache_get(_cache_recomendacoes, aluno_id)
+    if por_ficha is None:
+        por_ficha = {}
+        _cache_set(_cache_recomendacoes, aluno_id, por_ficha, RECOMENDACOES_CACHE_MAX)
+    entrada = por_ficha.get(ficha['id'])
+    if (
+        entrada is not None
+        and entrada[1] == prescricao
+        and time.monotonic() - entrada[0] <= RECOMENDACOES_CACHE_TTL_SEGUNDOS
+    ):
+        return entrada[2]
+    
+    sessoes = await sessoes_recentes(aluno_id, [ex['exercicio_id'] for ex in ficha['exercicios']])
+    recomendacoes = [
+        recomendar_exercicio(ex, sessoes.get(ex['exercicio_id'], [])) for ex in ficha['exercicios']
+    ]
+    por_ficha[ficha['id']] = (time.monotonic(), prescricao, recomendacoes)
+    return recomendacoes
+
 
 # ==================== REGISTROS DE TREINO ROUTES ====================
 
@@ -1478,8 +2759,11 @@ async def create_registro_treino(registro: RegistroTreinoCreate, current_user: U
     registro_data['data_treino'] = data_treino
     
     # Adicionar nome dos exercícios
+    catalogo = await catalogo_exercicios.obter(
+        {ex_realizado['exercicio_id'] for ex_realizado in registro_data['exercicios_realizados']}
+    )
     for ex_realizado in registro_data['exercicios_realizados']:
-        exercicio = await db.exercicios.find_one({"id": ex_realizado['exercicio_id']}, {"_id": 0})
+        exercicio = catalogo.get(ex_realizado['exercicio_id'])
         if exercicio:
             ex_realizado['exercicio_nome'] = exercicio['nome']
     
@@ -1489,6 +2773,13 @@ async def create_registro_treino(registro: RegistroTreinoCreate, current_user: U
     doc['criado_em'] = doc['criado_em'].isoformat()
     
     await db.registros_treino.insert_one(doc)
+    await asyncio.gather(
+        incrementar_contador_atividade(registro_obj.aluno_id, "treinos", registro_obj.data_treino),
+        registrar_progressao_registro(doc),
+        registrar_recordes_registro(doc)
+    )
+    invalidar_recomendacoes_aluno(registro_obj.aluno_id)
+    invalidar_analytics_aluno(registro_obj.aluno_id)
     return registro_obj
 
 @api_router.get("/registros-treino", response_model=List[RegistroTreino])
@@ -1511,6 +2802,25 @@ async def get_registros_treino(
             registro['criado_em'] = datetime.fromisoformat(registro['criado_em'])
     return registros
 
+@api_router.get("/registros-treino/analytics")
+async def get_analytics_academia(
+    semanas: int = ANALYTICS_SEMANAS_PADRAO,
+    formula: str = "epley",
+    current_user: User = Depends(get_current_user)
+):
+    """Volume por grupo muscular e tendência de 1RM estimado de toda a academia."""
+    if current_user.role != "admin":
+        raise HTTPException(403, "Apenas administradores podem ver o analytics da academia")
+    validar_parametros_analytics(semanas, formula)
+    
+    chave = (semanas, formula)
+    entrada = _cache_get(_cache_analytics_academia, chave)
+    if entrada is not None and time.monotonic() - entrada[0] <= ANALYTICS_ACADEMIA_CACHE_TTL_SEGUNDOS:
+        return entrada[1]
+    resultado = await calcular_analytics_treino({}, semanas, formula)
+    _cache_set(_cache_analytics_academia, chave, (time.monotonic(), resultado), ANALYTICS_ACADEMIA_CACHE_MAX)
+    return resultado
+
 @api_router.get("/registros-treino/{registro_id}", response_model=RegistroTreino)
 async def get_registro_treino(registro_id: str, current_user: User = Depends(get_current_user)):
     registro = await db.registros_treino.find_one({"id": registro_id}, {"_id": 0})
@@ -1525,9 +2835,20 @@ async def get_registro_treino(registro_id: str, current_user: User = Depends(get
 
 @api_router.delete("/registros-treino/{registro_id}")
 async def delete_registro_treino(registro_id: str, current_user: User = Depends(get_current_user)):
-    result = await db.registros_treino.delete_one({"id": registro_id})
-    if result.deleted_count == 0:
+    registro = await db.registros_treino.find_one_and_delete(
+        {"id": registro_id},
+        projection={"_id": 0, "aluno_id": 1, "data_treino": 1, "exercicios_realizados.exercicio_id": 1}
+    )
+    if not registro:
         raise HTTPException(status_code=404, detail="Registro não encontrado")
+    exercicio_ids = list({ex["exercicio_id"] for ex in registro.get("exercicios_realizados", [])})
+    await asyncio.gather(
+        incrementar_contador_atividade(registro["aluno_id"], "treinos", registro["data_treino"], -1),
+        remover_progressao_registro(registro_id, registro["aluno_id"], exercicio_ids),
+        recalcular_recordes(registro["aluno_id"], exercicio_ids)
+    )
+    invalidar_recomendacoes_aluno(registro["aluno_id"])
+    invalidar_analytics_aluno(registro["aluno_id"])
     return {"message": "Registro deletado com sucesso"}
 
 @api_router.get("/registros-treino/aluno/{aluno_id}/historico", response_model=List[RegistroTreino])
@@ -1547,36 +2868,24 @@ async def get_historico_treinos_aluno(aluno_id: str, current_user: User = Depend
 
 @api_router.get("/registros-treino/aluno/{aluno_id}/progressao/{exercicio_id}", response_model=ProgressaoCarga)
 async def get_progressao_carga(aluno_id: str, exercicio_id: str, current_user: User = Depends(get_current_user)):
-    # Buscar exercício
-    exercicio = await db.exercicios.find_one({"id": exercicio_id}, {"_id": 0})
+    exercicio, progressao = await asyncio.gather(
+        catalogo_exercicios.obter_um(exercicio_id),
+        db.progressao_exercicio.find_one({"aluno_id": aluno_id, "exercicio_id": exercicio_id}, {"_id": 0, "serie": 1})
+    )
     if not exercicio:
         raise HTTPException(status_code=404, detail="Exercício não encontrado")
     
-    # Buscar todos os registros do aluno
-    registros = await db.registros_treino.find(
-        {"aluno_id": aluno_id},
-        {"_id": 0}
-    ).sort("data_treino", 1).to_list(10000)
-    
-    historico = []
-    for registro in registros:
-        data_treino = registro['data_treino']
-        if isinstance(data_treino, str):
-            data_treino = datetime.fromisoformat(data_treino)
-        
-        for ex_realizado in registro.get('exercicios_realizados', []):
-            if ex_realizado.get('exercicio_id') == exercicio_id:
-                series = ex_realizado.get('series_realizadas', [])
-                if series:
-                    cargas = [s['carga'] for s in series if s.get('carga', 0) > 0]
-                    if cargas:
-                        historico.append({
-                            "data": data_treino.strftime("%Y-%m-%d"),
-                            "carga_media": round(sum(cargas) / len(cargas), 2),
-                            "carga_maxima": max(cargas),
-                            "total_series": len(series),
-                            "total_reps": sum(s.get('repeticoes', 0) for s in series)
-                        })
+    historico = [
+        {
+            "data": entrada["data_treino"][:10],
+            "carga_media": entrada["carga_media"],
+            "carga_maxima": entrada["carga_maxima"],
+            "volume": entrada["volume"],
+            "total_series": entrada["total_series"],
+            "total_reps": entrada["total_reps"]
+        }
+        for entrada in (progressao or {}).get("serie", [])
+    ]
     
     return ProgressaoCarga(
         exercicio_id=exercicio_id,
@@ -1584,6 +2893,90 @@ async def get_progressao_carga(aluno_id: str, exercicio_id: str, current_user: U
         historico=historico
     )
 
+@api_router.get("/registros-treino/aluno/{aluno_id}/analytics")
+async def get_analytics_aluno(
+    aluno_id: str,
+    semanas: int = ANALYTICS_SEMANAS_PADRAO,
+    formula: str = "epley",
+    current_user: User = Depends(get_current_user)
+):
+    """Volume semanal por grupo muscular, intensidade e tendência de 1RM estimado do aluno."""
+    validar_parametros_analytics(semanas, formula)
+    aluno = await db.alunos.find_one({"id": aluno_id}, {"_id": 0, "id": 1})
+    if not aluno:
+        raise HTTPException(status_code=404, detail="Aluno não encontrado")
+    
+    # Mesmo esquema das recomendações: o dicionário do aluno entra no cache antes do
+    # cálculo, e um registro gravado no meio do caminho o descarta junto com o resultado
+    por_parametros = _cache_get(_cache_analytics_aluno, aluno_id)
+    if por_parametros is None:
+        por_parametros = {}
+        _cache_set(_cache_analytics_aluno, aluno_id, por_parametros, ANALYTICS_ALUNO_CACHE_MAX)
+    entrada = por_parametros.get((semanas, formula))
+    if entrada is not None and time.monotonic() - entrada[0] <= ANALYTICS_ALUNO_CACHE_TTL_SEGUNDOS:
+        return entrada[1]
+    resultado = {"aluno_id": aluno_id, **await calcular_analytics_treino({"aluno_id": aluno_id}, semanas, formula)}
+    por_parametros[(semanas, formula)] = (time.monotonic(), resultado)
+    return resultado
+
+@api_router.post("/registros-treino/progressao/reconstruir")
+async def reconstruir_progressao_carga(current_user: User = Depends(get_current_user)):
+    """Reconstrói as séries de progressão de carga a partir do histórico (em segundo plano)."""
+    if current_user.role != "admin":
+        raise HTTPException(403, "Apenas administradores podem reconstruir a progressão")
+    
+    # Mesmo mecanismo de jobs da gamificação: acompanhar em GET /gamificacao/jobs/{job_id}
+    return await iniciar_job_gamificacao("reconstruir_progressao", reconstruir_progressao_exercicios)
+
+@api_router.get("/registros-treino/aluno/{aluno_id}/recordes")
+async def get_recordes_aluno(aluno_id: str, current_user: User = Depends(get_current_user)):
+    """Recordes pessoais do aluno em cada exercício."""
+    recordes = await db.recordes_pessoais.find({"aluno_id": aluno_id}, {"_id": 0}).to_list(1000)
+    catalogo = await catalogo_exercicios.obter([recorde["exercicio_id"] for recorde in recordes])
+    resultado = [
+        formatar_recordes(recorde, catalogo.get(recorde["exercicio_id"], {}).get("nome"))
+        for recorde in recordes
+    ]
+    return sorted(resultado, key=lambda recorde: recorde["exercicio_nome"] or "")
+
+@api_router.get("/registros-treino/recordes/{exercicio_id}")
+async def get_quadro_recordes(
+    exercicio_id: str,
+    tipo: str = "carga",
+    limite: int = 20,
+    current_user: User = Depends(get_current_user)
+):
+    """Quadro de recordes da academia num exercício (maior carga ou maior 1RM estimado)."""
+    if tipo not in TIPOS_RECORDE:
+        raise HTTPException(status_code=400, detail=f"Tipo inválido. Use: {', '.join(TIPOS_RECORDE)}")
+    exercicio = await catalogo_exercicios.obter_um(exercicio_id)
+    if not exercicio:
+        raise HTTPException(status_code=404, detail="Exercício não encontrado")
+    
+    # Servido pelo índice (exercicio_id, <tipo>.valor, <tipo>.data_treino): empate vai para quem chegou antes
+    limite = max(1, min(limite, RECORDES_QUADRO_LIMITE_MAXIMO))
+    recordes = await db.recordes_pessoais.find(
+        {"exercicio_id": exercicio_id, f"{tipo}.valor": {"$exists": True}},
+        {"_id": 0, "aluno_id": 1, "aluno_nome": 1, tipo: 1}
+    ).sort([(f"{tipo}.valor", -1), (f"{tipo}.data_treino", 1)]).limit(limite).to_list(limite)
+    
+    return {
+        "exercicio_id": exercicio_id,
+        "exercicio_nome": exercicio["nome"],
+        "tipo": tipo,
+        "recordes": [
+            {"posicao": posicao, "aluno_id": recorde["aluno_id"], "aluno_nome": recorde.get("aluno_nome"), **recorde[tipo]}
+            for posicao, recorde in enumerate(recordes, start=1)
+        ]
+    }
+
+@api_router.post("/registros-treino/recordes/reconstruir")
+async def reconstruir_recordes(current_user: User = Depends(get_current_user)):
+    """Reconstrói os recordes pessoais a partir do histórico (em segundo plano)."""
+    if current_user.role != "admin":
+        raise HTTPException(403, "Apenas administradores podem reconstruir os recordes")
+    return await iniciar_job_gamificacao("reconstruir_recordes", reconstruir_recordes_pessoais)
+
 @api_router.get("/registros-treino/aluno/{aluno_id}/calendario")
 async def get_calendario_treinos(aluno_id: str, current_user: User = Depends(get_current_user)):
     registros = await db.registros_treino.find(
@@ -2225,6 +3618,7 @@ class Contrato(BaseModel):
     aluno_nome: str
     template_id: str
     template_nome: str
+    template_versao: int = 1  # Versão imutável do template usada na geração
     plano_id: Optional[str] = None
     plano_nome: Optional[str] = None
     
@@ -2238,7 +3632,9 @@ class Contrato(BaseModel):
     
     # Status e assinatura
     status: str = "pendente"  # pendente, assinado, ativo, vencido, cancelado
-    conteudo_gerado: str  # HTML final com dados preenchidos
+    parametros: dict = Field(default_factory=dict)  # Valores dos placeholders {{chave}}
+    conteudo_gerado: Optional[str] = None  # HTML final, renderizado na leitura (não persistido)
+    hash_conteudo: Optional[str] = None  # SHA-256 do conteúdo no momento da assinatura
     assinatura_aluno: Optional[str] = None  # Base64 da assinatura
     assinatura_responsavel: Optional[str] = None  # Base64
     data_assinatura: Optional[datetime] = None
@@ -2269,14 +3665,124 @@ class ContratoCreate(BaseModel):
     dia_vencimento: int = 5
 
 class ContratoAssinar(BaseModel):
-    assinatura_aluno: str  # Base64 da assinatura
+    assinatura_aluno: str  # data:image/png;base64,... (ou image/jpeg)
     assinatura_responsavel: Optional[str] = None
     ip_address: Optional[str] = None
 
 
-# ==================== CONTRATOS - TEMPLATES ROUTES ====================
+# ==================== CONTRATOS - RENDERIZAÇÃO ====================
+
+# Versões de template são imutáveis, então os caches só precisam de limite de tamanho
+CACHE_TEMPLATES_VERSAO_MAX = 256
+CACHE_CONTEUDO_CONTRATO_MAX = 2048
+_cache_templates_versao: OrderedDict = OrderedDict()
+_cache_conteudo_contrato: OrderedDict = OrderedDict()
+
+def _cache_get(cache: OrderedDict, chave):
+    valor = cache.get(chave)
+    if valor is not None:
+        cache.move_to_end(chave)
+    return valor
+
+def _cache_set(cache: OrderedDict, chave, valor, limite: int):
+    cache[chave] = valor
+    cache.move_to_end(chave)
+    while len(cache) > limite:
+        cache.popitem(last=False)
+
+def formatar_moeda(valor: float) -> str:
+    """Formata valor no padrão brasileiro: R$ 1.234,56"""
+    return f"R$ {valor:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+
+def renderizar_template(conteudo_html: str, parametros: dict) -> str:
+    """Substitui os placeholders {{chave}} do template pelos parâmetros do contrato."""
+    for chave, valor in parametros.items():
+        conteudo_html = conteudo_html.replace("{{" + chave + "}}", str(valor))
+    return conteudo_html
+
+def calcular_hash_conteudo(conteudo: str) -> str:
+    return hashlib.sha256(conteudo.encode("utf-8")).hexdigest()
+
+async def salvar_versao_template(template: dict):
+    """Grava o snapshot imutável de uma versão do template (idempotente)."""
+    versao = template.get("versao", 1)
+    await db.contratos_templates_versoes.update_one(
+        {"template_id": template["id"], "versao": versao},
+        {"$setOnInsert": {
+            "template_id": template["id"],
+            "versao": versao,
+            "nome": template["nome"],
+            "conteudo_html": template["conteudo_html"],
+            "clausulas": template.get("clausulas", []),
+            "criado_em": datetime.now(timezone.utc).isoformat()
+        }},
+        upsert=True
+    )
 
-@api_router.post("/contratos/templates", response_model=ContratoTemplate)
+async def carregar_templates_versoes(chaves: set) -> dict:
+    """Retorna {(template_id, versao): conteudo_html} buscando o que falta numa única consulta."""
+    resultado = {}
+    faltando = []
+    for chave in chaves:
+        html = _cache_get(_cache_templates_versao, chave)
+        if html is None:
+            faltando.append(chave)
+        else:
+            resultado[chave] = html
+    
+    if faltando:
+        versoes = await db.contratos_templates_versoes.find(
+            {"$or": [{"template_id": t, "versao": v} for t, v in faltando]},
+            {"_id": 0, "template_id": 1, "versao": 1, "conteudo_html": 1}
+        ).to_list(len(faltando))
+        for v in versoes:
+            chave = (v["template_id"], v["versao"])
+            resultado[chave] = v["conteudo_html"]
+            _cache_set(_cache_templates_versao, chave, v["conteudo_html"], CACHE_TEMPLATES_VERSAO_MAX)
+        
+        # Templates criados antes do versionamento: a versão corrente vive no próprio documento
+        sem_snapshot = [c for c in faltando if c not in resultado]
+        if sem_snapshot:
+            templates = await db.contratos_templates.find(
+                {"id": {"$in": list({t for t, _ in sem_snapshot})}},
+                {"_id": 0, "id": 1, "versao": 1, "conteudo_html": 1}
+            ).to_list(len(sem_snapshot))
+            for t in templates:
+                chave = (t["id"], t.get("versao", 1))
+                if chave in sem_snapshot:
+                    resultado[chave] = t["conteudo_html"]
+                    _cache_set(_cache_templates_versao, chave, t["conteudo_html"], CACHE_TEMPLATES_VERSAO_MAX)
+    
+    return resultado
+
+async def hidratar_conteudo_contratos(contratos: List[dict]):
+    """Preenche conteudo_gerado a partir de template + versão + parâmetros (memoizado)."""
+    pendentes = [c for c in contratos if not c.get("conteudo_gerado")]
+    if not pendentes:
+        return
+    
+    templates = await carregar_templates_versoes(
+        {(c["template_id"], c.get("template_versao", 1)) for c in pendentes}
+    )
+    
+    for c in pendentes:
+        parametros = c.get("parametros", {})
+        chave_template = (c["template_id"], c.get("template_versao", 1))
+        chave = chave_template + (tuple(sorted(parametros.items())),)
+        conteudo = _cache_get(_cache_conteudo_contrato, chave)
+        if conteudo is None:
+            html = templates.get(chave_template)
+            if html is None:
+                logger.warning(f"Template {chave_template} não encontrado para contrato {c.get('id')}")
+                continue
+            conteudo = renderizar_template(html, parametros)
+            _cache_set(_cache_conteudo_contrato, chave, conteudo, CACHE_CONTEUDO_CONTRATO_MAX)
+        c["conteudo_gerado"] = conteudo
+
+
+# ==================== CONTRATOS - TEMPLATES ROUTES ====================
+
+@api_router.post("/contratos/templates", response_model=ContratoTemplate)
 async def criar_template_contrato(
     template: ContratoTemplateCreate,
     current_user: User = Depends(get_current_user)
@@ -2288,6 +3794,7 @@ async def criar_template_contrato(
     doc['atualizado_em'] = doc['atualizado_em'].isoformat()
     
     await db.contratos_templates.insert_one(doc)
+    await salvar_versao_template(doc)
     return template_obj
 
 @api_router.get("/contratos/templates", response_model=List[ContratoTemplate])
@@ -2335,6 +3842,9 @@ async def atualizar_template(
     if not template:
         raise HTTPException(404, "Template não encontrado")
     
+    # Garante que a versão vigente continue disponível para os contratos já gerados
+    await salvar_versao_template(template)
+    
     update_dict = updates.model_dump()
     update_dict["atualizado_em"] = datetime.now(timezone.utc).isoformat()
     update_dict["versao"] = template.get("versao", 1) + 1
@@ -2345,6 +3855,7 @@ async def atualizar_template(
     )
     
     updated = await db.contratos_templates.find_one({"id": id}, {"_id": 0})
+    await salvar_versao_template(updated)
     if isinstance(updated.get('criado_em'), str):
         updated['criado_em'] = datetime.fromisoformat(updated['criado_em'])
     if isinstance(updated.get('atualizado_em'), str):
@@ -2366,6 +3877,124 @@ async def deletar_template(
     return {"message": "Template desativado com sucesso"}
 
 
+# ==================== CONTRATOS - PDF ====================
+
+# PDFs são endereçados pelo hash do HTML final: mesmo conteúdo, mesmo arquivo
+PDF_CACHE_DIR = Path(os.environ.get('PDF_CACHE_DIR', ROOT_DIR / 'pdf_cache'))
+PDF_WORKERS = int(os.environ.get('PDF_WORKERS', '2'))
+PDF_LOTE_TAMANHO = 50
+# Teto do cache em disco; a limpeza roda a cada PDF_CACHE_LIMPEZA_A_CADA renderizações
+PDF_CACHE_MAX_ARQUIVOS = int(os.environ.get('PDF_CACHE_MAX_ARQUIVOS', '5000'))
+PDF_CACHE_LIMPEZA_A_CADA = 50
+
+_pdf_executor: Optional[ProcessPoolExecutor] = None
+_pdf_em_andamento: dict = {}
+_pdf_renderizados_desde_limpeza = PDF_CACHE_LIMPEZA_A_CADA  # limpa já na primeira renderização
+
+def obter_pdf_executor() -> ProcessPoolExecutor:
+    global _pdf_executor
+    if _pdf_executor is None:
+        PDF_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        # spawn: os filhos importam só contratos_pdf, sem copiar o servidor (ver o módulo)
+        _pdf_executor = ProcessPoolExecutor(
+            max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _pdf_executor
+
+async def limpar_cache_pdf_se_preciso():
+    global _pdf_renderizados_desde_limpeza
+    _pdf_renderizados_desde_limpeza += 1
+    if _pdf_renderizados_desde_limpeza < PDF_CACHE_LIMPEZA_A_CADA:
+        return
+    _pdf_renderizados_desde_limpeza = 0
+    removidos = await asyncio.to_thread(
+        contratos_pdf.limpar_cache, str(PDF_CACHE_DIR), PDF_CACHE_MAX_ARQUIVOS
+    )
+    if removidos:
+        logger.info(f"Cache de PDF: {removidos} arquivos antigos removidos")
+
+async def gerar_pdf_contrato(contrato: dict) -> tuple:
+    """
+    Gera o PDF do contrato no pool de processos, reaproveitando o cache em disco.
+    
+    O contrato deve estar hidratado (conteudo_gerado preenchido).
+    Retorna (hash_pdf, caminho).
+    """
+    data_assinatura = contrato.get("data_assinatura")
+    if isinstance(data_assinatura, datetime):
+        data_assinatura = data_assinatura.isoformat()
+    
+    documento = contratos_pdf.montar_html_contrato(
+        conteudo_gerado=contrato["conteudo_gerado"],
+        numero_contrato=contrato["numero_contrato"],
+        aluno_nome=contrato["aluno_nome"],
+        assinatura_aluno=contrato.get("assinatura_aluno"),
+        assinatura_responsavel=contrato.get("assinatura_responsavel"),
+        data_assinatura=data_assinatura,
+        hash_conteudo=contrato.get("hash_conteudo")
+    )
+    chave = contratos_pdf.hash_documento(documento)
+    caminho = PDF_CACHE_DIR / f"{chave}.pdf"
+    try:
+        # Renova o mtime: a limpeza do cache remove primeiro os menos usados
+        os.utime(caminho)
+        return chave, caminho
+    except FileNotFoundError:
+        pass
+    
+    # Requisições simultâneas do mesmo documento compartilham a mesma renderização
+    futuro = _pdf_em_andamento.get(chave)
+    renderizando = futuro is None
+    if renderizando:
+        loop = asyncio.get_running_loop()
+        futuro = loop.run_in_executor(
+            obter_pdf_executor(), contratos_pdf.renderizar_pdf, documento, str(caminho)
+        )
+        _pdf_em_andamento[chave] = futuro
+        futuro.add_done_callback(lambda _: _pdf_em_andamento.pop(chave, None))
+    
+    await asyncio.shield(futuro)
+    if renderizando:
+        await limpar_cache_pdf_se_preciso()
+    return chave, caminho
+
+async def processar_lote_pdf(lote_id: str, query: dict):
+    """Renderiza os PDFs de todos os contratos do filtro, registrando o progresso."""
+    cursor = db.contratos.find(query, {"_id": 0}).batch_size(PDF_LOTE_TAMANHO)
+    bloco = []
+    
+    async def renderizar_bloco(contratos: List[dict]):
+        await hidratar_conteudo_contratos(contratos)
+        resultados = await asyncio.gather(
+            *[gerar_pdf_contrato(c) for c in contratos if c.get("conteudo_gerado")],
+            return_exceptions=True
+        )
+        erros = sum(1 for r in resultados if isinstance(r, Exception))
+        erros += sum(1 for c in contratos if not c.get("conteudo_gerado"))
+        await db.lotes_pdf.update_one(
+            {"id": lote_id},
+            {"$inc": {"processados": len(contratos), "erros": erros}}
+        )
+    
+    try:
+        async for contrato in cursor:
+            bloco.append(contrato)
+            if len(bloco) >= PDF_LOTE_TAMANHO:
+                await renderizar_bloco(bloco)
+                bloco = []
+        if bloco:
+            await renderizar_bloco(bloco)
+        status_final = "concluido"
+    except Exception as e:
+        logger.error(f"Lote de PDF {lote_id} falhou: {str(e)}")
+        status_final = "erro"
+    
+    await db.lotes_pdf.update_one(
+        {"id": lote_id},
+        {"$set": {"status": status_final, "finalizado_em": datetime.now(timezone.utc).isoformat()}}
+    )
+
+
 # ==================== CONTRATOS - GESTÃO ROUTES ====================
 
 @api_router.post("/contratos", response_model=Contrato)
@@ -2393,36 +4022,32 @@ async def criar_contrato(
             plano_nome = plano.get("nome")
     
     # Gerar número do contrato
-    count = await db.contratos.count_documents({})
-    numero_contrato = f"CTRT-{datetime.now().year}-{str(count + 1).zfill(4)}"
-    
-    # Gerar conteúdo do contrato (substituir placeholders)
-    conteudo = template["conteudo_html"]
-    replacements = {
-        "{{aluno_nome}}": aluno["nome"],
-        "{{aluno_cpf}}": aluno.get("cpf", "N/A"),
-        "{{aluno_email}}": aluno.get("email", "N/A"),
-        "{{aluno_telefone}}": aluno.get("telefone", "N/A"),
-        "{{numero_contrato}}": numero_contrato,
-        "{{valor_total}}": f"R$ {contrato.valor_total:,.2f}".replace(",", "X").replace(".", ",").replace("X", "."),
-        "{{valor_mensal}}": f"R$ {contrato.valor_mensal:,.2f}".replace(",", "X").replace(".", ",").replace("X", "."),
-        "{{data_inicio}}": contrato.data_inicio,
-        "{{data_fim}}": contrato.data_fim,
-        "{{duracao_meses}}": str(contrato.duracao_meses),
-        "{{plano_nome}}": plano_nome or "N/A",
-        "{{dia_vencimento}}": str(contrato.dia_vencimento),
-        "{{data_atual}}": datetime.now().strftime("%d/%m/%Y"),
+    numero_contrato = await gerar_numero_contrato()
+    
+    # Parâmetros dos placeholders (o HTML é renderizado na leitura)
+    parametros = {
+        "aluno_nome": aluno["nome"],
+        "aluno_cpf": aluno.get("cpf") or "N/A",
+        "aluno_email": aluno.get("email") or "N/A",
+        "aluno_telefone": aluno.get("telefone") or "N/A",
+        "numero_contrato": numero_contrato,
+        "valor_total": formatar_moeda(contrato.valor_total),
+        "valor_mensal": formatar_moeda(contrato.valor_mensal),
+        "data_inicio": contrato.data_inicio,
+        "data_fim": contrato.data_fim,
+        "duracao_meses": str(contrato.duracao_meses),
+        "plano_nome": plano_nome or "N/A",
+        "dia_vencimento": str(contrato.dia_vencimento),
+        "data_atual": datetime.now().strftime("%d/%m/%Y"),
     }
     
-    for key, value in replacements.items():
-        conteudo = conteudo.replace(key, str(value))
-    
     # Criar contrato
     contrato_obj = Contrato(
         aluno_id=contrato.aluno_id,
         aluno_nome=aluno["nome"],
         template_id=contrato.template_id,
         template_nome=template["nome"],
+        template_versao=template.get("versao", 1),
         plano_id=contrato.plano_id,
         plano_nome=plano_nome,
         numero_contrato=numero_contrato,
@@ -2431,16 +4056,18 @@ async def criar_contrato(
         data_inicio=contrato.data_inicio,
         data_fim=contrato.data_fim,
         duracao_meses=contrato.duracao_meses,
-        conteudo_gerado=conteudo,
+        parametros=parametros,
         renovacao_automatica=contrato.renovacao_automatica,
         dia_vencimento=contrato.dia_vencimento
     )
     
-    doc = contrato_obj.model_dump()
+    doc = contrato_obj.model_dump(exclude={"conteudo_gerado"})
     doc['criado_em'] = doc['criado_em'].isoformat()
     doc['atualizado_em'] = doc['atualizado_em'].isoformat()
     
     await db.contratos.insert_one(doc)
+    
+    contrato_obj.conteudo_gerado = renderizar_template(template["conteudo_html"], parametros)
     return contrato_obj
 
 @api_router.get("/contratos", response_model=List[Contrato])
@@ -2466,6 +4093,8 @@ async def listar_contratos(
             c['data_assinatura'] = datetime.fromisoformat(c['data_assinatura'])
         if c.get('data_email') and isinstance(c['data_email'], str):
             c['data_email'] = datetime.fromisoformat(c['data_email'])
+    
+    await hidratar_conteudo_contratos(contratos)
     return contratos
 
 @api_router.get("/contratos/vencendo/{dias}")
@@ -2488,8 +4117,47 @@ async def contratos_vencendo(
         if isinstance(c.get('atualizado_em'), str):
             c['atualizado_em'] = datetime.fromisoformat(c['atualizado_em'])
     
+    await hidratar_conteudo_contratos(contratos)
     return contratos
 
+@api_router.post("/contratos/pdf/lote")
+async def gerar_pdfs_contratos_mes(
+    mes: str,
+    current_user: User = Depends(get_current_user)
+):
+    """Gera em segundo plano os PDFs dos contratos criados no mês (AAAA-MM)"""
+    try:
+        inicio = datetime.strptime(mes, "%Y-%m")
+    except ValueError:
+        raise HTTPException(400, "Mês inválido. Use o formato AAAA-MM")
+    
+    proximo = (inicio.replace(day=28) + timedelta(days=4)).replace(day=1)
+    query = {"criado_em": {"$gte": inicio.strftime("%Y-%m"), "$lt": proximo.strftime("%Y-%m")}}
+    
+    lote = {
+        "id": str(uuid.uuid4()),
+        "mes": mes,
+        "status": "processando",
+        "total": await db.contratos.count_documents(query),
+        "processados": 0,
+        "erros": 0,
+        "criado_em": datetime.now(timezone.utc).isoformat()
+    }
+    await db.lotes_pdf.insert_one(lote.copy())
+    iniciar_tarefa_background(processar_lote_pdf(lote["id"], query))
+    return lote
+
+@api_router.get("/contratos/pdf/lote/{lote_id}")
+async def obter_lote_pdf(
+    lote_id: str,
+    current_user: User = Depends(get_current_user)
+):
+    """Consultar progresso de um lote de PDFs"""
+    lote = await db.lotes_pdf.find_one({"id": lote_id}, {"_id": 0})
+    if not lote:
+        raise HTTPException(404, "Lote não encontrado")
+    return lote
+
 @api_router.get("/contratos/{id}", response_model=Contrato)
 async def obter_contrato(
     id: str,
@@ -2509,6 +4177,7 @@ async def obter_contrato(
     if contrato.get('data_email') and isinstance(contrato['data_email'], str):
         contrato['data_email'] = datetime.fromisoformat(contrato['data_email'])
     
+    await hidratar_conteudo_contratos([contrato])
     return Contrato(**contrato)
 
 @api_router.post("/contratos/{id}/assinar", response_model=Contrato)
@@ -2525,6 +4194,15 @@ async def assinar_contrato(
     if contrato["status"] == "assinado":
         raise HTTPException(400, "Contrato já foi assinado")
     
+    for assinatura_imagem in (assinatura.assinatura_aluno, assinatura.assinatura_responsavel):
+        if assinatura_imagem is not None and not contratos_pdf.assinatura_valida(assinatura_imagem):
+            raise HTTPException(400, "Assinatura deve ser uma imagem PNG ou JPEG em data URI (base64)")
+    
+    # Hash do conteúdo exatamente como foi apresentado para assinatura
+    await hidratar_conteudo_contratos([contrato])
+    if not contrato.get("conteudo_gerado"):
+        raise HTTPException(500, "Não foi possível gerar o conteúdo do contrato")
+    
     # Atualizar com assinatura
     now = datetime.now(timezone.utc)
     await db.contratos.update_one(
@@ -2534,6 +4212,7 @@ async def assinar_contrato(
             "assinatura_responsavel": assinatura.assinatura_responsavel,
             "data_assinatura": now.isoformat(),
             "ip_assinatura": assinatura.ip_address,
+            "hash_conteudo": calcular_hash_conteudo(contrato["conteudo_gerado"]),
             "status": "assinado",
             "atualizado_em": now.isoformat()
         }}
@@ -2547,8 +4226,31 @@ async def assinar_contrato(
     if updated.get('data_assinatura') and isinstance(updated['data_assinatura'], str):
         updated['data_assinatura'] = datetime.fromisoformat(updated['data_assinatura'])
     
+    updated["conteudo_gerado"] = contrato["conteudo_gerado"]
     return Contrato(**updated)
 
+@api_router.get("/contratos/{id}/pdf")
+async def baixar_contrato_pdf(
+    id: str,
+    current_user: User = Depends(get_current_user)
+):
+    """Baixar contrato em PDF (com assinaturas, se houver)"""
+    contrato = await db.contratos.find_one({"id": id}, {"_id": 0})
+    if not contrato:
+        raise HTTPException(404, "Contrato não encontrado")
+    
+    await hidratar_conteudo_contratos([contrato])
+    if not contrato.get("conteudo_gerado"):
+        raise HTTPException(500, "Não foi possível gerar o conteúdo do contrato")
+    
+    chave, caminho = await gerar_pdf_contrato(contrato)
+    return FileResponse(
+        caminho,
+        media_type="application/pdf",
+        filename=f"{contrato['numero_contrato']}.pdf",
+        headers={"ETag": chave}
+    )
+
 @api_router.post("/contratos/{id}/enviar-email")
 async def enviar_contrato_email(
     id: str,
@@ -2559,6 +4261,13 @@ async def enviar_contrato_email(
     if not contrato:
         raise HTTPException(404, "Contrato não encontrado")
     
+    await hidratar_conteudo_contratos([contrato])
+    if not contrato.get("conteudo_gerado"):
+        raise HTTPException(500, "Não foi possível gerar o conteúdo do contrato")
+    
+    # PDF anexo (reaproveita o cache se já foi gerado)
+    pdf_hash, _ = await gerar_pdf_contrato(contrato)
+    
     # TODO: Implementar envio real de email com integração SMTP/SendGrid
     # Por enquanto apenas marca como enviado
     now = datetime.now(timezone.utc)
@@ -2566,11 +4275,12 @@ async def enviar_contrato_email(
         {"id": id},
         {"$set": {
             "email_enviado": True,
-            "data_email": now.isoformat()
+            "data_email": now.isoformat(),
+            "pdf_hash": pdf_hash
         }}
     )
     
-    return {"message": "Email enviado com sucesso", "data_envio": now.isoformat()}
+    return {"message": "Email enviado com sucesso", "data_envio": now.isoformat(), "pdf_hash": pdf_hash}
 
 @api_router.put("/contratos/{id}/status")
 async def atualizar_status_contrato(
@@ -2626,9 +4336,6 @@ async def root():
 async def health():
     return {"status": "ok"}
 
-# Include router
-app.include_router(api_router)
-
 # CORS
 app.add_middleware(
     CORSMiddleware,
@@ -2668,6 +4375,65 @@ async def create_admin_user():
     else:
         logger.info("Admin user already exists")
 
+@app.on_event("startup")
+async def criar_indices():
+    """Create indexes used by the hot paths (idempotent)"""
+    await db.contratos_templates_versoes.create_index([("template_id", 1), ("versao", 1)], unique=True)
+    await db.whatsapp_outbox.create_index([("status", 1), ("proxima_tentativa", 1)])
+    await db.whatsapp_outbox.create_index("campanha_id")
+    await db.alunos.create_index([("status", 1), ("plano_id", 1)])
+    await db.pagamentos.create_index([("status", 1), ("data_vencimento", 1), ("aluno_id", 1)])
+    await db.checkins.create_index([("data_hora", 1), ("aluno_id", 1)])
+    await db.checkins.create_index([("aluno_id", 1), ("data_hora", 1)])
+    await db.registros_treino.create_index("aluno_id")
+    await db.registros_treino.create_index([("aluno_id", 1), ("data_treino", 1)])
+    await db.registros_treino.create_index("data_treino")
+    await db.progressao_exercicio.create_index([("aluno_id", 1), ("exercicio_id", 1)], unique=True)
+    await db.recordes_pessoais.create_index([("aluno_id", 1), ("exercicio_id", 1)], unique=True)
+    for tipo in TIPOS_RECORDE:
+        await db.recordes_pessoais.create_index(
+            [("exercicio_id", 1), (f"{tipo}.valor", -1), (f"{tipo}.data_treino", 1)]
+        )
+    await db.alunos.create_index("indicado_por", sparse=True)
+    await db.pagamentos.create_index([("aluno_id", 1), ("data_pagamento", -1)])
+    await db.jobs_gamificacao.create_index("id", unique=True)
+    await db.eventos_gamificacao.create_index("id", unique=True)
+    await db.eventos_gamificacao.create_index([("status", 1), ("proxima_tentativa", 1), ("criado_em", 1)])
+    await db.eventos_gamificacao.create_index([("aluno_id", 1), ("status", 1), ("criado_em", 1)])
+    await db.eventos_gamificacao.create_index(
+        [("aluno_id", 1), ("chave_idempotencia", 1)],
+        unique=True,
+        partialFilterExpression={"chave_idempotencia": {"$exists": True}}
+    )
+    await db.eventos_gamificacao.create_index(
+        "expira_em", expireAfterSeconds=0, partialFilterExpression={"status": "processado"}
+    )
+    await db.gamificacao_travas.create_index("aluno_id", unique=True)
+    await db.pontos_ledger.create_index([("aluno_id", 1), ("dia", 1)], unique=True)
+    await db.pontos_ledger.create_index([("dia", 1), ("aluno_id", 1), ("pontos", 1)])
+    await db.estatisticas_gamificacao_diarias.create_index("dia", unique=True)
+    await db.notificacoes_gamificacao.create_index("expira_em", expireAfterSeconds=0)
+    await db.ranking_segmentos.create_index([("aluno_id", 1), ("segmento", 1)], unique=True)
+    await db.ranking_segmentos.create_index([("segmento", 1), ("pontos_totais", -1), ("aluno_id", 1)])
+    await db.ranking_segmentos.create_index([("segmento", 1), ("periodo_mes", 1), ("pontos_mes_atual", -1), ("aluno_id", 1)])
+    await db.ranking_segmentos.create_index([("segmento", 1), ("periodo_semana", 1), ("pontos_semana_atual", -1), ("aluno_id", 1)])
+    await db.segmentos_ranking.create_index("id", unique=True)
+    await db.segmentos_ranking.create_index("aluno_ids")
+    try:
+        await db.alunos_conquistas.create_index([("aluno_id", 1), ("conquista_id", 1)], unique=True)
+    except OperationFailure as e:
+        logger.warning(f"Índice único de alunos_conquistas não criado: {str(e)}")
+    try:
+        await db.contratos.create_index("numero_contrato", unique=True)
+    except OperationFailure as e:
+        # Bases antigas podem ter números duplicados gerados pela contagem
+        logger.warning(f"Índice único de numero_contrato não criado: {str(e)}")
+    try:
+        # Contadores fazem upsert por aluno_id; sem unicidade, upserts concorrentes duplicariam o perfil
+        await db.pontuacao_alunos.create_index("aluno_id", unique=True)
+    except OperationFailure as e:
+        logger.warning(f"Índice único de pontuacao_alunos.aluno_id não criado: {str(e)}")
+
 # ==================== GAMIFICAÇÃO - ENUMS ====================
 
 class TipoConquista(str, Enum):
@@ -2786,6 +4552,8 @@ class PontuacaoAluno(BaseModel):
     pontos_totais: int = 0
     pontos_mes_atual: int = 0
     pontos_semana_atual: int = 0
+    periodo_mes: Optional[str] = None  # "AAAA-MM" a que pontos_mes_atual se refere
+    periodo_semana: Optional[str] = None  # "AAAA-Wnn" a que pontos_semana_atual se refere
     
     nivel: int = 1
     xp_atual: int = 0
@@ -2816,20 +4584,22 @@ class PontuacaoAluno(BaseModel):
 
 class EventoGamificacao(BaseModel):
     """Evento disparado que pode desbloquear conquistas."""
-    tipo_evento: str  # "checkin", "treino_completo", "pagamento"
+    tipo_evento: str  # "checkin", "treino_completo", "pagamento", "recorde_pessoal"
     aluno_id: str
     dados_evento: dict = Field(default_factory=dict)
     timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    chave_idempotencia: Optional[str] = None  # gerada pelo dispositivo; repetida nas retentativas
 
 # ==================== GAMIFICAÇÃO - FUNÇÕES AUXILIARES ====================
 
-async def criar_perfil_gamificacao_inicial(aluno_id: str) -> dict:
-    """Cria perfil inicial de gamificação para novo aluno."""
-    perfil = {
-        "aluno_id": aluno_id,
+def perfil_gamificacao_padrao() -> dict:
+    """Campos iniciais do perfil de gamificação (sem aluno_id)."""
+    return {
         "pontos_totais": 0,
         "pontos_mes_atual": 0,
         "pontos_semana_atual": 0,
+        "periodo_mes": chave_mes(datetime.now(timezone.utc)),
+        "periodo_semana": chave_semana(datetime.now(timezone.utc)),
         "nivel": 1,
         "xp_atual": 0,
         "xp_proximo_nivel": 100,
@@ -2844,12 +4614,117 @@ async def criar_perfil_gamificacao_inicial(aluno_id: str) -> dict:
         "sequencia_dias_recorde": 0,
         "atualizado_em": datetime.now(timezone.utc).isoformat()
     }
-    await db.pontuacao_alunos.insert_one(perfil)
-    return perfil
 
-async def verificar_criterio_conquista(aluno_id: str, criterio: dict) -> bool:
+def com_perfil_padrao(update: dict) -> dict:
+    """
+    Acrescenta $setOnInsert com os campos iniciais do perfil a um upsert em pontuacao_alunos.
+    
+    Qualquer escrita pode ser a primeira do aluno (contador, pontos, backfill);
+    assim o documento nunca nasce incompleto. Campos já tocados pelo update ficam de fora.
+    """
+    tocados = {
+        campo.split(".")[0]
+        for operador, campos in update.items() if operador != "$setOnInsert"
+        for campo in campos
+    }
+    padrao = {k: v for k, v in perfil_gamificacao_padrao().items() if k not in tocados}
+    return {**update, "$setOnInsert": {**padrao, **update.get("$setOnInsert", {})}}
+
+async def upsert_perfil_gamificacao(aluno_id: str, update: dict):
+    """update_one com upsert em pontuacao_alunos, contabilizando perfis criados nas estatísticas."""
+    result = await db.pontuacao_alunos.update_one({"aluno_id": aluno_id}, com_perfil_padrao(update), upsert=True)
+    invalidar_progresso_aluno(aluno_id)
+    if result.upserted_id is not None:
+        await incrementar_estatisticas_gamificacao({"total_perfis": 1})
+    return result
+
+async def criar_perfil_gamificacao_inicial(aluno_id: str) -> dict:
+    """Cria perfil inicial de gamificação para novo aluno."""
+    await upsert_perfil_gamificacao(aluno_id, {})
+    return {"aluno_id": aluno_id, **perfil_gamificacao_padrao()}
+
+# Estatística do aluno consumida por cada tipo de critério
+ESTATISTICAS_POR_CRITERIO = {
+    "checkins_total": "checkins_total",
+    "checkins_consecutivos": "sequencia_dias_atual",
+    "checkins_mes": "checkins_mes",
+    "treinos_total": "treinos_total",
+    "treinos_mes": "treinos_mes",
+    "pagamentos_dia": "pagamentos_em_dia",
+    "meses_ativo": "meses_ativo",
+    "indicacoes": "indicacoes",
+}
+
+def estatisticas_necessarias(criterios: List[dict]) -> set:
+    necessarias = set()
+    for criterio in criterios:
+        if criterio.get("tipo") in COMBINADORES_CRITERIO:
+            necessarias |= estatisticas_necessarias(criterio.get("criterios", []))
+        elif criterio.get("tipo") in ESTATISTICAS_POR_CRITERIO:
+            necessarias.add(ESTATISTICAS_POR_CRITERIO[criterio["tipo"]])
+    return necessarias
+
+def contar_pagamentos_em_dia(pagamentos: List[dict]) -> int:
+    """Quantos pagamentos seguidos (do mais recente para trás) foram pagos até o vencimento."""
+    sequencia = 0
+    for pag in pagamentos:
+        data_pag = str(pag.get("data_pagamento") or "")[:10]
+        data_venc = str(pag.get("data_vencimento") or "")[:10]
+        if data_pag and data_venc and data_pag > data_venc:
+            break
+        sequencia += 1
+    return sequencia
+
+async def coletar_estatisticas_aluno(
+    aluno_id: str,
+    necessarias: set,
+    perfil: Optional[dict] = None,
+    aluno: Optional[dict] = None
+) -> dict:
     """
-    Verifica se um aluno atende ao critério de uma conquista.
+    Lê as estatísticas exigidas pelos critérios a partir dos contadores do perfil (O(1)).
+    
+    Perfis cujos contadores nunca foram reconstruídos a partir do histórico
+    são reconstruídos aqui, uma única vez.
+    """
+    consultas = {}
+    if perfil is None:
+        consultas["perfil"] = db.pontuacao_alunos.find_one({"aluno_id": aluno_id}, {"_id": 0})
+    if "meses_ativo" in necessarias and aluno is None:
+        consultas["aluno"] = db.alunos.find_one({"id": aluno_id}, {"_id": 0})
+    if consultas:
+        resultados = dict(zip(consultas.keys(), await asyncio.gather(*consultas.values())))
+        perfil = resultados.get("perfil", perfil) or {}
+        aluno = resultados.get("aluno", aluno)
+    
+    if perfil.get("contadores_reconstruidos_em"):
+        contadores = perfil.get("contadores", {})
+    else:
+        contadores = (await reconstruir_contadores([aluno_id])).get(aluno_id, contadores_vazios())
+    
+    return estatisticas_do_perfil(perfil, contadores, aluno, "meses_ativo" in necessarias)
+
+def estatisticas_do_perfil(perfil: dict, contadores: dict, aluno: Optional[dict], com_meses_ativo: bool) -> dict:
+    agora = datetime.now(timezone.utc)
+    stats = {
+        "checkins_total": contadores.get("checkins_total", 0),
+        "checkins_mes": contadores.get("checkins_mes", {}).get(chave_mes(agora), 0),
+        "treinos_total": contadores.get("treinos_total", 0),
+        "treinos_mes": contadores.get("treinos_mes", {}).get(chave_mes(agora), 0),
+        "pagamentos_em_dia": contadores.get("pagamentos_em_dia", 0),
+        "indicacoes": contadores.get("indicacoes", 0),
+        "sequencia_dias_atual": perfil.get("sequencia_dias_atual", 0),
+    }
+    if com_meses_ativo:
+        stats["meses_ativo"] = 0
+        cadastro = (aluno or {}).get("data_matricula") or (aluno or {}).get("criado_em")
+        if cadastro:
+            stats["meses_ativo"] = (agora - como_datetime_utc(cadastro)).days / 30
+    return stats
+
+def avaliar_criterio(criterio: dict, stats: dict) -> bool:
+    """
+    Avalia um critério em memória sobre as estatísticas já coletadas.
     
     Critérios suportados:
     - checkins_total: Total de check-ins realizados
@@ -2860,121 +4735,145 @@ async def verificar_criterio_conquista(aluno_id: str, criterio: dict) -> bool:
     - pagamentos_dia: Pagamentos em dia consecutivos
     - meses_ativo: Tempo de cadastro em meses
     - indicacoes: Número de amigos indicados
+    - easter_egg: Conquistas secretas, desbloqueadas manualmente
+    - agregacao / e / ou: critérios compilados (ver CRITÉRIOS COMPILADOS)
     """
     tipo = criterio.get("tipo")
-    quantidade = criterio.get("quantidade", 0)
-    
-    if tipo == "checkins_total":
-        count = await db.checkins.count_documents({"aluno_id": aluno_id})
-        return count >= quantidade
-    
-    elif tipo == "checkins_consecutivos":
-        perfil = await db.pontuacao_alunos.find_one({"aluno_id": aluno_id})
-        if perfil:
-            return perfil.get("sequencia_dias_atual", 0) >= quantidade
-        return False
-    
-    elif tipo == "checkins_mes":
-        inicio_mes = datetime.now(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        count = await db.checkins.count_documents({
-            "aluno_id": aluno_id,
-            "data_checkin": {"$gte": inicio_mes.isoformat()}
-        })
-        return count >= quantidade
-    
-    elif tipo == "treinos_total":
-        count = await db.registros_treino.count_documents({"aluno_id": aluno_id})
-        return count >= quantidade
-    
-    elif tipo == "treinos_mes":
-        inicio_mes = datetime.now(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        count = await db.registros_treino.count_documents({
-            "aluno_id": aluno_id,
-            "data_treino": {"$gte": inicio_mes.isoformat()}
-        })
-        return count >= quantidade
-    
-    elif tipo == "pagamentos_dia":
-        pagamentos = await db.pagamentos.find({
-            "aluno_id": aluno_id,
-            "status": "pago"
-        }).sort("data_pagamento", -1).limit(quantidade).to_list(quantidade)
-        
-        if len(pagamentos) < quantidade:
-            return False
-        
-        for pag in pagamentos:
-            data_pag = pag.get("data_pagamento")
-            data_venc = pag.get("data_vencimento")
-            if data_pag and data_venc:
-                if isinstance(data_pag, str):
-                    data_pag = datetime.fromisoformat(data_pag)
-                if isinstance(data_venc, str):
-                    data_venc = datetime.fromisoformat(data_venc)
-                if data_pag > data_venc:
-                    return False
-        return True
-    
-    elif tipo == "meses_ativo":
-        aluno = await db.alunos.find_one({"id": aluno_id})
-        if aluno:
-            cadastro = aluno.get("data_matricula") or aluno.get("criado_em")
-            if cadastro:
-                if isinstance(cadastro, str):
-                    cadastro = datetime.fromisoformat(cadastro)
-                meses = (datetime.now(timezone.utc) - cadastro).days / 30
-                return meses >= quantidade
+    if tipo == "e":
+        subcriterios = criterio.get("criterios", [])
+        return bool(subcriterios) and all(avaliar_criterio(c, stats) for c in subcriterios)
+    if tipo == "ou":
+        return any(avaliar_criterio(c, stats) for c in criterio.get("criterios", []))
+    if tipo == "agregacao":
+        valor = stats.get("agregacoes", {}).get(compilar_folha(criterio)["chave"], 0)
+        return valor >= criterio.get("minimo", 0)
+    
+    estatistica = ESTATISTICAS_POR_CRITERIO.get(tipo)
+    if estatistica is None:
         return False
-    
-    elif tipo == "indicacoes":
-        count = await db.alunos.count_documents({"indicado_por": aluno_id})
-        return count >= quantidade
-    
-    elif tipo == "easter_egg":
-        # Conquistas secretas são desbloqueadas manualmente
+    quantidade = criterio.get("quantidade", 0)
+    if criterio.get("tipo") == "pagamentos_dia" and quantidade <= 0:
         return False
-    
-    return False
+    return stats.get(estatistica, 0) >= quantidade
 
-async def desbloquear_conquista(aluno_id: str, aluno_nome: str, conquista: dict) -> dict:
-    """Desbloqueia uma conquista para o aluno e adiciona pontos."""
+async def verificar_criterio_conquista(aluno_id: str, criterio: dict) -> bool:
+    """Verifica se um aluno atende a um único critério (ver avaliar_criterio)."""
+    stats, agregacoes = await asyncio.gather(
+        coletar_estatisticas_aluno(aluno_id, estatisticas_necessarias([criterio])),
+        calcular_agregacoes([criterio], [aluno_id])
+    )
+    stats["agregacoes"] = agregacoes.get(aluno_id, {})
+    return avaliar_criterio(criterio, stats)
+
+async def avaliar_conquistas_aluno(aluno_id: str, aluno: dict, perfil: dict) -> List[dict]:
+    """Avalia todas as conquistas pendentes do aluno com uma única coleta de estatísticas."""
+    # conquistas_ids é gravado no mesmo update que credita os pontos do desbloqueio
+    desbloqueadas = set(perfil.get("conquistas_ids", []))
+    candidatas = [
+        c for c in await catalogo_conquistas.elegiveis(perfil.get("nivel", 1))
+        if c["id"] not in desbloqueadas
+    ]
+    if not candidatas:
+        return []
     
-    aluno_conquista = {
-        "id": str(uuid.uuid4()),
-        "aluno_id": aluno_id,
-        "aluno_nome": aluno_nome,
-        "conquista_id": conquista["id"],
-        "conquista_nome": conquista["nome"],
-        "conquista_icone": conquista.get("icone", "🏆"),
-        "pontos_ganhos": conquista["pontos"],
-        "xp_ganhos": conquista.get("xp_bonus", 0),
-        "data_desbloqueio": datetime.now(timezone.utc).isoformat(),
-        "notificado": False,
-        "visualizado": False
-    }
+    criterios = [c.get("criterio", {}) for c in candidatas]
+    stats, agregacoes = await asyncio.gather(
+        coletar_estatisticas_aluno(aluno_id, estatisticas_necessarias(criterios), perfil, aluno),
+        calcular_agregacoes(criterios, [aluno_id])
+    )
+    stats["agregacoes"] = agregacoes.get(aluno_id, {})
     
-    await db.alunos_conquistas.insert_one(aluno_conquista)
+    a_desbloquear = selecionar_conquistas(candidatas, desbloqueadas, stats)
+    return await desbloquear_conquistas(aluno_id, aluno.get("nome", "Aluno"), a_desbloquear)
+
+def selecionar_conquistas(candidatas: List[dict], desbloqueadas: set, stats: dict) -> List[dict]:
+    """
+    Conquistas atendidas pelas estatísticas, em ordem de desbloqueio.
     
-    # Adicionar pontos ao perfil
-    await adicionar_pontos_aluno(
-        aluno_id=aluno_id,
-        pontos=conquista["pontos"],
-        xp=conquista.get("xp_bonus", 0),
-        motivo=f"Conquista desbloqueada: {conquista['nome']}",
-        conquista_id=conquista["id"]
-    )
+    Repete a varredura enquanto houver desbloqueios, para liberar conquistas
+    cujo pré-requisito acabou de ser conquistado. `desbloqueadas` é atualizado.
+    """
+    a_desbloquear = []
+    houve_desbloqueio = True
+    while houve_desbloqueio:
+        houve_desbloqueio = False
+        for conquista in candidatas:
+            if conquista["id"] in desbloqueadas:
+                continue
+            if not all(p in desbloqueadas for p in conquista.get("conquistas_prerequisitos", [])):
+                continue
+            if avaliar_criterio(conquista.get("criterio", {}), stats):
+                a_desbloquear.append(conquista)
+                desbloqueadas.add(conquista["id"])
+                houve_desbloqueio = True
+    return a_desbloquear
+
+async def desbloquear_conquista(aluno_id: str, aluno_nome: str, conquista: dict) -> Optional[dict]:
+    """Desbloqueia uma conquista para o aluno e adiciona pontos."""
+    desbloqueadas = await desbloquear_conquistas(aluno_id, aluno_nome, [conquista])
+    return desbloqueadas[0] if desbloqueadas else None
+
+async def desbloquear_conquistas(aluno_id: str, aluno_nome: str, conquistas: List[dict]) -> List[dict]:
+    """
+    Desbloqueia várias conquistas de uma vez: um insert_many e um único update do perfil.
     
-    # Incrementar contador de conquistas
-    await db.pontuacao_alunos.update_one(
-        {"aluno_id": aluno_id},
+    Conquistas que outro processamento já gravou (índice único aluno/conquista)
+    são ignoradas e não rendem pontos. Por isso o insert vem antes e fica
+    separado do update do perfil: é o índice que decide quais desbloqueios
+    pontuam, e juntar as duas coleções numa escrita exigiria transação (replica
+    set), que o servidor não exige.
+    """
+    if not conquistas:
+        return []
+    agora = datetime.now(timezone.utc).isoformat()
+    registros = [
         {
-            "$inc": {"conquistas_total": 1, "conquistas_mes": 1},
-            "$push": {"conquistas_ids": conquista["id"]}
+            "id": str(uuid.uuid4()),
+            "aluno_id": aluno_id,
+            "aluno_nome": aluno_nome,
+            "conquista_id": conquista["id"],
+            "conquista_nome": conquista["nome"],
+            "conquista_icone": conquista.get("icone", "🏆"),
+            "pontos_ganhos": conquista["pontos"],
+            "xp_ganhos": conquista.get("xp_bonus", 0),
+            "data_desbloqueio": agora,
+            "notificado": False,
+            "visualizado": False
         }
+        for conquista in conquistas
+    ]
+    
+    try:
+        await db.alunos_conquistas.insert_many([r.copy() for r in registros], ordered=False)
+    except BulkWriteError as e:
+        erros = e.details.get("writeErrors", [])
+        if any(erro.get("code") != 11000 for erro in erros):
+            raise
+        duplicadas = {erro["index"] for erro in erros}
+        registros = [r for i, r in enumerate(registros) if i not in duplicadas]
+        conquistas = [c for i, c in enumerate(conquistas) if i not in duplicadas]
+        if not registros:
+            return []
+    
+    await aplicar_lancamentos_pontos(
+        aluno_id,
+        [
+            {
+                "data": agora,
+                "pontos": conquista["pontos"],
+                "xp": conquista.get("xp_bonus", 0) or conquista["pontos"],
+                "motivo": f"Conquista desbloqueada: {conquista['nome']}",
+                "conquista_id": conquista["id"]
+            }
+            for conquista in conquistas
+        ],
+        conquistas=conquistas,
+        notificacoes=[notificacao_conquista(registro) for registro in registros]
     )
     
-    logger.info(f"🏆 Conquista desbloqueada: {conquista['nome']} para aluno {aluno_id}")
-    return aluno_conquista
+    for conquista in conquistas:
+        logger.info(f"🏆 Conquista desbloqueada: {conquista['nome']} para aluno {aluno_id}")
+    return registros
 
 async def adicionar_pontos_aluno(
     aluno_id: str, 
@@ -2982,81 +4881,198 @@ async def adicionar_pontos_aluno(
     xp: int = 0,
     motivo: str = "", 
     conquista_id: Optional[str] = None,
-    contexto: Optional[dict] = None
+    contexto: Optional[dict] = None,
+    quando: Optional[datetime] = None
 ):
-    """Adiciona pontos e XP ao perfil do aluno."""
-    
-    xp_total = xp if xp > 0 else pontos
+    """
+    Adiciona pontos e XP ao perfil do aluno e lança no ledger diário.
     
-    update_doc = {
-        "$inc": {
-            "pontos_totais": pontos,
-            "pontos_mes_atual": pontos,
-            "pontos_semana_atual": pontos,
-            "xp_atual": xp_total
-        },
-        "$push": {
-            "historico_pontos": {
-                "$each": [{
-                    "data": datetime.now(timezone.utc).isoformat(),
-                    "pontos": pontos,
-                    "xp": xp_total,
-                    "motivo": motivo,
-                    "conquista_id": conquista_id
-                }],
-                "$slice": -30
-            }
-        },
-        "$set": {
-            "atualizado_em": datetime.now(timezone.utc).isoformat()
-        }
+    `quando` é o momento do fato que gerou os pontos (padrão: agora); define o
+    dia do ledger e se os pontos entram nas janelas de mês/semana correntes.
+    """
+    quando = quando or datetime.now(timezone.utc)
+    lancamento = {
+        "data": quando.isoformat(),
+        "pontos": pontos,
+        "xp": xp if xp > 0 else pontos,
+        "motivo": motivo,
+        "conquista_id": conquista_id
     }
-    
-    await db.pontuacao_alunos.update_one(
-        {"aluno_id": aluno_id},
-        update_doc,
-        upsert=True
-    )
-    
-    await verificar_nivel_aluno(aluno_id)
+    await aplicar_lancamentos_pontos(aluno_id, [lancamento], contexto, quando=quando)
 
-async def verificar_nivel_aluno(aluno_id: str):
-    """Verifica e atualiza o nível do aluno baseado no XP."""
-    perfil = await db.pontuacao_alunos.find_one({"aluno_id": aluno_id})
-    if not perfil:
-        return
+async def aplicar_lancamentos_pontos(
+    aluno_id: str,
+    lancamentos: List[dict],
+    contexto: Optional[dict] = None,
+    conquistas: Optional[List[dict]] = None,
+    notificacoes: Optional[List[dict]] = None,
+    quando: Optional[datetime] = None
+):
+    """
+    Aplica um ou mais lançamentos (e as conquistas que os geraram) num único update do perfil.
     
-    xp_atual = perfil.get("xp_atual", 0)
-    nivel_atual = perfil.get("nivel", 1)
+    Pontos, XP, histórico, contadores de conquista, nível e progresso do nível
+    vão num só find_one_and_update com pipeline (o nível é calculado no banco,
+    sobre o XP já somado); o ledger é gravado em paralelo. Depois, segmentos,
+    estatísticas e notificações (as recebidas mais a de subida de nível) saem
+    juntos, também em paralelo.
     
-    def xp_para_nivel(nivel):
-        return int(100 * (1.5 ** (nivel - 1)))
+    `quando` (padrão: agora) é a data do fato: o ledger é lançado nesse dia e
+    pontos de um mês/semana já encerrado não entram nas janelas correntes do perfil.
+    """
+    agora = datetime.now(timezone.utc)
+    quando = quando or agora
+    conquistas = conquistas or []
+    pontos = sum(l["pontos"] for l in lancamentos)
+    xp_total = sum(l["xp"] for l in lancamentos)
+    mes, semana = chave_mes(agora), chave_semana(agora)
+    incrementos = {
+        "pontos_totais": pontos,
+        "pontos_mes_atual": pontos if chave_mes(quando) == mes else 0,
+        "pontos_semana_atual": pontos if chave_semana(quando) == semana else 0,
+        "xp_atual": xp_total,
+        "conquistas_total": len(conquistas),
+        "conquistas_mes": len(conquistas),
+    }
+    pipeline = pipeline_lancamentos(incrementos, lancamentos, [c["id"] for c in conquistas], agora)
+    
+    _, anterior = await asyncio.gather(
+        registrar_lancamento_pontos(aluno_id, quando, lancamentos, contexto),
+        db.pontuacao_alunos.find_one_and_update(
+            {"aluno_id": aluno_id, "periodo_mes": mes, "periodo_semana": semana},
+            pipeline,
+            projection=PROJECAO_PONTOS,
+            return_document=ReturnDocument.BEFORE
+        )
+    )
+    if anterior is None:
+        # Perfil novo ou virada de mês/semana: zera as janelas vencidas e aplica
+        await criar_perfil_gamificacao_inicial(aluno_id)
+        await virar_janelas_pontos(aluno_id, mes, semana)
+        anterior = await db.pontuacao_alunos.find_one_and_update(
+            {"aluno_id": aluno_id},
+            pipeline,
+            projection=PROJECAO_PONTOS,
+            return_document=ReturnDocument.BEFORE
+        )
     
-    novo_nivel = nivel_atual
-    xp_proximo = xp_para_nivel(novo_nivel)
+    # O update é atômico: o estado anterior mais os incrementos é exatamente o perfil gravado
+    perfil = {
+        **anterior,
+        **{campo: anterior.get(campo, 0) + valor for campo, valor in incrementos.items() if campo in PROJECAO_PONTOS}
+    }
+    nivel_anterior = anterior.get("nivel", 1)
+    perfil["nivel"] = max(nivel_anterior, nivel_por_xp(perfil["xp_atual"]))
+    notificacoes = list(notificacoes or [])
+    if perfil["nivel"] > nivel_anterior:
+        notificacoes.append(montar_notificacao(aluno_id, "nivel", {
+            "nivel": perfil["nivel"],
+            "nivel_anterior": nivel_anterior,
+            "xp_atual": perfil["xp_atual"],
+            "xp_proximo_nivel": xp_para_nivel(perfil["nivel"])
+        }))
+        logger.info(f"⬆️ Aluno {aluno_id} subiu para nível {perfil['nivel']}!")
+    
+    ranking_alunos.aplicar_perfil(perfil)
+    invalidar_progresso_aluno(aluno_id)
+    await asyncio.gather(
+        atualizar_pontos_segmentos([perfil]),
+        registrar_pontos_estatisticas(pontos, perfil, conquistas),
+        publicar_notificacoes(notificacoes)
+    )
+
+def pipeline_lancamentos(incrementos: dict, lancamentos: List[dict], conquista_ids: List[str], agora: datetime) -> List[dict]:
+    """
+    Pipeline de update do perfil: soma os incrementos, anexa histórico e
+    conquistas e recalcula nível e progresso a partir do XP resultante.
+    O nível nunca desce (escritas concorrentes ou ajustes manuais são preservados).
+    """
+    def somar(campo, valor):
+        return {"$add": [{"$ifNull": [f"${campo}", 0]}, valor]}
     
-    while xp_atual >= xp_proximo and novo_nivel < 100:
-        novo_nivel += 1
-        xp_proximo = xp_para_nivel(novo_nivel)
+    def anexar(campo, itens):
+        # $literal: textos dos lançamentos começando com "$" não viram caminhos de campo
+        return {"$concatArrays": [{"$ifNull": [f"${campo}", []]}, {"$literal": itens}]}
     
-    if novo_nivel > nivel_atual:
-        progresso = (xp_atual / xp_proximo) * 100 if xp_proximo > 0 else 0
-        
-        await db.pontuacao_alunos.update_one(
-            {"aluno_id": aluno_id},
-            {
-                "$set": {
-                    "nivel": novo_nivel,
-                    "xp_proximo_nivel": xp_proximo,
-                    "progresso_nivel_percent": round(progresso, 2)
-                }
-            }
-        )
-        logger.info(f"⬆️ Aluno {aluno_id} subiu para nível {novo_nivel}!")
+    return [
+        {"$set": {
+            **{campo: somar(campo, valor) for campo, valor in incrementos.items() if valor},
+            "historico_pontos": {"$slice": [anexar("historico_pontos", lancamentos), -30]},
+            "conquistas_ids": anexar("conquistas_ids", conquista_ids),
+            "atualizado_em": {"$literal": agora.isoformat()},
+        }},
+        {"$set": {"nivel": {"$max": [{"$ifNull": ["$nivel", 1]}, expressao_nivel_por_xp("$xp_atual")]}}},
+        {"$set": {
+            "xp_proximo_nivel": expressao_xp_para_nivel("$nivel"),
+            # Percentual com duas casas: floor(x * 100 + 0.5) / 100
+            "progresso_nivel_percent": {"$divide": [{"$floor": {"$add": [
+                {"$multiply": [{"$divide": ["$xp_atual", expressao_xp_para_nivel("$nivel")]}, 10000]}, 0.5
+            ]}}, 100]},
+        }},
+    ]
 
-async def atualizar_sequencia_checkins(aluno_id: str):
-    """Atualiza a sequência de dias consecutivos de check-in."""
-    perfil = await db.pontuacao_alunos.find_one({"aluno_id": aluno_id})
+def xp_para_nivel(nivel: int) -> int:
+    return int(100 * (1.5 ** (nivel - 1)))
+
+def nivel_por_xp(xp: int) -> int:
+    """Menor nível cujo limiar de XP ainda não foi atingido (máximo 100)."""
+    if xp < xp_para_nivel(1):
+        return 1
+    nivel = int(math.log(xp / 100, 1.5)) + 2
+    # Ajusta erros de ponto flutuante e do int() do limiar na fronteira
+    while nivel > 1 and xp < xp_para_nivel(nivel - 1):
+        nivel -= 1
+    while xp >= xp_para_nivel(nivel):
+        nivel += 1
+    return min(nivel, 100)
+
+def expressao_xp_para_nivel(nivel) -> dict:
+    """xp_para_nivel como expressão de agregação."""
+    return {"$floor": {"$multiply": [100, {"$pow": [1.5, {"$subtract": [nivel, 1]}]}]}}
+
+def expressao_nivel_por_xp(xp) -> dict:
+    """
+    nivel_por_xp como expressão de agregação: a mesma estimativa pelo logaritmo,
+    com um passo de ajuste em cada sentido (o erro do log fica bem abaixo de um nível).
+    """
+    estimado = "$$estimado"
+    return {"$let": {
+        "vars": {"estimado": {"$cond": [
+            {"$lt": [xp, 100]},
+            1,
+            {"$add": [{"$floor": {"$divide": [{"$ln": {"$divide": [xp, 100]}}, math.log(1.5)]}}, 2]}
+        ]}},
+        "in": {"$min": [100, {"$switch": {
+            "branches": [
+                {
+                    "case": {"$and": [
+                        {"$gt": [estimado, 1]},
+                        {"$lt": [xp, expressao_xp_para_nivel({"$subtract": [estimado, 1]})]}
+                    ]},
+                    "then": {"$subtract": [estimado, 1]}
+                },
+                {"case": {"$gte": [xp, expressao_xp_para_nivel(estimado)]}, "then": {"$add": [estimado, 1]}},
+            ],
+            "default": estimado
+        }}]}
+    }}
+
+async def atualizar_sequencia_checkins(
+    aluno_id: str,
+    quando: Optional[datetime] = None,
+    evento_id: Optional[str] = None
+):
+    """
+    Atualiza a sequência de dias consecutivos de check-in.
+    
+    `quando` é o horário do check-in (padrão: agora). Com `evento_id`, o evento
+    fica gravado no perfil na mesma escrita e uma retentativa não conta de novo.
+    """
+    quando = como_datetime_utc(quando) if quando else datetime.now(timezone.utc)
+    filtro = {"aluno_id": aluno_id}
+    if evento_id:
+        filtro["ultimo_evento_sequencia"] = {"$ne": evento_id}
+    perfil = await db.pontuacao_alunos.find_one(filtro)
     if not perfil:
         return
     
@@ -3064,13 +5080,11 @@ async def atualizar_sequencia_checkins(aluno_id: str):
     sequencia_atual = perfil.get("sequencia_dias_atual", 0)
     sequencia_recorde = perfil.get("sequencia_dias_recorde", 0)
     
-    hoje = datetime.now(timezone.utc).date()
+    dia = dia_local(quando)
     
     if ultimo_checkin:
-        if isinstance(ultimo_checkin, str):
-            ultimo_checkin = datetime.fromisoformat(ultimo_checkin)
-        ultimo_dia = ultimo_checkin.date()
-        diff = (hoje - ultimo_dia).days
+        ultimo_dia = dia_local(ultimo_checkin)
+        diff = (dia - ultimo_dia).days
         
         if diff == 1:
             # Dia consecutivo!
@@ -3078,67 +5092,1978 @@ async def atualizar_sequencia_checkins(aluno_id: str):
         elif diff > 1:
             # Quebrou a sequência
             sequencia_atual = 1
-        # Se diff == 0, já fez check-in hoje, mantém
+        # Se diff == 0, já fez check-in nesse dia, mantém; diff < 0 é um
+        # check-in antigo processado com atraso e não mexe na sequência
     else:
         sequencia_atual = 1
     
     if sequencia_atual > sequencia_recorde:
         sequencia_recorde = sequencia_atual
     
+    campos = {
+        "sequencia_dias_atual": sequencia_atual,
+        "sequencia_dias_recorde": sequencia_recorde
+    }
+    if not ultimo_checkin or quando > como_datetime_utc(ultimo_checkin):
+        campos["ultimo_checkin"] = quando.isoformat()
+    if evento_id:
+        campos["ultimo_evento_sequencia"] = evento_id
+    
     await db.pontuacao_alunos.update_one(
-        {"aluno_id": aluno_id},
-        {
-            "$set": {
-                "ultimo_checkin": datetime.now(timezone.utc).isoformat(),
-                "sequencia_dias_atual": sequencia_atual,
-                "sequencia_dias_recorde": sequencia_recorde
-            },
-            "$inc": {"total_checkins": 1}
-        },
-        upsert=True
+        filtro,
+        {"$set": campos, "$inc": {"total_checkins": 1}},
+        upsert=not evento_id
     )
+    invalidar_progresso_aluno(aluno_id)
 
-# ==================== GAMIFICAÇÃO - ENDPOINTS ====================
+# ==================== GAMIFICAÇÃO - RECONSTRUÇÃO DE SEQUÊNCIAS ====================
 
-@api_router.get("/gamificacao/conquistas")
-async def listar_conquistas(
-    tipo: Optional[str] = None,
-    raridade: Optional[str] = None,
-    visiveis_apenas: bool = True,
-    current_user: User = Depends(get_current_user)
-):
-    """Lista todas as conquistas disponíveis no sistema."""
-    query = {"ativo": True}
+# Dias de check-in são contados no fuso da academia, não em UTC
+FUSO_GAMIFICACAO = os.environ.get('GAMIFICACAO_TIMEZONE', 'America/Sao_Paulo')
+SEQUENCIAS_LOTE_ESCRITA = 1000
+
+def inicio_dia_local_utc(dia: date) -> datetime:
+    """Meia-noite do dia no fuso da academia, em UTC."""
+    return datetime(dia.year, dia.month, dia.day, tzinfo=ZoneInfo(FUSO_GAMIFICACAO)).astimezone(timezone.utc)
+
+def dia_local(valor) -> date:
+    if isinstance(valor, date) and not isinstance(valor, datetime):
+        return valor
+    return como_datetime_utc(valor).astimezone(ZoneInfo(FUSO_GAMIFICACAO)).date()
+
+def calcular_sequencias(dias: List[date], hoje: date) -> tuple:
+    """
+    (sequência atual, recorde) a partir dos dias distintos de check-in em ordem crescente.
     
-    if tipo:
-        query["tipo"] = tipo
-    if raridade:
-        query["raridade"] = raridade
-    if visiveis_apenas:
-        query["visivel"] = True
+    A sequência atual só está viva se o último check-in foi hoje ou ontem.
+    """
+    recorde, corrente, anterior = 0, 0, None
+    for dia in dias:
+        corrente = corrente + 1 if anterior is not None and (dia - anterior).days == 1 else 1
+        recorde = max(recorde, corrente)
+        anterior = dia
+    atual = corrente if anterior is not None and (hoje - anterior).days <= 1 else 0
+    return atual, recorde
+
+async def reconstruir_sequencias_checkins(job_id: Optional[str] = None) -> dict:
+    """
+    Reconstrói sequência atual/recorde, último check-in e total de todos os alunos.
     
-    conquistas = await db.conquistas.find(query, {"_id": 0}).sort("ordem_exibicao", 1).to_list(1000)
-    return conquistas
+    O banco agrupa os check-ins por (aluno, dia local) e devolve os grupos
+    ordenados; aqui é uma única passada sobre esse cursor, com gravação em
+    bulk_write a cada lote de alunos.
+    """
+    pipeline = [
+        {"$group": {
+            "_id": {
+                "aluno_id": "$aluno_id",
+                "dia": {"$dateToString": {
+                    "format": "%Y-%m-%d",
+                    "date": {"$toDate": "$data_hora"},
+                    "timezone": FUSO_GAMIFICACAO
+                }}
+            },
+            "checkins": {"$sum": 1},
+            "ultimo": {"$max": "$data_hora"}
+        }},
+        {"$sort": {"_id.aluno_id": 1, "_id.dia": 1}}
+    ]
+    hoje = dia_local(datetime.now(timezone.utc))
+    marca = datetime.now(timezone.utc).isoformat()
+    operacoes, processados, perfis_criados = [], 0, 0
+    
+    async def gravar():
+        nonlocal operacoes, perfis_criados
+        if not operacoes:
+            return
+        resultado = await db.pontuacao_alunos.bulk_write(operacoes, ordered=False)
+        perfis_criados += resultado.upserted_count
+        operacoes = []
+        if job_id:
+            await db.jobs_gamificacao.update_one({"id": job_id}, {"$set": {"processados": processados}})
+    
+    def finalizar_aluno(aluno_id: str, dias: List[date], total: int, ultimo):
+        atual, recorde = calcular_sequencias(dias, hoje)
+        operacoes.append(UpdateOne(
+            {"aluno_id": aluno_id},
+            com_perfil_padrao({"$set": {
+                "sequencia_dias_atual": atual,
+                "sequencia_dias_recorde": recorde,
+                "ultimo_checkin": como_datetime_utc(ultimo).isoformat(),
+                "total_checkins": total,
+                "sequencias_reconstruidas_em": marca
+            }}),
+            upsert=True
+        ))
+    
+    aluno_atual, dias, total, ultimo = None, [], 0, None
+    async for grupo in db.checkins.aggregate(pipeline, allowDiskUse=True):
+        aluno_id = grupo["_id"]["aluno_id"]
+        if aluno_id != aluno_atual:
+            if aluno_atual is not None:
+                finalizar_aluno(aluno_atual, dias, total, ultimo)
+                processados += 1
+                if len(operacoes) >= SEQUENCIAS_LOTE_ESCRITA:
+                    await gravar()
+            aluno_atual, dias, total, ultimo = aluno_id, [], 0, None
+        dias.append(date.fromisoformat(grupo["_id"]["dia"]))
+        total += grupo["checkins"]
+        ultimo = max(ultimo, grupo["ultimo"]) if ultimo else grupo["ultimo"]
+    if aluno_atual is not None:
+        finalizar_aluno(aluno_atual, dias, total, ultimo)
+        processados += 1
+    await gravar()
+    
+    # Perfis sem nenhum check-in
+    await db.pontuacao_alunos.update_many(
+        {"sequencias_reconstruidas_em": {"$ne": marca}},
+        {"$set": {
+            "sequencia_dias_atual": 0,
+            "sequencia_dias_recorde": 0,
+            "ultimo_checkin": None,
+            "total_checkins": 0,
+            "sequencias_reconstruidas_em": marca
+        }}
+    )
+    if perfis_criados:
+        await incrementar_estatisticas_gamificacao({"total_perfis": perfis_criados})
+    invalidar_progresso_aluno()
+    return {"alunos_com_checkins": processados}
 
-@api_router.post("/gamificacao/conquistas")
-async def criar_conquista(
-    conquista: ConquistaCreate,
-    current_user: User = Depends(get_current_user)
-):
-    """Cria nova conquista (apenas admins)."""
-    if current_user.role != "admin":
-        raise HTTPException(403, "Apenas administradores podem criar conquistas")
+
+# ==================== GAMIFICAÇÃO - CATÁLOGO DE CONQUISTAS ====================
+
+# Conquistas ativas mantidas no processo; invalidado pelos endpoints de CRUD e
+# recarregado após o TTL para refletir alterações feitas por outros processos.
+CATALOGO_CONQUISTAS_TTL_SEGUNDOS = int(os.environ.get('CATALOGO_CONQUISTAS_TTL_SEGUNDOS', '300'))
+
+def ordenar_por_prerequisitos(conquistas: List[dict]) -> List[dict]:
+    """
+    Ordem topológica do grafo de pré-requisitos (desempate por nível mínimo).
     
-    conquista_dict = conquista.model_dump()
-    conquista_dict["id"] = str(uuid.uuid4())
-    conquista_dict["criado_em"] = datetime.now(timezone.utc).isoformat()
-    conquista_dict["criado_por"] = current_user.id
-    conquista_dict["atualizado_em"] = datetime.now(timezone.utc).isoformat()
-    conquista_dict["ativo"] = True
-    conquista_dict["ordem_exibicao"] = 0
+    Com os pré-requisitos antes dos dependentes, a varredura de
+    selecionar_conquistas resolve cadeias inteiras numa passada. Conquistas
+    que dependem de uma conquista inativa (que o aluno pode já ter) ou em
+    ciclo vão para o fim, na ordem de nível.
+    """
+    restantes = sorted(conquistas, key=lambda c: (c.get("nivel_minimo", 1), c.get("ordem_exibicao", 0)))
+    ordenadas, resolvidas = [], set()
+    progresso = True
+    while restantes and progresso:
+        progresso = False
+        pendentes = []
+        for conquista in restantes:
+            if all(p in resolvidas for p in conquista.get("conquistas_prerequisitos", [])):
+                ordenadas.append(conquista)
+                resolvidas.add(conquista["id"])
+                progresso = True
+            else:
+                pendentes.append(conquista)
+        restantes = pendentes
+    return ordenadas + restantes
+
+class CatalogoConquistas:
+    def __init__(self):
+        self._ordenadas: Optional[List[dict]] = None
+        self._carregado_em = 0.0
+        self._lock = asyncio.Lock()
+        self.versao = 0  # muda a cada invalidação/recarga; caches derivados comparam
+    
+    def invalidar(self):
+        self._ordenadas = None
+        self.versao += 1
+    
+    async def obter(self) -> List[dict]:
+        if self._ordenadas is None or time.monotonic() - self._carregado_em > CATALOGO_CONQUISTAS_TTL_SEGUNDOS:
+            async with self._lock:
+                if self._ordenadas is None or time.monotonic() - self._carregado_em > CATALOGO_CONQUISTAS_TTL_SEGUNDOS:
+                    conquistas = await db.conquistas.find({"ativo": True}, {"_id": 0}).to_list(1000)
+                    self._ordenadas = ordenar_por_prerequisitos(conquistas)
+                    self._carregado_em = time.monotonic()
+                    self.versao += 1
+        return self._ordenadas
+    
+    async def todas(self) -> List[dict]:
+        """Todas as conquistas ativas, em ordem topológica, sem filtro de nível."""
+        return await self.obter()
+    
+    async def elegiveis(self, nivel: int) -> List[dict]:
+        """Conquistas desbloqueáveis no nível informado, em ordem topológica."""
+        return [c for c in await self.obter() if c.get("nivel_minimo", 1) <= nivel]
+
+catalogo_conquistas = CatalogoConquistas()
+
+
+# ==================== GAMIFICAÇÃO - CRITÉRIOS COMPILADOS ====================
+
+# Além dos tipos fixos, um critério pode ser uma agregação declarativa:
+#   {"tipo": "agregacao", "colecao": "checkins", "operacao": "dias_distintos",
+#    "filtros": {"tipo": "entrada"}, "janela": "mes_atual", "minimo": 12}
+#   operacao: contar | somar (exige "campo") | dias_distintos
+#   janela: mes_atual | semana_atual, ou "janela_dias": N
+# e combinadores {"tipo": "e" | "ou", "criterios": [...]} (também com tipos fixos).
+# Cada folha é compilada uma vez num template de pipeline; o mesmo pipeline serve
+# para um aluno ou para um lote inteiro (aluno_id $in).
+# Dias e janelas seguem o fuso da academia, como os contadores e o ledger.
+COLECOES_CRITERIO = {
+    "checkins": "data_hora",
+    "registros_treino": "data_treino",
+    "pagamentos": "data_pagamento",
+    "avaliacoes_fisicas": "data_avaliacao",
+}
+# data_pagamento é uma data simples (AAAA-MM-DD), já no calendário local; os
+# demais campos são timestamps UTC e passam pelo fuso da academia
+COLECOES_CRITERIO_DATA_SIMPLES = {"pagamentos"}
+OPERACOES_CRITERIO = {"contar", "somar", "dias_distintos"}
+OPERADORES_FILTRO_CRITERIO = {"$eq", "$ne", "$gt", "$gte", "$lt", "$lte", "$in", "$nin", "$exists"}
+COMBINADORES_CRITERIO = {"e", "ou"}
+JANELAS_CRITERIO = {"mes_atual", "semana_atual"}
+CRITERIO_PROFUNDIDADE_MAXIMA = 4
+# Folhas de critérios avaliados avulsos (endpoint de teste) também passam por aqui
+CRITERIOS_COMPILADOS_MAX = 1000
+
+_criterios_compilados: OrderedDict = OrderedDict()
+
+def validar_criterio(criterio: dict, profundidade: int = 0):
+    """Rejeita critérios malformados ou com operadores fora da lista permitida."""
+    if not isinstance(criterio, dict):
+        raise HTTPException(400, "Critério deve ser um objeto")
+    tipo = criterio.get("tipo")
     
-    await db.conquistas.insert_one(conquista_dict)
-    return conquista_dict
+    if tipo in COMBINADORES_CRITERIO:
+        subcriterios = criterio.get("criterios")
+        if not isinstance(subcriterios, list) or not subcriterios:
+            raise HTTPException(400, f"Critério '{tipo}' exige a lista 'criterios'")
+        if profundidade >= CRITERIO_PROFUNDIDADE_MAXIMA:
+            raise HTTPException(400, "Critério aninhado demais")
+        for subcriterio in subcriterios:
+            validar_criterio(subcriterio, profundidade + 1)
+        return
+    
+    if tipo == "agregacao":
+        if criterio.get("colecao") not in COLECOES_CRITERIO:
+            raise HTTPException(400, f"Coleção inválida. Use: {', '.join(COLECOES_CRITERIO)}")
+        if criterio.get("operacao") not in OPERACOES_CRITERIO:
+            raise HTTPException(400, f"Operação inválida. Use: {', '.join(sorted(OPERACOES_CRITERIO))}")
+        if criterio["operacao"] == "somar":
+            campo = criterio.get("campo")
+            if not isinstance(campo, str) or not campo or campo.startswith("$"):
+                raise HTTPException(400, "Operação 'somar' exige 'campo'")
+        if not isinstance(criterio.get("minimo"), (int, float)):
+            raise HTTPException(400, "Critério de agregação exige 'minimo' numérico")
+        filtros = criterio.get("filtros", {})
+        if not isinstance(filtros, dict):
+            raise HTTPException(400, "'filtros' deve ser um objeto")
+        for campo, valor in filtros.items():
+            if campo.startswith("$") or campo == "aluno_id":
+                raise HTTPException(400, f"Filtro não permitido: {campo}")
+            if isinstance(valor, dict) and not set(valor) <= OPERADORES_FILTRO_CRITERIO:
+                raise HTTPException(400, f"Operador não permitido em '{campo}'")
+        if criterio.get("janela") is not None and criterio["janela"] not in JANELAS_CRITERIO:
+            raise HTTPException(400, f"Janela inválida. Use: {', '.join(sorted(JANELAS_CRITERIO))}")
+        janela_dias = criterio.get("janela_dias")
+        if janela_dias is not None and (not isinstance(janela_dias, int) or janela_dias <= 0):
+            raise HTTPException(400, "'janela_dias' deve ser um inteiro positivo")
+        return
+    
+    if tipo not in ESTATISTICAS_POR_CRITERIO and tipo != "easter_egg":
+        raise HTTPException(400, f"Tipo de critério inválido: {tipo}")
+
+def chave_folha(criterio: dict) -> str:
+    """
+    Identifica o que a folha agrega; o "minimo" fica de fora (é aplicado sobre o
+    valor já agregado), então folhas que só mudam o limiar rodam uma vez só.
+    """
+    campos = ("colecao", "operacao", "campo", "filtros", "janela", "janela_dias")
+    definicao = {campo: criterio.get(campo) for campo in campos}
+    return hashlib.sha1(json.dumps(definicao, sort_keys=True, default=str).encode()).hexdigest()
+
+def compilar_folha(criterio: dict) -> dict:
+    """Compila (uma vez, com cache LRU) uma folha 'agregacao' num template de pipeline."""
+    chave = chave_folha(criterio)
+    compilado = _cache_get(_criterios_compilados, chave)
+    if compilado is not None:
+        return compilado
+    
+    campo_data = COLECOES_CRITERIO[criterio["colecao"]]
+    data_simples = criterio["colecao"] in COLECOES_CRITERIO_DATA_SIMPLES
+    operacao = criterio["operacao"]
+    if operacao == "contar":
+        grupo = [{"$group": {"_id": "$aluno_id", "valor": {"$sum": 1}}}]
+    elif operacao == "somar":
+        grupo = [{"$group": {"_id": "$aluno_id", "valor": {"$sum": f"${criterio['campo']}"}}}]
+    else:
+        if data_simples:
+            dia = {"$substr": [f"${campo_data}", 0, 10]}
+        else:
+            dia = {"$dateToString": {
+                "format": "%Y-%m-%d", "date": {"$toDate": f"${campo_data}"}, "timezone": FUSO_GAMIFICACAO
+            }}
+        grupo = [
+            {"$group": {"_id": {"aluno_id": "$aluno_id", "dia": dia}}},
+            {"$group": {"_id": "$_id.aluno_id", "valor": {"$sum": 1}}}
+        ]
+    
+    compilado = {
+        "chave": chave,
+        "colecao": criterio["colecao"],
+        "campo_data": campo_data,
+        "data_simples": data_simples,
+        "filtros": dict(criterio.get("filtros", {})),
+        "janela": criterio.get("janela"),
+        "janela_dias": criterio.get("janela_dias"),
+        "grupo": grupo,
+    }
+    _cache_set(_criterios_compilados, chave, compilado, CRITERIOS_COMPILADOS_MAX)
+    return compilado
+
+def pipeline_criterio(compilado: dict, aluno_ids: Optional[List[str]]) -> List[dict]:
+    """Instancia o template: filtro de alunos e início da janela (datas mudam, o resto não)."""
+    condicoes = [compilado["filtros"]] if compilado["filtros"] else []
+    if aluno_ids is not None:
+        condicoes.append({"aluno_id": {"$in": aluno_ids}})
+    
+    hoje = dia_local(datetime.now(timezone.utc))
+    inicio = None
+    if compilado["janela"] == "mes_atual":
+        inicio = hoje.replace(day=1)
+    elif compilado["janela"] == "semana_atual":
+        inicio = hoje - timedelta(days=hoje.weekday())
+    elif compilado["janela_dias"]:
+        inicio = hoje - timedelta(days=compilado["janela_dias"])
+    if inicio:
+        # Timestamps UTC: a meia-noite local do início convertida para UTC (ISO compara como texto)
+        limite = inicio.isoformat() if compilado["data_simples"] else inicio_dia_local_utc(inicio).isoformat()
+        condicoes.append({compilado["campo_data"]: {"$gte": limite}})
+    
+    match = {"$and": condicoes} if len(condicoes) > 1 else (condicoes[0] if condicoes else {})
+    return [{"$match": match}, *compilado["grupo"]]
+
+def folhas_agregacao(criterios: List[dict]) -> List[dict]:
+    folhas = []
+    for criterio in criterios:
+        if criterio.get("tipo") in COMBINADORES_CRITERIO:
+            folhas.extend(folhas_agregacao(criterio.get("criterios", [])))
+        elif criterio.get("tipo") == "agregacao":
+            folhas.append(criterio)
+    return folhas
+
+async def calcular_agregacoes(criterios: List[dict], aluno_ids: Optional[List[str]]) -> dict:
+    """
+    Executa as folhas de agregação dos critérios para os alunos informados (None = todos).
+    
+    Folhas iguais em conquistas diferentes rodam uma vez só. Retorna
+    {aluno_id: {chave_folha: valor}}.
+    """
+    compilados = {}
+    for folha in folhas_agregacao(criterios):
+        compilado = compilar_folha(folha)
+        compilados[compilado["chave"]] = compilado
+    if not compilados:
+        return {}
+    
+    async def executar(compilado):
+        return await db[compilado["colecao"]].aggregate(
+            pipeline_criterio(compilado, aluno_ids), allowDiskUse=True
+        ).to_list(None)
+    
+    resultados = await asyncio.gather(*(executar(c) for c in compilados.values()))
+    valores = defaultdict(dict)
+    for chave, grupos in zip(compilados.keys(), resultados):
+        for grupo in grupos:
+            valores[grupo["_id"]][chave] = grupo["valor"]
+    return dict(valores)
+
+
+# ==================== GAMIFICAÇÃO - PROGRESSO DE CONQUISTAS ====================
+
+# Progresso (valor atual x alvo) de cada conquista visível, calculado numa única
+# coleta de estatísticas e guardado por aluno até o próximo evento dele. O TTL
+# limita a defasagem quando o evento foi processado por outro processo.
+PROGRESSO_CACHE_MAX = 5000
+PROGRESSO_CACHE_TTL_SEGUNDOS = int(os.environ.get('PROGRESSO_CACHE_TTL_SEGUNDOS', '300'))
+_cache_progresso: OrderedDict = OrderedDict()
+
+def invalidar_progresso_aluno(aluno_id: Optional[str] = None):
+    """Descarta o progresso em cache do aluno (None = de todos)."""
+    if aluno_id is None:
+        _cache_progresso.clear()
+    else:
+        _cache_progresso.pop(aluno_id, None)
+
+def progresso_criterio(criterio: dict, stats: dict) -> dict:
+    """Valor atual, alvo e percentual de um critério (mesma semântica de avaliar_criterio)."""
+    tipo = criterio.get("tipo")
+    if tipo in COMBINADORES_CRITERIO:
+        partes = [progresso_criterio(c, stats) for c in criterio.get("criterios", [])]
+        percentuais = [p["percentual"] for p in partes] or [0]
+        # "e" avança com a média das partes; "ou" com a parte mais adiantada
+        percentual = sum(percentuais) / len(percentuais) if tipo == "e" else max(percentuais)
+        return {"tipo": tipo, "percentual": round(percentual, 1), "criterios": partes}
+    
+    if tipo == "agregacao":
+        atual = stats.get("agregacoes", {}).get(compilar_folha(criterio)["chave"], 0)
+        alvo = criterio.get("minimo", 0)
+    elif tipo in ESTATISTICAS_POR_CRITERIO:
+        atual = stats.get(ESTATISTICAS_POR_CRITERIO[tipo], 0)
+        alvo = criterio.get("quantidade", 0)
+        if tipo == "meses_ativo":
+            atual = round(atual, 1)
+    else:
+        # easter_egg: sem progresso mensurável
+        return {"tipo": tipo, "atual": None, "alvo": None, "percentual": 0}
+    
+    if avaliar_criterio(criterio, stats):
+        percentual = 100
+    elif alvo > 0:
+        percentual = round(min(atual / alvo, 1) * 100, 1)
+    else:
+        percentual = 0
+    return {"tipo": tipo, "atual": atual, "alvo": alvo, "percentual": percentual}
+
+async def calcular_progresso_aluno(aluno_id: str) -> dict:
+    aluno, perfil, conquistas = await asyncio.gather(
+        db.alunos.find_one({"id": aluno_id}, {"_id": 0, "id": 1, "data_matricula": 1, "criado_em": 1}),
+        db.pontuacao_alunos.find_one({"aluno_id": aluno_id}, {"_id": 0}),
+        catalogo_conquistas.obter()
+    )
+    if not aluno:
+        raise HTTPException(404, "Aluno não encontrado")
+    perfil = perfil or {"aluno_id": aluno_id, **perfil_gamificacao_padrao()}
+    desbloqueadas = set(perfil.get("conquistas_ids", []))
+    nivel = perfil.get("nivel", 1)
+    
+    exibidas = [c for c in conquistas if c.get("visivel", True) or c["id"] in desbloqueadas]
+    bloqueadas = [c.get("criterio", {}) for c in exibidas if c["id"] not in desbloqueadas]
+    stats, agregacoes = await asyncio.gather(
+        coletar_estatisticas_aluno(aluno_id, estatisticas_necessarias(bloqueadas), perfil, aluno),
+        calcular_agregacoes(bloqueadas, [aluno_id])
+    )
+    stats["agregacoes"] = agregacoes.get(aluno_id, {})
+    
+    itens = []
+    for conquista in sorted(exibidas, key=lambda c: c.get("ordem_exibicao", 0)):
+        item = {
+            "conquista_id": conquista["id"],
+            "nome": conquista["nome"],
+            "descricao": conquista.get("descricao"),
+            "icone": conquista.get("icone", "🏆"),
+            "raridade": conquista.get("raridade"),
+            "pontos": conquista.get("pontos", 0),
+            "desbloqueada": conquista["id"] in desbloqueadas,
+        }
+        if item["desbloqueada"]:
+            item["percentual"] = 100
+        else:
+            item.update(progresso_criterio(conquista.get("criterio", {}), stats))
+            item["nivel_minimo"] = conquista.get("nivel_minimo", 1)
+            item["bloqueada_por_nivel"] = nivel < item["nivel_minimo"]
+            item["prerequisitos_pendentes"] = [
+                p for p in conquista.get("conquistas_prerequisitos", []) if p not in desbloqueadas
+            ]
+        itens.append(item)
+    
+    return {
+        "aluno_id": aluno_id,
+        "nivel": nivel,
+        "total_conquistas": len(itens),
+        "desbloqueadas": sum(1 for item in itens if item["desbloqueada"]),
+        "conquistas": itens,
+        "calculado_em": datetime.now(timezone.utc).isoformat()
+    }
+
+async def obter_progresso_aluno(aluno_id: str) -> dict:
+    # Mesmo esquema das recomendações: o dicionário do aluno entra no cache antes do
+    # cálculo; se um evento o invalidar no meio do caminho, o resultado (já defasado)
+    # é gravado num dicionário descartado
+    cache_aluno = _cache_get(_cache_progresso, aluno_id)
+    if cache_aluno is None:
+        cache_aluno = {}
+        _cache_set(_cache_progresso, aluno_id, cache_aluno, PROGRESSO_CACHE_MAX)
+    entrada = cache_aluno.get("progresso")
+    if entrada is not None:
+        calculado_em, versao_catalogo, progresso = entrada
+        if (
+            versao_catalogo == catalogo_conquistas.versao
+            and time.monotonic() - calculado_em <= PROGRESSO_CACHE_TTL_SEGUNDOS
+        ):
+            return progresso
+    
+    await catalogo_conquistas.obter()
+    versao_catalogo = catalogo_conquistas.versao
+    progresso = await calcular_progresso_aluno(aluno_id)
+    cache_aluno["progresso"] = (time.monotonic(), versao_catalogo, progresso)
+    return progresso
+
+
+# ==================== GAMIFICAÇÃO - LEDGER DE PONTOS ====================
+
+# pontos_ledger: um documento por (aluno, dia) com o total do dia e os lançamentos.
+# Rankings de qualquer janela são agregações sobre o índice (dia, aluno_id, pontos);
+# pontos_mes_atual/pontos_semana_atual do perfil são apenas cache da janela corrente,
+# zerados preguiçosamente quando periodo_mes/periodo_semana ficam para trás.
+
+async def registrar_lancamento_pontos(
+    aluno_id: str,
+    quando: datetime,
+    lancamentos: List[dict],
+    contexto: Optional[dict] = None
+):
+    await db.pontos_ledger.update_one(
+        {"aluno_id": aluno_id, "dia": dia_local(quando).isoformat()},
+        {
+            "$inc": {
+                "pontos": sum(l["pontos"] for l in lancamentos),
+                "xp": sum(l["xp"] for l in lancamentos),
+                "lancamentos_total": len(lancamentos)
+            },
+            "$push": {"lancamentos": {"$each": [{**l, "contexto": contexto or {}} for l in lancamentos]}}
+        },
+        upsert=True
+    )
+
+def operacoes_virada_janelas(aluno_id: str, mes: str, semana: str) -> List[UpdateOne]:
+    """
+    Zera os contadores de janela do perfil que pertencerem a um mês/semana anterior.
+    
+    O filtro é "período anterior" (as chaves ordenam como texto), e não
+    "período diferente": uma escrita concorrente que já virou para um período
+    mais novo nunca é desfeita.
+    """
+    return [
+        UpdateOne(
+            {"aluno_id": aluno_id, "periodo_mes": {"$not": {"$gte": mes}}},
+            {"$set": {"periodo_mes": mes, "pontos_mes_atual": 0, "conquistas_mes": 0}}
+        ),
+        UpdateOne(
+            {"aluno_id": aluno_id, "periodo_semana": {"$not": {"$gte": semana}}},
+            {"$set": {"periodo_semana": semana, "pontos_semana_atual": 0}}
+        )
+    ]
+
+async def virar_janelas_pontos(aluno_id: str, mes: str, semana: str):
+    await db.pontuacao_alunos.bulk_write(operacoes_virada_janelas(aluno_id, mes, semana), ordered=False)
+
+def normalizar_janelas_perfil(perfil: dict, agora: Optional[datetime] = None) -> dict:
+    """Na leitura, janelas de um período já encerrado valem zero (a escrita só vira no próximo lançamento)."""
+    agora = agora or datetime.now(timezone.utc)
+    if perfil.get("periodo_mes") != chave_mes(agora):
+        perfil["pontos_mes_atual"] = 0
+        perfil["conquistas_mes"] = 0
+    if perfil.get("periodo_semana") != chave_semana(agora):
+        perfil["pontos_semana_atual"] = 0
+    return perfil
+
+def intervalo_janela(janela: str, agora: Optional[datetime] = None) -> tuple:
+    """Converte uma janela nomeada em (dia_inicio, dia_fim) inclusivos."""
+    hoje = dia_local(agora or datetime.now(timezone.utc))
+    inicio_semana = hoje - timedelta(days=hoje.weekday())
+    inicio_mes = hoje.replace(day=1)
+    if janela == "semana_atual":
+        inicio, fim = inicio_semana, hoje
+    elif janela == "semana_passada":
+        inicio, fim = inicio_semana - timedelta(days=7), inicio_semana - timedelta(days=1)
+    elif janela == "mes_atual":
+        inicio, fim = inicio_mes, hoje
+    elif janela == "mes_passado":
+        fim = inicio_mes - timedelta(days=1)
+        inicio = fim.replace(day=1)
+    else:
+        raise HTTPException(400, "Janela inválida. Use semana_atual, semana_passada, mes_atual, mes_passado ou inicio/fim")
+    return inicio.isoformat(), fim.isoformat()
+
+async def ranking_por_intervalo(dia_inicio: str, dia_fim: str, limite: int) -> List[dict]:
+    pipeline = [
+        {"$match": {"dia": {"$gte": dia_inicio, "$lte": dia_fim}}},
+        {"$group": {"_id": "$aluno_id", "pontos": {"$sum": "$pontos"}}},
+        {"$match": {"pontos": {"$gt": 0}}},
+        {"$sort": {"pontos": -1, "_id": 1}},
+        {"$limit": limite}
+    ]
+    return await db.pontos_ledger.aggregate(pipeline, allowDiskUse=True).to_list(limite)
+
+
+# ==================== GAMIFICAÇÃO - RANKING EM MEMÓRIA ====================
+
+# Ranking mantido no processo: uma lista ordenada por período, atualizada a cada
+# mudança de pontos. Consultas de posição são bisect (O(log n)); a lista é
+# recarregada do banco periodicamente para absorver escritas de outros processos.
+RANKING_RECARGA_SEGUNDOS = int(os.environ.get('RANKING_RECARGA_SEGUNDOS', '300'))
+
+CAMPOS_RANKING = {
+    "geral": "pontos_totais",
+    "mensal": "pontos_mes_atual",
+    "semanal": "pontos_semana_atual",
+}
+
+PROJECAO_RANKING = {
+    "_id": 0,
+    "aluno_id": 1,
+    "pontos_totais": 1,
+    "pontos_mes_atual": 1,
+    "pontos_semana_atual": 1,
+    "periodo_mes": 1,
+    "periodo_semana": 1,
+    "nivel": 1,
+    "conquistas_total": 1,
+}
+
+# Campos devolvidos pelo update de pontos (ranking + cálculo de nível)
+PROJECAO_PONTOS = {**PROJECAO_RANKING, "xp_atual": 1}
+
+class RankingOrdenado:
+    """Lista ordenada de (-pontos, aluno_id); só entram alunos com pontos > 0."""
+    
+    def __init__(self):
+        self._pontos: dict = {}
+        self._ordem: List[tuple] = []
+    
+    def __len__(self):
+        return len(self._ordem)
+    
+    def atualizar(self, aluno_id: str, pontos: int):
+        anterior = self._pontos.get(aluno_id)
+        if anterior == pontos:
+            return
+        if anterior is not None:
+            del self._ordem[bisect.bisect_left(self._ordem, (-anterior, aluno_id))]
+            del self._pontos[aluno_id]
+        if pontos > 0:
+            bisect.insort(self._ordem, (-pontos, aluno_id))
+            self._pontos[aluno_id] = pontos
+    
+    def remover(self, aluno_id: str):
+        self.atualizar(aluno_id, 0)
+    
+    def pontos(self, aluno_id: str) -> int:
+        return self._pontos.get(aluno_id, 0)
+    
+    def posicao(self, aluno_id: str) -> Optional[int]:
+        """Posição 1-based; empates dividem a mesma posição."""
+        pontos = self._pontos.get(aluno_id)
+        if pontos is None:
+            return None
+        return bisect.bisect_left(self._ordem, (-pontos,)) + 1
+    
+    def indice(self, aluno_id: str) -> int:
+        """Índice exato na lista (desempata pelo aluno_id)."""
+        return bisect.bisect_left(self._ordem, (-self._pontos[aluno_id], aluno_id))
+    
+    def pagina(self, inicio: int, limite: int) -> List[tuple]:
+        return [(aluno_id, -negativo) for negativo, aluno_id in self._ordem[inicio:inicio + limite]]
+
+class RankingAlunos:
+    def __init__(self):
+        self.periodos = {periodo: RankingOrdenado() for periodo in CAMPOS_RANKING}
+        self.info: dict = {}  # aluno_id -> {"nivel", "conquistas_total"}
+        self.carregado_em: Optional[float] = None
+        self.janelas: Optional[tuple] = None  # (mês, semana) vigentes na carga
+        self._lock = asyncio.Lock()
+        self._durante_carga: Optional[List[tuple]] = None
+    
+    async def garantir_carregado(self):
+        agora = datetime.now(timezone.utc)
+        if self.carregado_em is not None and self.janelas != (chave_mes(agora), chave_semana(agora)):
+            # Virada de mês/semana: as janelas em memória venceram todas de uma vez
+            self.carregado_em = None
+        if self.carregado_em is None:
+            await self.carregar()
+        elif time.monotonic() - self.carregado_em > RANKING_RECARGA_SEGUNDOS and not self._lock.locked():
+            # Continua servindo a versão atual enquanto recarrega
+            iniciar_tarefa_background(self.carregar())
+    
+    async def carregar(self):
+        async with self._lock:
+            if self.carregado_em is not None and time.monotonic() - self.carregado_em <= RANKING_RECARGA_SEGUNDOS:
+                return
+            self._durante_carga = []
+            agora = datetime.now(timezone.utc)
+            try:
+                periodos = {periodo: RankingOrdenado() for periodo in CAMPOS_RANKING}
+                info = {}
+                async for perfil in db.pontuacao_alunos.find({}, PROJECAO_RANKING):
+                    self._aplicar(perfil, periodos, info)
+                # Atualizações recebidas durante a leitura podem ser mais novas que o cursor
+                for operacao in self._durante_carga:
+                    operacao(periodos, info)
+                self.periodos, self.info = periodos, info
+                self.carregado_em = time.monotonic()
+                self.janelas = (chave_mes(agora), chave_semana(agora))
+            finally:
+                self._durante_carga = None
+        logger.info(f"Ranking carregado: {len(self.periodos['geral'])} alunos")
+    
+    @staticmethod
+    def _aplicar(perfil: dict, periodos: dict, info: dict):
+        perfil = normalizar_janelas_perfil(dict(perfil))
+        aluno_id = perfil["aluno_id"]
+        for periodo, campo in CAMPOS_RANKING.items():
+            periodos[periodo].atualizar(aluno_id, perfil.get(campo, 0) or 0)
+        info[aluno_id] = {
+            "nivel": perfil.get("nivel", 1),
+            "conquistas_total": perfil.get("conquistas_total", 0),
+        }
+    
+    def _registrar(self, operacao):
+        """Aplica agora e, se houver recarga em andamento, também na versão sendo montada."""
+        operacao(self.periodos, self.info)
+        if self._durante_carga is not None:
+            self._durante_carga.append(operacao)
+    
+    def aplicar_perfil(self, perfil: Optional[dict]):
+        """Reflete no ranking o perfil retornado após uma atualização de pontos."""
+        if perfil:
+            self._registrar(lambda periodos, info: self._aplicar(perfil, periodos, info))
+    
+    def atualizar_info(self, aluno_id: str, **campos):
+        self._registrar(
+            lambda periodos, info: info.setdefault(aluno_id, {"nivel": 1, "conquistas_total": 0}).update(campos)
+        )
+    
+    def remover(self, aluno_id: str):
+        def operacao(periodos, info):
+            for ranking in periodos.values():
+                ranking.remover(aluno_id)
+            info.pop(aluno_id, None)
+        self._registrar(operacao)
+
+class CacheNomesAlunos:
+    """Nome e foto dos alunos para montar o ranking sem uma consulta por linha."""
+    
+    def __init__(self):
+        self._dados: dict = {}
+    
+    def invalidar(self, aluno_id: str):
+        self._dados.pop(aluno_id, None)
+    
+    async def obter(self, aluno_ids: List[str]) -> dict:
+        faltando = [aluno_id for aluno_id in aluno_ids if aluno_id not in self._dados]
+        if faltando:
+            async for aluno in db.alunos.find(
+                {"id": {"$in": faltando}}, {"_id": 0, "id": 1, "nome": 1, "foto_url": 1}
+            ):
+                self._dados[aluno["id"]] = {"nome": aluno.get("nome"), "foto_url": aluno.get("foto_url")}
+        return {aluno_id: self._dados[aluno_id] for aluno_id in aluno_ids if aluno_id in self._dados}
+
+ranking_alunos = RankingAlunos()
+cache_nomes_alunos = CacheNomesAlunos()
+
+async def montar_linhas_ranking(periodo: str, itens: List[tuple]) -> List[dict]:
+    ranking = ranking_alunos.periodos[periodo]
+    nomes = await cache_nomes_alunos.obter([aluno_id for aluno_id, _ in itens])
+    linhas = []
+    for aluno_id, pontos in itens:
+        aluno = nomes.get(aluno_id)
+        if not aluno:
+            continue
+        info = ranking_alunos.info.get(aluno_id, {})
+        linhas.append({
+            "posicao": ranking.posicao(aluno_id),
+            "aluno_id": aluno_id,
+            "aluno_nome": aluno["nome"],
+            "aluno_foto": aluno["foto_url"],
+            "pontos": pontos,
+            "nivel": info.get("nivel", 1),
+            "conquistas_total": info.get("conquistas_total", 0)
+        })
+    return linhas
+
+
+# ==================== GAMIFICAÇÃO - RANKING POR SEGMENTO ====================
+
+# Cada aluno tem uma linha em ranking_segmentos por segmento a que pertence
+# (plano, modalidades do plano, professor das fichas ativas, segmentos salvos),
+# com cópia dos pontos do perfil. Os índices (segmento, janela, pontos, aluno_id)
+# tornam o top-N de um segmento uma consulta coberta pelo índice.
+TIPOS_SEGMENTO = ("plano", "modalidade", "professor", "segmento")
+SEGMENTOS_LOTE_ALUNOS = 1000
+
+# Campo de janela que precisa ser a vigente para os pontos do período valerem
+JANELA_PERIODO_RANKING = {
+    "geral": None,
+    "mensal": "periodo_mes",
+    "semanal": "periodo_semana",
+}
+
+class SegmentoRankingCreate(BaseModel):
+    nome: str = Field(..., min_length=3, max_length=100)
+    descricao: Optional[str] = None
+    aluno_ids: List[str] = []
+
+def chave_segmento(tipo: str, valor: str) -> str:
+    return f"{tipo}:{valor}"
+
+def pontos_segmento(perfil: Optional[dict]) -> dict:
+    perfil = perfil or {}
+    pontos = {campo: perfil.get(campo, 0) or 0 for campo in CAMPOS_RANKING.values()}
+    pontos["periodo_mes"] = perfil.get("periodo_mes")
+    pontos["periodo_semana"] = perfil.get("periodo_semana")
+    return pontos
+
+async def segmentos_dos_alunos(aluno_ids: List[str]) -> dict:
+    """aluno_id -> chaves dos segmentos a que o aluno pertence hoje."""
+    planos = {
+        plano["id"]: plano.get("modalidades", [])
+        async for plano in db.planos.find({}, {"_id": 0, "id": 1, "modalidades": 1})
+    }
+    membros = {}
+    async for aluno in db.alunos.find({"id": {"$in": aluno_ids}}, {"_id": 0, "id": 1, "plano_id": 1}):
+        chaves = set()
+        plano_id = aluno.get("plano_id")
+        if plano_id in planos:
+            chaves.add(chave_segmento("plano", plano_id))
+            chaves.update(chave_segmento("modalidade", modalidade) for modalidade in planos[plano_id])
+        membros[aluno["id"]] = chaves
+    
+    async for ficha in db.fichas_treino.find(
+        {"aluno_id": {"$in": aluno_ids}, "ativo": True}, {"_id": 0, "aluno_id": 1, "professor_id": 1}
+    ):
+        if ficha["aluno_id"] in membros:
+            membros[ficha["aluno_id"]].add(chave_segmento("professor", ficha["professor_id"]))
+    
+    async for segmento in db.segmentos_ranking.find({"aluno_ids": {"$in": aluno_ids}}, {"_id": 0, "id": 1, "aluno_ids": 1}):
+        for aluno_id in segmento["aluno_ids"]:
+            if aluno_id in membros:
+                membros[aluno_id].add(chave_segmento("segmento", segmento["id"]))
+    return membros
+
+async def sincronizar_segmentos_alunos(aluno_ids: List[str]) -> int:
+    """Recalcula a participação dos alunos nos segmentos e copia os pontos atuais."""
+    aluno_ids = list(dict.fromkeys(aluno_ids))
+    if not aluno_ids:
+        return 0
+    membros = await segmentos_dos_alunos(aluno_ids)
+    perfis = {
+        perfil["aluno_id"]: perfil
+        async for perfil in db.pontuacao_alunos.find({"aluno_id": {"$in": aluno_ids}}, PROJECAO_RANKING)
+    }
+    agora = datetime.now(timezone.utc).isoformat()
+    operacoes = []
+    for aluno_id in aluno_ids:
+        chaves = sorted(membros.get(aluno_id, ()))
+        operacoes.append(DeleteMany({"aluno_id": aluno_id, "segmento": {"$nin": chaves}}))
+        pontos = {**pontos_segmento(perfis.get(aluno_id)), "sincronizado_em": agora}
+        operacoes.extend(
+            UpdateOne({"aluno_id": aluno_id, "segmento": chave}, {"$set": pontos}, upsert=True)
+            for chave in chaves
+        )
+    for inicio in range(0, len(operacoes), SEGMENTOS_LOTE_ALUNOS):
+        await db.ranking_segmentos.bulk_write(operacoes[inicio:inicio + SEGMENTOS_LOTE_ALUNOS], ordered=False)
+    return len(aluno_ids)
+
+async def sincronizar_segmentos_por_filtro(filtro_alunos: dict, job_id: Optional[str] = None) -> int:
+    """Sincroniza, em lotes, todos os alunos que atendem ao filtro."""
+    processados, lote = 0, []
+    async for aluno in db.alunos.find(filtro_alunos, {"_id": 0, "id": 1}):
+        lote.append(aluno["id"])
+        if len(lote) < SEGMENTOS_LOTE_ALUNOS:
+            continue
+        processados += await sincronizar_segmentos_alunos(lote)
+        lote = []
+        if job_id:
+            await db.jobs_gamificacao.update_one({"id": job_id}, {"$set": {"processados": processados}})
+    processados += await sincronizar_segmentos_alunos(lote)
+    return processados
+
+async def atualizar_pontos_segmentos(perfis: List[dict]):
+    """Copia os pontos dos perfis para todas as linhas de segmento de cada aluno."""
+    operacoes = [
+        UpdateMany({"aluno_id": perfil["aluno_id"]}, {"$set": pontos_segmento(perfil)})
+        for perfil in perfis if perfil
+    ]
+    if operacoes:
+        await db.ranking_segmentos.bulk_write(operacoes, ordered=False)
+
+async def job_reconstruir_segmentos(job_id: str) -> dict:
+    inicio = datetime.now(timezone.utc).isoformat()
+    await db.jobs_gamificacao.update_one({"id": job_id}, {"$set": {"total": await db.alunos.count_documents({})}})
+    processados = await sincronizar_segmentos_por_filtro({}, job_id)
+    # Linhas não tocadas pela passada são de alunos que não existem mais
+    removidas = await db.ranking_segmentos.delete_many({"sincronizado_em": {"$lt": inicio}})
+    await db.jobs_gamificacao.update_one({"id": job_id}, {"$set": {"processados": processados}})
+    return {"alunos": processados, "linhas_removidas": removidas.deleted_count}
+
+def filtro_ranking_segmento(segmento: str, periodo: str, agora: Optional[datetime] = None) -> dict:
+    agora = agora or datetime.now(timezone.utc)
+    filtro = {"segmento": segmento}
+    janela = JANELA_PERIODO_RANKING[periodo]
+    if janela == "periodo_mes":
+        filtro["periodo_mes"] = chave_mes(agora)
+    elif janela == "periodo_semana":
+        filtro["periodo_semana"] = chave_semana(agora)
+    return filtro
+
+def ler_cursor_ranking(cursor: str) -> tuple:
+    """"pontos:ordinal:aluno_id" -> (pontos, ordinal, aluno_id) do último item da página anterior."""
+    try:
+        pontos, ordinal, aluno_id = cursor.split(":", 2)
+        return int(pontos), int(ordinal), aluno_id
+    except ValueError:
+        raise HTTPException(400, "Cursor inválido")
+
+async def ranking_segmento(segmento: str, periodo: str, limite: int, cursor: Optional[str] = None) -> tuple:
+    """
+    (linhas [(aluno_id, pontos, posição)], total, próximo cursor) lidos só do índice.
+    
+    Páginas por faixa de (pontos, aluno_id) a partir do cursor, sem skip. O total
+    só é contado na primeira página; nas seguintes, uma contagem de pontuações
+    maiores dá a posição do primeiro item (como em posicao_no_segmento) e o
+    ordinal levado no cursor dá a dos demais.
+    """
+    campo = CAMPOS_RANKING[periodo]
+    filtro = {**filtro_ranking_segmento(segmento, periodo), campo: {"$gt": 0}}
+    ordinal, total = 0, None
+    if cursor:
+        pontos_cursor, ordinal, aluno_cursor = ler_cursor_ranking(cursor)
+        filtro["$or"] = [
+            {campo: {"$lt": pontos_cursor}},
+            {campo: pontos_cursor, "aluno_id": {"$gt": aluno_cursor}}
+        ]
+    else:
+        total = await db.ranking_segmentos.count_documents(filtro)
+    itens = await db.ranking_segmentos.find(
+        filtro, {"_id": 0, "aluno_id": 1, campo: 1}
+    ).sort([(campo, -1), ("aluno_id", 1)]).limit(limite).to_list(limite)
+    if not itens:
+        return [], total, None
+    
+    posicao = 1
+    if cursor:
+        filtro_acima = {k: v for k, v in filtro.items() if k != "$or"}
+        filtro_acima[campo] = {"$gt": itens[0][campo]}
+        posicao = await db.ranking_segmentos.count_documents(filtro_acima) + 1
+    linhas = []
+    for idx, item in enumerate(itens):
+        if idx and item[campo] != itens[idx - 1][campo]:
+            posicao = ordinal + idx + 1
+        linhas.append((item["aluno_id"], item[campo], posicao))
+    
+    proximo = None
+    if len(itens) == limite:
+        ultimo = itens[-1]
+        proximo = f"{ultimo[campo]}:{ordinal + len(itens)}:{ultimo['aluno_id']}"
+    return linhas, total, proximo
+
+async def posicao_no_segmento(segmento: str, periodo: str, aluno_id: str) -> tuple:
+    """(posição, pontos) do aluno no segmento; posição None se não participa."""
+    campo = CAMPOS_RANKING[periodo]
+    filtro = filtro_ranking_segmento(segmento, periodo)
+    linha = await db.ranking_segmentos.find_one({**filtro, "aluno_id": aluno_id}, {"_id": 0, campo: 1})
+    pontos = (linha or {}).get(campo, 0)
+    if pontos <= 0:
+        return None, 0
+    return await db.ranking_segmentos.count_documents({**filtro, campo: {"$gt": pontos}}) + 1, pontos
+
+
+# ==================== GAMIFICAÇÃO - CONTADORES ====================
+
+# Contadores por aluno mantidos em pontuacao_alunos.contadores:
+#   checkins_total, treinos_total, indicacoes, pagamentos_em_dia (sequência atual)
+#   checkins_mes/treinos_mes     -> {"AAAA-MM": n} (mês e semana no fuso da academia)
+#   checkins_semana/treinos_semana -> {"AAAA-Wnn": n} (semana ISO)
+CONTADORES_LOTE_ESCRITA = 1000
+
+def como_datetime_utc(valor) -> datetime:
+    if isinstance(valor, str):
+        valor = datetime.fromisoformat(valor.replace("Z", "+00:00"))
+    if valor.tzinfo is None:
+        valor = valor.replace(tzinfo=timezone.utc)
+    return valor
+
+def chave_mes(dt) -> str:
+    return dia_local(dt).strftime("%Y-%m")
+
+def chave_semana(dt) -> str:
+    ano, semana, _ = dia_local(dt).isocalendar()
+    return f"{ano}-W{semana:02d}"
+
+def contadores_vazios() -> dict:
+    return {
+        "checkins_total": 0,
+        "checkins_mes": {},
+        "checkins_semana": {},
+        "treinos_total": 0,
+        "treinos_mes": {},
+        "treinos_semana": {},
+        "indicacoes": 0,
+        "pagamentos_em_dia": 0,
+    }
+
+async def incrementar_contador(aluno_id: str, nome: str, delta: int = 1):
+    await upsert_perfil_gamificacao(aluno_id, {"$inc": {f"contadores.{nome}": delta}})
+
+async def incrementar_contador_atividade(aluno_id: str, atividade: str, quando, delta: int = 1):
+    """Atualiza atomicamente total, mês e semana de uma atividade ('checkins' ou 'treinos')."""
+    dt = como_datetime_utc(quando)
+    await upsert_perfil_gamificacao(aluno_id, {"$inc": {
+        f"contadores.{atividade}_total": delta,
+        f"contadores.{atividade}_mes.{chave_mes(dt)}": delta,
+        f"contadores.{atividade}_semana.{chave_semana(dt)}": delta,
+    }})
+
+async def registrar_pagamento_contador(pagamento: dict):
+    """
+    Pagamento quitado: estende a sequência de pagamentos em dia ou a zera se atrasado.
+    
+    Conta uma vez por pagamento: a flag `contabilizado` é marcada antes, de forma
+    atômica, e só volta a False quando o pagamento deixa de estar pago.
+    """
+    marcado = await db.pagamentos.find_one_and_update(
+        {"id": pagamento["id"], "status": "pago", "contabilizado": {"$ne": True}},
+        {"$set": {"contabilizado": True}},
+        projection={"_id": 0, "id": 1}
+    )
+    if marcado is None:
+        return
+    data_pag = str(pagamento.get("data_pagamento") or datetime.now(timezone.utc).strftime("%Y-%m-%d"))[:10]
+    data_venc = str(pagamento.get("data_vencimento") or "")[:10]
+    if data_venc and data_pag > data_venc:
+        update = {"$set": {"contadores.pagamentos_em_dia": 0}}
+    else:
+        update = {"$inc": {"contadores.pagamentos_em_dia": 1}}
+    await upsert_perfil_gamificacao(pagamento["aluno_id"], update)
+
+async def desfazer_pagamento_contador(pagamento: dict):
+    """
+    Pagamento que deixou de estar pago sai da sequência.
+    
+    Um pagamento atrasado zerou a sequência e um simples decremento não a
+    restaura, então a sequência do aluno é recontada a partir dos pagamentos
+    que continuam pagos (também cobre pagamentos contados pela reconstrução,
+    que não têm a flag).
+    """
+    await db.pagamentos.update_one(
+        {"id": pagamento["id"], "status": {"$ne": "pago"}},
+        {"$set": {"contabilizado": False}}
+    )
+    pagos = await db.pagamentos.find(
+        {"aluno_id": pagamento["aluno_id"], "status": "pago"},
+        {"_id": 0, "data_pagamento": 1, "data_vencimento": 1}
+    ).sort("data_pagamento", -1).to_list(None)
+    await upsert_perfil_gamificacao(
+        pagamento["aluno_id"], {"$set": {"contadores.pagamentos_em_dia": contar_pagamentos_em_dia(pagos)}}
+    )
+
+async def reconstruir_contadores(aluno_ids: Optional[List[str]] = None) -> dict:
+    """
+    Recalcula os contadores a partir do histórico e grava com bulk_write.
+    
+    Check-ins e treinos são agregados por (aluno, hora UTC) no banco; meses e
+    semanas são consolidados em memória a partir do dia local de cada grupo. Sem `aluno_ids`,
+    reconstrói todos os perfis. Retorna {aluno_id: contadores}.
+    """
+    filtro = {"aluno_id": {"$in": aluno_ids}} if aluno_ids is not None else {}
+    contadores = defaultdict(contadores_vazios)
+    for aluno_id in aluno_ids or []:
+        contadores[aluno_id]
+    
+    for atividade, colecao, campo in (
+        ("checkins", db.checkins, "data_hora"),
+        ("treinos", db.registros_treino, "data_treino"),
+    ):
+        pipeline = [
+            {"$match": filtro},
+            {"$group": {
+                # Por hora UTC: o dia local só é conhecido depois de aplicar o fuso
+                "_id": {"aluno_id": "$aluno_id", "hora": {"$substr": [f"${campo}", 0, 13]}},
+                "total": {"$sum": 1}
+            }}
+        ]
+        async for grupo in colecao.aggregate(pipeline, allowDiskUse=True):
+            c = contadores[grupo["_id"]["aluno_id"]]
+            dia = dia_local(grupo["_id"]["hora"])
+            total = grupo["total"]
+            c[f"{atividade}_total"] += total
+            mes, semana = chave_mes(dia), chave_semana(dia)
+            c[f"{atividade}_mes"][mes] = c[f"{atividade}_mes"].get(mes, 0) + total
+            c[f"{atividade}_semana"][semana] = c[f"{atividade}_semana"].get(semana, 0) + total
+    
+    filtro_indicacoes = {"indicado_por": {"$in": aluno_ids} if aluno_ids is not None else {"$ne": None}}
+    async for grupo in db.alunos.aggregate([
+        {"$match": filtro_indicacoes},
+        {"$group": {"_id": "$indicado_por", "total": {"$sum": 1}}}
+    ]):
+        contadores[grupo["_id"]]["indicacoes"] = grupo["total"]
+    
+    # Sequência de pagamentos em dia: um passe ordenado por aluno, do mais recente para trás
+    aluno_atual, pagamentos_aluno = None, []
+    cursor = db.pagamentos.find(
+        {**filtro, "status": "pago"},
+        {"_id": 0, "aluno_id": 1, "data_pagamento": 1, "data_vencimento": 1}
+    ).sort([("aluno_id", 1), ("data_pagamento", -1)])
+    async for pag in cursor:
+        if pag["aluno_id"] != aluno_atual:
+            if aluno_atual is not None:
+                contadores[aluno_atual]["pagamentos_em_dia"] = contar_pagamentos_em_dia(pagamentos_aluno)
+            aluno_atual, pagamentos_aluno = pag["aluno_id"], []
+        pagamentos_aluno.append(pag)
+    if aluno_atual is not None:
+        contadores[aluno_atual]["pagamentos_em_dia"] = contar_pagamentos_em_dia(pagamentos_aluno)
+    
+    marca = datetime.now(timezone.utc).isoformat()
+    operacoes = [
+        UpdateOne(
+            {"aluno_id": aluno_id},
+            com_perfil_padrao({"$set": {"contadores": c, "contadores_reconstruidos_em": marca}}),
+            upsert=True
+        )
+        for aluno_id, c in contadores.items()
+    ]
+    for i in range(0, len(operacoes), CONTADORES_LOTE_ESCRITA):
+        resultado = await db.pontuacao_alunos.bulk_write(operacoes[i:i + CONTADORES_LOTE_ESCRITA], ordered=False)
+        if resultado.upserted_count:
+            await incrementar_estatisticas_gamificacao({"total_perfis": resultado.upserted_count})
+    
+    if aluno_ids is None:
+        # Perfis sem nenhum histórico
+        await db.pontuacao_alunos.update_many(
+            {"contadores_reconstruidos_em": {"$ne": marca}},
+            {"$set": {"contadores": contadores_vazios(), "contadores_reconstruidos_em": marca}}
+        )
+    
+    return dict(contadores)
+
+async def executar_job_gamificacao(job_id: str, coro):
+    """Executa um job de manutenção registrando status em jobs_gamificacao."""
+    try:
+        resultado = await coro
+        await db.jobs_gamificacao.update_one(
+            {"id": job_id},
+            {"$set": {
+                "status": "concluido",
+                "resultado": resultado,
+                "finalizado_em": datetime.now(timezone.utc).isoformat()
+            }}
+        )
+    except Exception as e:
+        logger.error(f"Job de gamificação {job_id} falhou: {str(e)}")
+        await db.jobs_gamificacao.update_one(
+            {"id": job_id},
+            {"$set": {"status": "erro", "erro": str(e), "finalizado_em": datetime.now(timezone.utc).isoformat()}}
+        )
+
+async def iniciar_job_gamificacao(tipo: str, coro_factory, parametros: Optional[dict] = None) -> dict:
+    """Cria o registro do job e agenda `coro_factory(job_id)` em segundo plano."""
+    job = {
+        "id": str(uuid.uuid4()),
+        "tipo": tipo,
+        "status": "processando",
+        "parametros": parametros or {},
+        "processados": 0,
+        "total": None,
+        "criado_em": datetime.now(timezone.utc).isoformat()
+    }
+    await db.jobs_gamificacao.insert_one(job.copy())
+    iniciar_tarefa_background(executar_job_gamificacao(job["id"], coro_factory(job["id"])))
+    return job
+
+async def job_reconstruir_contadores(job_id: str) -> dict:
+    contadores = await reconstruir_contadores()
+    invalidar_progresso_aluno()
+    return {"perfis_atualizados": len(contadores)}
+
+
+# ==================== GAMIFICAÇÃO - ESTATÍSTICAS ====================
+
+# Documento único em estatisticas_gamificacao mantido por $inc nos desbloqueios e
+# lançamentos de pontos; uma reconciliação periódica recalcula tudo pelas coleções
+# e grava o retrato do dia em estatisticas_gamificacao_diarias.
+ESTATISTICAS_RECONCILIACAO_SEGUNDOS = int(os.environ.get('ESTATISTICAS_RECONCILIACAO_SEGUNDOS', '3600'))
+ESTATISTICAS_ID = "global"
+
+_estatisticas_tarefa: Optional[asyncio.Task] = None
+
+async def incrementar_estatisticas_gamificacao(incrementos: dict, conquistas: Optional[List[dict]] = None):
+    inc = {campo: valor for campo, valor in incrementos.items() if valor}
+    definir = {}
+    if conquistas:
+        inc["total_desbloqueadas"] = len(conquistas)
+        for conquista in conquistas:
+            campo = f"desbloqueios_por_conquista.{conquista['id']}"
+            inc[f"{campo}.count"] = inc.get(f"{campo}.count", 0) + 1
+            definir[f"{campo}.nome"] = conquista["nome"]
+    if not inc:
+        return
+    update = {"$inc": inc}
+    if definir:
+        update["$set"] = definir
+    await db.estatisticas_gamificacao.update_one({"_id": ESTATISTICAS_ID}, update, upsert=True)
+
+async def registrar_pontos_estatisticas(pontos: int, perfil: Optional[dict], conquistas: Optional[List[dict]] = None):
+    """Soma de pontos, participantes (perfis que acabaram de sair do zero) e desbloqueios, num único $inc."""
+    total = (perfil or {}).get("pontos_totais", 0)
+    await incrementar_estatisticas_gamificacao({
+        "soma_pontos": pontos,
+        "alunos_participando": 1 if pontos and total > 0 >= total - pontos else 0,
+    }, conquistas)
+
+async def reconciliar_estatisticas_gamificacao() -> dict:
+    """Recalcula as estatísticas a partir das coleções e grava o retrato do dia."""
+    por_conquista, totais = await asyncio.gather(
+        db.alunos_conquistas.aggregate([
+            {"$group": {"_id": "$conquista_id", "count": {"$sum": 1}, "nome": {"$first": "$conquista_nome"}}}
+        ]).to_list(None),
+        db.pontuacao_alunos.aggregate([
+            {"$group": {
+                "_id": None,
+                "total_perfis": {"$sum": 1},
+                "soma_pontos": {"$sum": "$pontos_totais"},
+                "alunos_participando": {"$sum": {"$cond": [{"$gt": ["$pontos_totais", 0]}, 1, 0]}}
+            }}
+        ]).to_list(1)
+    )
+    totais = totais[0] if totais else {}
+    agora = datetime.now(timezone.utc).isoformat()
+    estatisticas = {
+        "total_desbloqueadas": sum(g["count"] for g in por_conquista),
+        "desbloqueios_por_conquista": {g["_id"]: {"count": g["count"], "nome": g["nome"]} for g in por_conquista},
+        "total_perfis": totais.get("total_perfis", 0),
+        "soma_pontos": totais.get("soma_pontos", 0),
+        "alunos_participando": totais.get("alunos_participando", 0),
+        "reconciliado_em": agora,
+    }
+    await db.estatisticas_gamificacao.update_one({"_id": ESTATISTICAS_ID}, {"$set": estatisticas}, upsert=True)
+    # Mesmo dia local do ledger e dos contadores
+    dia = dia_local(agora).isoformat()
+    await db.estatisticas_gamificacao_diarias.update_one(
+        {"dia": dia},
+        {"$set": {**montar_estatisticas_gamificacao(estatisticas, None), "dia": dia, "gravado_em": agora}},
+        upsert=True
+    )
+    return estatisticas
+
+def montar_estatisticas_gamificacao(doc: dict, total_conquistas: Optional[int]) -> dict:
+    por_conquista = doc.get("desbloqueios_por_conquista", {})
+    top_conquistas = sorted(
+        ({"_id": conquista_id, "count": d.get("count", 0), "nome": d.get("nome")} for conquista_id, d in por_conquista.items()),
+        key=lambda c: c["count"],
+        reverse=True
+    )[:5]
+    total_perfis = doc.get("total_perfis", 0)
+    resultado = {
+        "total_desbloqueadas": doc.get("total_desbloqueadas", 0),
+        "top_conquistas": top_conquistas,
+        "media_pontos_por_aluno": round(doc.get("soma_pontos", 0) / total_perfis, 2) if total_perfis else 0,
+        "alunos_participando": doc.get("alunos_participando", 0)
+    }
+    if total_conquistas is not None:
+        resultado = {"total_conquistas": total_conquistas, **resultado}
+    return resultado
+
+async def loop_reconciliacao_estatisticas():
+    while True:
+        try:
+            await reconciliar_estatisticas_gamificacao()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Reconciliação de estatísticas falhou: {str(e)}")
+        await asyncio.sleep(ESTATISTICAS_RECONCILIACAO_SEGUNDOS)
+
+
+# ==================== GAMIFICAÇÃO - FILA DE EVENTOS ====================
+
+# Eventos são gravados em eventos_gamificacao e processados por workers em segundo
+# plano. A ordem por aluno é garantida por uma trava (lease) em gamificacao_travas:
+# só um worker processa os eventos de um aluno por vez, em lote e em ordem de chegada.
+GAMIFICACAO_WORKERS = int(os.environ.get('GAMIFICACAO_WORKERS', '4'))
+GAMIFICACAO_LOTE_EVENTOS = 50
+GAMIFICACAO_MAX_TENTATIVAS = 5
+GAMIFICACAO_BACKOFF_SEGUNDOS = 10
+GAMIFICACAO_POLL_SEGUNDOS = 5
+GAMIFICACAO_TRAVA_SEGUNDOS = 120  # trava/evento "processando" mais antigo que isso é retomado
+# Eventos processados expiram (TTL) após a retenção; até lá a chave de idempotência deduplica retentativas
+GAMIFICACAO_EVENTOS_RETENCAO_DIAS = int(os.environ.get('GAMIFICACAO_EVENTOS_RETENCAO_DIAS', '7'))
+GAMIFICACAO_EVENTOS_POR_REQUISICAO = 500
+GAMIFICACAO_TOLERANCIA_RELOGIO_SEGUNDOS = 300  # relógio do dispositivo adiantado
+
+PONTOS_POR_EVENTO = {
+    "checkin": 5,
+    "treino_completo": 10,
+    "pagamento": 15,
+    "avaliacao": 20,
+    "recorde_pessoal": 10
+}
+
+_gamificacao_sinal = asyncio.Event()
+_gamificacao_workers: List[asyncio.Task] = []
+
+def montar_documento_evento(evento: EventoGamificacao, criado_em: datetime) -> dict:
+    doc = {
+        "id": str(uuid.uuid4()),
+        "aluno_id": evento.aluno_id,
+        "tipo_evento": evento.tipo_evento,
+        "dados_evento": evento.dados_evento,
+        "timestamp": evento.timestamp.isoformat(),
+        "status": "pendente",  # pendente, processando, processado, falhou
+        "tentativas": 0,
+        "pontos_aplicados": False,
+        "proxima_tentativa": criado_em.isoformat(),
+        "criado_em": criado_em.isoformat(),
+        "expira_em": criado_em + timedelta(days=GAMIFICACAO_EVENTOS_RETENCAO_DIAS)
+    }
+    if evento.chave_idempotencia:
+        doc["chave_idempotencia"] = evento.chave_idempotencia
+    return doc
+
+def erro_timestamp_evento(evento: EventoGamificacao, agora: Optional[datetime] = None) -> Optional[str]:
+    """
+    Motivo para recusar um evento no futuro ou mais antigo que a retenção da fila (None se válido).
+    
+    Sequência, ledger e janelas usam o timestamp do evento; um evento além da
+    retenção também já não seria deduplicado pela chave de idempotência.
+    """
+    agora = agora or datetime.now(timezone.utc)
+    quando = como_datetime_utc(evento.timestamp)
+    if quando > agora + timedelta(seconds=GAMIFICACAO_TOLERANCIA_RELOGIO_SEGUNDOS):
+        return "timestamp no futuro"
+    if quando < agora - timedelta(days=GAMIFICACAO_EVENTOS_RETENCAO_DIAS):
+        return f"timestamp anterior a {GAMIFICACAO_EVENTOS_RETENCAO_DIAS} dias"
+    return None
+
+async def enfileirar_eventos_gamificacao(eventos: List[EventoGamificacao]) -> List[dict]:
+    """
+    Grava um lote de eventos na fila com um único insert_many.
+    
+    Eventos cuja chave_idempotencia já existe para o aluno (índice único) não são
+    regravados: no retorno aparecem como o evento original com duplicado=True.
+    """
+    agora = datetime.now(timezone.utc)
+    # Offsets de microssegundo mantêm a ordem do lote em criado_em (ordem de processamento)
+    docs = [montar_documento_evento(evento, agora + timedelta(microseconds=i)) for i, evento in enumerate(eventos)]
+    if not docs:
+        return []
+    
+    # Aluno com evento aguardando retentativa: os novos esperam por ele (mantém a ordem)
+    bloqueios = {
+        grupo["_id"]: grupo["proxima"]
+        async for grupo in db.eventos_gamificacao.aggregate([
+            {"$match": {
+                "aluno_id": {"$in": list({doc["aluno_id"] for doc in docs})},
+                "status": "pendente",
+                "proxima_tentativa": {"$gt": agora.isoformat()}
+            }},
+            {"$group": {"_id": "$aluno_id", "proxima": {"$max": "$proxima_tentativa"}}}
+        ])
+    }
+    for doc in docs:
+        if doc["aluno_id"] in bloqueios:
+            doc["proxima_tentativa"] = max(doc["proxima_tentativa"], bloqueios[doc["aluno_id"]])
+    
+    duplicados = set()
+    try:
+        await db.eventos_gamificacao.insert_many([doc.copy() for doc in docs], ordered=False)
+    except BulkWriteError as e:
+        erros = e.details.get("writeErrors", [])
+        if any(erro.get("code") != 11000 for erro in erros):
+            raise
+        duplicados = {erro["index"] for erro in erros}
+    if len(duplicados) < len(docs):
+        _gamificacao_sinal.set()
+    
+    if duplicados:
+        chaves = [
+            {"aluno_id": docs[i]["aluno_id"], "chave_idempotencia": docs[i]["chave_idempotencia"]}
+            for i in duplicados
+        ]
+        originais = {
+            (original["aluno_id"], original["chave_idempotencia"]): original
+            async for original in db.eventos_gamificacao.find({"$or": chaves}, {"_id": 0})
+        }
+        for i in duplicados:
+            original = originais.get((docs[i]["aluno_id"], docs[i]["chave_idempotencia"]), docs[i])
+            docs[i] = {**original, "duplicado": True}
+    return docs
+
+async def enfileirar_evento_gamificacao(evento: EventoGamificacao) -> dict:
+    return (await enfileirar_eventos_gamificacao([evento]))[0]
+
+def resposta_evento_recusado(erro: str) -> dict:
+    return {
+        "evento_id": None,
+        "status": "recusado",
+        "duplicado": False,
+        "pontos_previstos": 0,
+        "erro": erro,
+        "message": "Evento recusado"
+    }
+
+def resposta_evento_enfileirado(doc: dict) -> dict:
+    duplicado = doc.get("duplicado", False)
+    return {
+        "evento_id": doc["id"],
+        "status": doc["status"],
+        "duplicado": duplicado,
+        "pontos_previstos": PONTOS_POR_EVENTO.get(doc["tipo_evento"], 0),
+        "message": "Evento já recebido" if duplicado else "Evento enfileirado"
+    }
+
+async def adquirir_trava_aluno(aluno_id: str, dono: str) -> bool:
+    agora = datetime.now(timezone.utc)
+    try:
+        await db.gamificacao_travas.update_one(
+            {"aluno_id": aluno_id, "expira_em": {"$lt": agora.isoformat()}},
+            {"$set": {
+                "dono": dono,
+                "expira_em": (agora + timedelta(seconds=GAMIFICACAO_TRAVA_SEGUNDOS)).isoformat()
+            }},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # Trava válida de outro worker
+        return False
+    return True
+
+async def liberar_trava_aluno(aluno_id: str, dono: str):
+    await db.gamificacao_travas.delete_one({"aluno_id": aluno_id, "dono": dono})
+
+async def proximo_aluno_com_eventos(ignorar: set) -> Optional[str]:
+    """
+    Aluno do evento pronto mais antigo (inclui eventos presos em "processando").
+    
+    Alunos cujo evento mais antigo ainda aguarda retentativa são pulados, e os
+    eventos posteriores deles passam a esperar a mesma retentativa.
+    """
+    ignorar = set(ignorar)
+    while True:
+        agora = datetime.now(timezone.utc)
+        limite_trava = (agora - timedelta(seconds=GAMIFICACAO_TRAVA_SEGUNDOS)).isoformat()
+        evento = await db.eventos_gamificacao.find_one(
+            {
+                "aluno_id": {"$nin": list(ignorar)},
+                "$or": [
+                    {"status": "pendente", "proxima_tentativa": {"$lte": agora.isoformat()}},
+                    {"status": "processando", "travado_em": {"$lt": limite_trava}}
+                ]
+            },
+            {"_id": 0, "aluno_id": 1},
+            sort=[("criado_em", 1)]
+        )
+        if not evento:
+            return None
+        aluno_id = evento["aluno_id"]
+        cabeca = await db.eventos_gamificacao.find_one(
+            {"aluno_id": aluno_id, "status": {"$in": ["pendente", "processando"]}},
+            {"_id": 0, "status": 1, "proxima_tentativa": 1},
+            sort=[("criado_em", 1)]
+        )
+        if not cabeca or cabeca["status"] != "pendente" or cabeca["proxima_tentativa"] <= agora.isoformat():
+            return aluno_id
+        # Evento posterior gravado depois da falha da cabeça: passa a esperar por ela
+        await db.eventos_gamificacao.update_many(
+            {"aluno_id": aluno_id, "status": "pendente"},
+            {"$max": {"proxima_tentativa": cabeca["proxima_tentativa"]}}
+        )
+        ignorar.add(aluno_id)
+
+async def aplicar_eventos_gamificacao(aluno_id: str, eventos: List[dict]) -> List[dict]:
+    """Aplica um lote de eventos do mesmo aluno: pontos e sequência por evento, uma avaliação de conquistas."""
+    await criar_perfil_gamificacao_inicial(aluno_id)  # não faz nada se o perfil já existe
+    
+    for evento in eventos:
+        if evento.get("pontos_aplicados"):
+            # Já aplicado numa tentativa anterior que falhou depois
+            continue
+        # Sequência, ledger e janelas seguem a hora do evento, não a do processamento
+        quando = como_datetime_utc(evento["timestamp"])
+        if evento["tipo_evento"] == "checkin":
+            await atualizar_sequencia_checkins(aluno_id, quando, evento_id=evento["id"])
+        pontos = PONTOS_POR_EVENTO.get(evento["tipo_evento"], 0)
+        if pontos > 0:
+            await adicionar_pontos_aluno(
+                aluno_id=aluno_id,
+                pontos=pontos,
+                motivo=f"Evento: {evento['tipo_evento']}",
+                contexto=evento.get("dados_evento"),
+                quando=quando
+            )
+        await db.eventos_gamificacao.update_one(
+            {"id": evento["id"]},
+            {"$set": {"pontos_aplicados": True, "pontos": pontos}}
+        )
+    
+    aluno = await db.alunos.find_one({"id": aluno_id}, {"_id": 0})
+    if not aluno:
+        return []
+    perfil = await db.pontuacao_alunos.find_one({"aluno_id": aluno_id}, {"_id": 0})
+    return await avaliar_conquistas_aluno(aluno_id, aluno, perfil)
+
+async def registrar_falha_eventos(aluno_id: str, eventos: List[dict], erro: str):
+    """Reagenda o lote com backoff; eventos sem tentativas restantes vão para "falhou" (dead-letter)."""
+    agora = datetime.now(timezone.utc)
+    tentativas = max(e.get("tentativas", 0) for e in eventos) + 1
+    ids = [e["id"] for e in eventos]
+    if tentativas >= GAMIFICACAO_MAX_TENTATIVAS:
+        await db.eventos_gamificacao.update_many(
+            {"id": {"$in": ids}},
+            {"$set": {"status": "falhou", "erro": erro, "tentativas": tentativas, "atualizado_em": agora.isoformat()}}
+        )
+        logger.error(f"Eventos de gamificação do aluno {aluno_id} descartados após {tentativas} tentativas: {erro}")
+        return
+    
+    proxima = (agora + timedelta(seconds=GAMIFICACAO_BACKOFF_SEGUNDOS * (2 ** (tentativas - 1)))).isoformat()
+    await db.eventos_gamificacao.update_many(
+        {"id": {"$in": ids}},
+        {"$set": {
+            "status": "pendente",
+            "erro": erro,
+            "tentativas": tentativas,
+            "proxima_tentativa": proxima,
+            "atualizado_em": agora.isoformat()
+        }}
+    )
+    # Eventos posteriores do aluno esperam o lote que falhou (mantém a ordem)
+    await db.eventos_gamificacao.update_many(
+        {"aluno_id": aluno_id, "status": "pendente", "id": {"$nin": ids}},
+        {"$max": {"proxima_tentativa": proxima}}
+    )
+
+async def processar_eventos_aluno(aluno_id: str) -> int:
+    """Processa, em ordem, o lote de eventos prontos do aluno (a trava já deve estar adquirida)."""
+    agora = datetime.now(timezone.utc).isoformat()
+    eventos = await db.eventos_gamificacao.find(
+        {"aluno_id": aluno_id, "status": {"$in": ["pendente", "processando"]}},
+        {"_id": 0}
+    ).sort("criado_em", 1).limit(GAMIFICACAO_LOTE_EVENTOS).to_list(GAMIFICACAO_LOTE_EVENTOS)
+    
+    # Só o prefixo pronto: um evento aguardando retentativa bloqueia os seguintes
+    lote = []
+    for evento in eventos:
+        if evento["status"] == "pendente" and evento["proxima_tentativa"] > agora:
+            break
+        lote.append(evento)
+    if not lote:
+        return 0
+    
+    ids = [e["id"] for e in lote]
+    await db.eventos_gamificacao.update_many(
+        {"id": {"$in": ids}},
+        {"$set": {"status": "processando", "travado_em": agora}}
+    )
+    try:
+        novas_conquistas = await aplicar_eventos_gamificacao(aluno_id, lote)
+    except Exception as e:
+        await registrar_falha_eventos(aluno_id, lote, str(e))
+        return 0
+    
+    await db.eventos_gamificacao.update_many(
+        {"id": {"$in": ids}},
+        {"$set": {
+            "status": "processado",
+            "processado_em": datetime.now(timezone.utc).isoformat()
+        }, "$inc": {"tentativas": 1}}
+    )
+    # Conquistas ficam no último evento do lote; o aluno as recebe pelo stream de notificações
+    await db.eventos_gamificacao.update_one(
+        {"id": ids[-1]},
+        {"$set": {"conquistas_desbloqueadas": [c["conquista_id"] for c in novas_conquistas]}}
+    )
+    return len(lote)
+
+async def worker_gamificacao(indice: int):
+    dono = f"{os.getpid()}-{indice}-{uuid.uuid4()}"
+    while True:
+        try:
+            _gamificacao_sinal.clear()
+            # Alunos travados por outro worker ou sem nada processável ficam de fora até a próxima rodada
+            ignorar = set()
+            while True:
+                aluno_id = await proximo_aluno_com_eventos(ignorar)
+                if aluno_id is None:
+                    break
+                if not await adquirir_trava_aluno(aluno_id, dono):
+                    ignorar.add(aluno_id)
+                    continue
+                _gamificacao_sinal.set()  # pode haver eventos de outros alunos
+                try:
+                    processados = await processar_eventos_aluno(aluno_id)
+                finally:
+                    await liberar_trava_aluno(aluno_id, dono)
+                if not processados:
+                    ignorar.add(aluno_id)
+            try:
+                await asyncio.wait_for(_gamificacao_sinal.wait(), timeout=GAMIFICACAO_POLL_SEGUNDOS)
+            except asyncio.TimeoutError:
+                pass
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Worker de gamificação {indice} falhou: {str(e)}")
+            await asyncio.sleep(GAMIFICACAO_POLL_SEGUNDOS)
+
+
+# ==================== GAMIFICAÇÃO - NOTIFICAÇÕES EM TEMPO REAL ====================
+
+# Conquistas e subidas de nível são empurradas por SSE em vez de o frontend
+# consultar conquistas-pendentes periodicamente. Com um único processo basta o
+# barramento em memória; com vários workers (uvicorn --workers, várias réplicas)
+# ative GAMIFICACAO_NOTIFICACOES_CHANGE_STREAM: a notificação é gravada em
+# notificacoes_gamificacao e cada processo a recebe por change stream (requer replica set).
+NOTIFICACOES_CHANGE_STREAM = os.environ.get('GAMIFICACAO_NOTIFICACOES_CHANGE_STREAM', 'false').lower() in ('1', 'true', 'sim')
+NOTIFICACOES_FILA_MAXIMA = 100
+NOTIFICACOES_HEARTBEAT_SEGUNDOS = 15
+NOTIFICACOES_RETENCAO_HORAS = 24
+CAMPOS_NOTIFICACAO = ("id", "tipo", "aluno_id", "data", "dados")
+
+class BarramentoNotificacoes:
+    """
+    Pub/sub em memória: cada conexão SSE assina as notificações de um aluno.
+    
+    Publicar para um aluno sem conexões é só um lookup no dicionário. Conexões
+    lentas que enchem a fila perdem notificações; as conquistas voltam como
+    pendentes na reconexão.
+    """
+    
+    def __init__(self, tamanho_fila: int = NOTIFICACOES_FILA_MAXIMA):
+        self.tamanho_fila = tamanho_fila
+        self._assinantes: dict = defaultdict(set)
+    
+    def assinar(self, aluno_id: str) -> asyncio.Queue:
+        fila = asyncio.Queue(maxsize=self.tamanho_fila)
+        self._assinantes[aluno_id].add(fila)
+        return fila
+    
+    def cancelar(self, aluno_id: str, fila: asyncio.Queue):
+        filas = self._assinantes.get(aluno_id)
+        if filas is None:
+            return
+        filas.discard(fila)
+        if not filas:
+            del self._assinantes[aluno_id]
+    
+    def publicar(self, notificacao: dict):
+        for fila in self._assinantes.get(notificacao["aluno_id"], ()):
+            try:
+                fila.put_nowait(notificacao)
+            except asyncio.QueueFull:
+                logger.warning(f"Fila de notificações cheia para aluno {notificacao['aluno_id']}; notificação descartada")
+    
+    def total_conexoes(self) -> int:
+        return sum(len(filas) for filas in self._assinantes.values())
+
+barramento_notificacoes = BarramentoNotificacoes()
+_notificacoes_tarefa: Optional[asyncio.Task] = None
+
+def montar_notificacao(aluno_id: str, tipo: str, dados: dict, notificacao_id: Optional[str] = None, data: Optional[str] = None) -> dict:
+    return {
+        "id": notificacao_id or str(uuid.uuid4()),
+        "tipo": tipo,
+        "aluno_id": aluno_id,
+        "data": data or datetime.now(timezone.utc).isoformat(),
+        "dados": dados
+    }
+
+def notificacao_conquista(registro: dict) -> dict:
+    """Notificação a partir do documento de alunos_conquistas (mesmo id, permite deduplicar)."""
+    return montar_notificacao(registro["aluno_id"], "conquista", registro, registro["id"], registro["data_desbloqueio"])
+
+async def publicar_notificacoes(notificacoes: List[dict]):
+    """Entrega notificações às conexões SSE; falhas não afetam quem desbloqueou."""
+    if not notificacoes:
+        return
+    if not NOTIFICACOES_CHANGE_STREAM:
+        for notificacao in notificacoes:
+            barramento_notificacoes.publicar(notificacao)
+        return
+    expira_em = datetime.now(timezone.utc) + timedelta(hours=NOTIFICACOES_RETENCAO_HORAS)
+    try:
+        await db.notificacoes_gamificacao.insert_many(
+            [{**notificacao, "expira_em": expira_em} for notificacao in notificacoes], ordered=False
+        )
+    except Exception as e:
+        logger.error(f"Falha ao publicar notificações de gamificação: {str(e)}")
+
+async def escutar_notificacoes_change_stream():
+    """Repassa ao barramento local as notificações gravadas por qualquer processo."""
+    token_retomada = None
+    while True:
+        try:
+            async with db.notificacoes_gamificacao.watch(
+                [{"$match": {"operationType": "insert"}}], resume_after=token_retomada
+            ) as stream:
+                async for mudanca in stream:
+                    token_retomada = stream.resume_token
+                    documento = mudanca["fullDocument"]
+                    barramento_notificacoes.publicar({campo: documento.get(campo) for campo in CAMPOS_NOTIFICACAO})
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if isinstance(e, OperationFailure):
+                token_retomada = None  # token fora do oplog: recomeça do presente
+            logger.error(f"Change stream de notificações falhou: {str(e)}")
+            await asyncio.sleep(GAMIFICACAO_POLL_SEGUNDOS)
+
+def formatar_evento_sse(notificacao: dict) -> str:
+    dados = json.dumps(notificacao, ensure_ascii=False, default=str)
+    return f"id: {notificacao['id']}\nevent: {notificacao['tipo']}\ndata: {dados}\n\n"
+
+
+# ==================== GAMIFICAÇÃO - BACKFILL DE CONQUISTAS ====================
+
+BACKFILL_LOTE_ALUNOS = 1000
+
+class BackfillConquistasRequest(BaseModel):
+    conquista_ids: Optional[List[str]] = None  # None = todas as conquistas ativas
+
+def montar_update_backfill(conquistas: List[dict], agora: datetime) -> tuple:
+    """
+    Update do perfil e lançamentos para as conquistas de um aluno no backfill.
+    
+    Só incrementos e pushes: virada de janela e nível dependem do perfil lido
+    no lote, que pode estar desatualizado, e vão em operações com filtro próprio
+    (operacoes_virada_janelas e operacao_subir_nivel).
+    """
+    lancamentos = [
+        {
+            "data": agora.isoformat(),
+            "pontos": conquista["pontos"],
+            "xp": conquista.get("xp_bonus", 0) or conquista["pontos"],
+            "motivo": f"Conquista desbloqueada: {conquista['nome']}",
+            "conquista_id": conquista["id"]
+        }
+        for conquista in conquistas
+    ]
+    pontos = sum(l["pontos"] for l in lancamentos)
+    
+    update = com_perfil_padrao({
+        "$inc": {
+            "pontos_totais": pontos,
+            "pontos_mes_atual": pontos,
+            "pontos_semana_atual": pontos,
+            "xp_atual": sum(l["xp"] for l in lancamentos),
+            "conquistas_total": len(conquistas),
+            "conquistas_mes": len(conquistas)
+        },
+        "$set": {"atualizado_em": agora.isoformat()},
+        "$push": {
+            "historico_pontos": {"$each": lancamentos, "$slice": -30},
+            "conquistas_ids": {"$each": [c["id"] for c in conquistas]}
+        }
+    })
+    return update, lancamentos
+
+def operacao_subir_nivel(aluno_id: str, perfil: dict, xp: int) -> Optional[UpdateOne]:
+    """Subida de nível filtrada pelo nível atual: nunca rebaixa o aluno."""
+    xp_final = perfil.get("xp_atual", 0) + xp
+    novo_nivel = nivel_por_xp(xp_final)
+    if novo_nivel <= perfil.get("nivel", 1):
+        return None
+    xp_proximo = xp_para_nivel(novo_nivel)
+    return UpdateOne(
+        {"aluno_id": aluno_id, "nivel": {"$not": {"$gte": novo_nivel}}},
+        {"$set": {
+            "nivel": novo_nivel,
+            "xp_proximo_nivel": xp_proximo,
+            "progresso_nivel_percent": round(xp_final / xp_proximo * 100, 2)
+        }}
+    )
+
+async def backfill_lote_alunos(alunos: List[dict], conquistas: List[dict], necessarias: set) -> int:
+    """Avalia e grava as conquistas de um lote de alunos com um punhado de operações em massa."""
+    aluno_ids = [a["id"] for a in alunos]
+    perfis = {
+        p["aluno_id"]: p
+        async for p in db.pontuacao_alunos.find({"aluno_id": {"$in": aluno_ids}}, {"_id": 0, "historico_pontos": 0})
+    }
+    
+    # Contadores ainda não reconstruídos: uma agregação agrupada por tipo para o lote inteiro
+    sem_contadores = [a for a in aluno_ids if not perfis.get(a, {}).get("contadores_reconstruidos_em")]
+    reconstruidos = await reconstruir_contadores(sem_contadores) if sem_contadores else {}
+    
+    desbloqueadas = {a: set(perfis.get(a, {}).get("conquistas_ids", [])) for a in aluno_ids}
+    
+    agregacoes = await calcular_agregacoes([c.get("criterio", {}) for c in conquistas], aluno_ids)
+    
+    agora = datetime.now(timezone.utc)
+    registros, por_aluno = [], {}
+    for aluno in alunos:
+        perfil = perfis.get(aluno["id"], {})
+        contadores = reconstruidos.get(aluno["id"]) or perfil.get("contadores", {})
+        stats = estatisticas_do_perfil(perfil, contadores, aluno, "meses_ativo" in necessarias)
+        stats["agregacoes"] = agregacoes.get(aluno["id"], {})
+        nivel = perfil.get("nivel", 1)
+        candidatas = [c for c in conquistas if nivel >= c.get("nivel_minimo", 1)]
+        novas = selecionar_conquistas(candidatas, desbloqueadas[aluno["id"]], stats)
+        if not novas:
+            continue
+        por_aluno[aluno["id"]] = novas
+        registros.extend({
+            "id": str(uuid.uuid4()),
+            "aluno_id": aluno["id"],
+            "aluno_nome": aluno.get("nome", "Aluno"),
+            "conquista_id": conquista["id"],
+            "conquista_nome": conquista["nome"],
+            "conquista_icone": conquista.get("icone", "🏆"),
+            "pontos_ganhos": conquista["pontos"],
+            "xp_ganhos": conquista.get("xp_bonus", 0),
+            "data_desbloqueio": agora.isoformat(),
+            "notificado": False,
+            "visualizado": False
+        } for conquista in novas)
+    
+    if not registros:
+        return 0
+    
+    try:
+        await db.alunos_conquistas.insert_many(registros, ordered=False)
+    except BulkWriteError as e:
+        erros = e.details.get("writeErrors", [])
+        if any(erro.get("code") != 11000 for erro in erros):
+            raise
+        # Desbloqueadas em paralelo pela fila de eventos: não pontuar de novo
+        duplicadas = {(registros[erro["index"]]["aluno_id"], registros[erro["index"]]["conquista_id"]) for erro in erros}
+        por_aluno = {
+            aluno_id: [c for c in novas if (aluno_id, c["id"]) not in duplicadas]
+            for aluno_id, novas in por_aluno.items()
+        }
+    
+    operacoes_janelas, operacoes_perfil, operacoes_nivel, operacoes_ledger = [], [], [], []
+    dia = dia_local(agora).isoformat()
+    mes, semana = chave_mes(agora), chave_semana(agora)
+    for aluno_id, novas in por_aluno.items():
+        if not novas:
+            continue
+        perfil = perfis.get(aluno_id, {})
+        update, lancamentos = montar_update_backfill(novas, agora)
+        if perfil and (perfil.get("periodo_mes") != mes or perfil.get("periodo_semana") != semana):
+            operacoes_janelas.extend(operacoes_virada_janelas(aluno_id, mes, semana))
+        operacoes_perfil.append(UpdateOne({"aluno_id": aluno_id}, update, upsert=True))
+        subir_nivel = operacao_subir_nivel(aluno_id, perfil, update["$inc"]["xp_atual"])
+        if subir_nivel:
+            operacoes_nivel.append(subir_nivel)
+        operacoes_ledger.append(UpdateOne(
+            {"aluno_id": aluno_id, "dia": dia},
+            {
+                "$inc": {
+                    "pontos": sum(l["pontos"] for l in lancamentos),
+                    "xp": sum(l["xp"] for l in lancamentos),
+                    "lancamentos_total": len(lancamentos)
+                },
+                "$push": {"lancamentos": {"$each": [{**l, "contexto": {"backfill": True}} for l in lancamentos]}}
+            },
+            upsert=True
+        ))
+    if not operacoes_perfil:
+        return 0
+    # Janelas viram antes dos incrementos; o nível sobe depois do upsert que cria o perfil
+    if operacoes_janelas:
+        await db.pontuacao_alunos.bulk_write(operacoes_janelas, ordered=False)
+    resultado_perfis, _ = await asyncio.gather(
+        db.pontuacao_alunos.bulk_write(operacoes_perfil, ordered=False),
+        db.pontos_ledger.bulk_write(operacoes_ledger, ordered=False)
+    )
+    if operacoes_nivel:
+        await db.pontuacao_alunos.bulk_write(operacoes_nivel, ordered=False)
+    await atualizar_pontos_segmentos(await db.pontuacao_alunos.find(
+        {"aluno_id": {"$in": [aluno_id for aluno_id, novas in por_aluno.items() if novas]}}, PROJECAO_RANKING
+    ).to_list(None))
+    
+    desbloqueios = [c for novas in por_aluno.values() for c in novas]
+    pontos = {aluno_id: sum(c["pontos"] for c in novas) for aluno_id, novas in por_aluno.items()}
+    await incrementar_estatisticas_gamificacao(
+        {
+            "total_perfis": resultado_perfis.upserted_count,
+            "soma_pontos": sum(pontos.values()),
+            "alunos_participando": sum(
+                1 for aluno_id, p in pontos.items()
+                if p > 0 and perfis.get(aluno_id, {}).get("pontos_totais", 0) <= 0
+            ),
+        },
+        desbloqueios
+    )
+    return len(desbloqueios)
+
+async def job_backfill_conquistas(job_id: str, conquista_ids: Optional[List[str]]) -> dict:
+    # O catálogo em memória deste processo pode não ter a conquista recém-criada
+    # em outro worker: o backfill sempre parte do banco
+    catalogo_conquistas.invalidar()
+    conquistas = await catalogo_conquistas.todas()
+    ignoradas = []
+    if conquista_ids:
+        conquistas = [c for c in conquistas if c["id"] in conquista_ids]
+        # O endpoint já recusa ids inativos; aqui sobra só a desativação entre o
+        # pedido e a execução, registrada no resultado em vez de sumir em silêncio
+        avaliadas = {c["id"] for c in conquistas}
+        ignoradas = [cid for cid in conquista_ids if cid not in avaliadas]
+    necessarias = estatisticas_necessarias([c.get("criterio", {}) for c in conquistas])
+    
+    total = await db.alunos.count_documents({})
+    await db.jobs_gamificacao.update_one({"id": job_id}, {"$set": {"total": total}})
+    
+    processados, desbloqueios = 0, 0
+    lote = []
+    cursor = db.alunos.find({}, {"_id": 0, "id": 1, "nome": 1, "data_matricula": 1, "criado_em": 1}).sort("id", 1)
+    async for aluno in cursor:
+        lote.append(aluno)
+        if len(lote) < BACKFILL_LOTE_ALUNOS:
+            continue
+        desbloqueios += await backfill_lote_alunos(lote, conquistas, necessarias)
+        processados += len(lote)
+        lote = []
+        await db.jobs_gamificacao.update_one(
+            {"id": job_id}, {"$set": {"processados": processados, "desbloqueios": desbloqueios}}
+        )
+    if lote:
+        desbloqueios += await backfill_lote_alunos(lote, conquistas, necessarias)
+        processados += len(lote)
+    await db.jobs_gamificacao.update_one(
+        {"id": job_id}, {"$set": {"processados": processados, "desbloqueios": desbloqueios}}
+    )
+    
+    # Pontos mudaram em massa: o ranking em memória é recarregado na próxima consulta
+    ranking_alunos.carregado_em = None
+    invalidar_progresso_aluno()
+    return {
+        "alunos": processados,
+        "desbloqueios": desbloqueios,
+        "conquistas_avaliadas": len(conquistas),
+        "conquistas_ignoradas": ignoradas,
+    }
+
+
+# ==================== GAMIFICAÇÃO - ENDPOINTS ====================
+
+@api_router.get("/gamificacao/conquistas")
+async def listar_conquistas(
+    tipo: Optional[str] = None,
+    raridade: Optional[str] = None,
+    visiveis_apenas: bool = True,
+    current_user: User = Depends(get_current_user)
+):
+    """Lista todas as conquistas disponíveis no sistema."""
+    query = {"ativo": True}
+    
+    if tipo:
+        query["tipo"] = tipo
+    if raridade:
+        query["raridade"] = raridade
+    if visiveis_apenas:
+        query["visivel"] = True
+    
+    conquistas = await db.conquistas.find(query, {"_id": 0}).sort("ordem_exibicao", 1).to_list(1000)
+    return conquistas
+
+@api_router.post("/gamificacao/conquistas")
+async def criar_conquista(
+    conquista: ConquistaCreate,
+    current_user: User = Depends(get_current_user)
+):
+    """Cria nova conquista (apenas admins)."""
+    if current_user.role != "admin":
+        raise HTTPException(403, "Apenas administradores podem criar conquistas")
+    validar_criterio(conquista.criterio)
+    
+    conquista_dict = conquista.model_dump()
+    conquista_dict["id"] = str(uuid.uuid4())
+    conquista_dict["criado_em"] = datetime.now(timezone.utc).isoformat()
+    conquista_dict["criado_por"] = current_user.id
+    conquista_dict["atualizado_em"] = datetime.now(timezone.utc).isoformat()
+    conquista_dict["ativo"] = True
+    conquista_dict["ordem_exibicao"] = 0
+    
+    await db.conquistas.insert_one(conquista_dict.copy())
+    catalogo_conquistas.invalidar()
+    return conquista_dict
 
 @api_router.put("/gamificacao/conquistas/{conquista_id}")
 async def atualizar_conquista(
@@ -3149,6 +7074,8 @@ async def atualizar_conquista(
     """Atualiza uma conquista existente (apenas admins)."""
     if current_user.role != "admin":
         raise HTTPException(403, "Apenas administradores podem atualizar conquistas")
+    if "criterio" in dados:
+        validar_criterio(dados["criterio"])
     
     dados["atualizado_em"] = datetime.now(timezone.utc).isoformat()
     
@@ -3159,6 +7086,7 @@ async def atualizar_conquista(
     
     if result.matched_count == 0:
         raise HTTPException(404, "Conquista não encontrada")
+    catalogo_conquistas.invalidar()
     
     return {"message": "Conquista atualizada com sucesso"}
 
@@ -3178,9 +7106,23 @@ async def deletar_conquista(
     
     if result.matched_count == 0:
         raise HTTPException(404, "Conquista não encontrada")
+    catalogo_conquistas.invalidar()
     
     return {"message": "Conquista desativada com sucesso"}
 
+@api_router.get("/gamificacao/aluno/{aluno_id}/progresso")
+async def obter_progresso_conquistas(
+    aluno_id: str,
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Progresso do aluno em cada conquista visível: valor atual, alvo e percentual.
+    
+    Calculado numa única coleta de estatísticas e mantido em cache até o
+    próximo evento do aluno.
+    """
+    return await obter_progresso_aluno(aluno_id)
+
 @api_router.get("/gamificacao/aluno/{aluno_id}")
 async def obter_perfil_gamificacao(
     aluno_id: str,
@@ -3192,6 +7134,11 @@ async def obter_perfil_gamificacao(
     if not perfil:
         perfil = await criar_perfil_gamificacao_inicial(aluno_id)
     
+    normalizar_janelas_perfil(perfil)
+    await ranking_alunos.garantir_carregado()
+    perfil["ranking_geral"] = ranking_alunos.periodos["geral"].posicao(aluno_id)
+    perfil["ranking_mensal"] = ranking_alunos.periodos["mensal"].posicao(aluno_id)
+    
     # Converter datas se necessário
     if isinstance(perfil.get("atualizado_em"), str):
         perfil["atualizado_em"] = datetime.fromisoformat(perfil["atualizado_em"])
@@ -3228,35 +7175,7 @@ async def verificar_conquistas_aluno(
     if not perfil:
         perfil = await criar_perfil_gamificacao_inicial(aluno_id)
     
-    # Buscar conquistas já desbloqueadas
-    conquistas_desbloqueadas = await db.alunos_conquistas.find(
-        {"aluno_id": aluno_id}
-    ).to_list(1000)
-    conquistas_ids_desbloqueadas = {c["conquista_id"] for c in conquistas_desbloqueadas}
-    
-    # Buscar todas conquistas ativas
-    todas_conquistas = await db.conquistas.find({"ativo": True}).to_list(1000)
-    
-    novas_conquistas = []
-    
-    for conquista in todas_conquistas:
-        if conquista["id"] in conquistas_ids_desbloqueadas:
-            continue
-        
-        if perfil.get("nivel", 1) < conquista.get("nivel_minimo", 1):
-            continue
-        
-        prerequisitos = conquista.get("conquistas_prerequisitos", [])
-        if not all(p in conquistas_ids_desbloqueadas for p in prerequisitos):
-            continue
-        
-        if await verificar_criterio_conquista(aluno_id, conquista.get("criterio", {})):
-            nova_conquista = await desbloquear_conquista(
-                aluno_id, 
-                aluno.get("nome", "Aluno"), 
-                conquista
-            )
-            novas_conquistas.append(nova_conquista)
+    novas_conquistas = await avaliar_conquistas_aluno(aluno_id, aluno, perfil)
     
     return {
         "novas_conquistas": novas_conquistas,
@@ -3267,157 +7186,443 @@ async def verificar_conquistas_aluno(
 async def obter_ranking(
     periodo: str = "geral",
     limite: int = 100,
+    inicio: int = 0,
     current_user: User = Depends(get_current_user)
 ):
     """Retorna o ranking de alunos por pontuação."""
-    if periodo == "mensal":
-        campo_pontos = "pontos_mes_atual"
-    elif periodo == "semanal":
-        campo_pontos = "pontos_semana_atual"
-    else:
-        campo_pontos = "pontos_totais"
+    if periodo not in CAMPOS_RANKING:
+        periodo = "geral"
     
-    pipeline = [
-        {"$match": {campo_pontos: {"$gt": 0}}},
-        {"$sort": {campo_pontos: -1}},
-        {"$limit": limite}
-    ]
+    await ranking_alunos.garantir_carregado()
+    ranking = ranking_alunos.periodos[periodo]
+    resultado = await montar_linhas_ranking(periodo, ranking.pagina(inicio, limite))
     
-    ranking = await db.pontuacao_alunos.aggregate(pipeline).to_list(limite)
+    return {
+        "periodo": periodo,
+        "ranking": resultado,
+        "total_participantes": len(ranking)
+    }
+
+@api_router.get("/gamificacao/ranking/aluno/{aluno_id}")
+async def obter_posicao_ranking(
+    aluno_id: str,
+    periodo: str = "geral",
+    vizinhos: int = 2,
+    current_user: User = Depends(get_current_user)
+):
+    """Posição do aluno no ranking e os alunos imediatamente acima e abaixo."""
+    if periodo not in CAMPOS_RANKING:
+        periodo = "geral"
+    
+    await ranking_alunos.garantir_carregado()
+    ranking = ranking_alunos.periodos[periodo]
+    posicao = ranking.posicao(aluno_id)
+    if posicao is None:
+        return {
+            "periodo": periodo,
+            "aluno_id": aluno_id,
+            "posicao": None,
+            "pontos": 0,
+            "total_participantes": len(ranking),
+            "vizinhos": []
+        }
+    
+    indice = ranking.indice(aluno_id)
+    inicio = max(0, indice - vizinhos)
+    return {
+        "periodo": periodo,
+        "aluno_id": aluno_id,
+        "posicao": posicao,
+        "pontos": ranking.pontos(aluno_id),
+        "total_participantes": len(ranking),
+        "vizinhos": await montar_linhas_ranking(periodo, ranking.pagina(inicio, indice - inicio + vizinhos + 1))
+    }
+
+@api_router.get("/gamificacao/ranking/janela")
+async def obter_ranking_janela(
+    janela: Optional[str] = "semana_atual",
+    inicio: Optional[str] = None,
+    fim: Optional[str] = None,
+    limite: int = 100,
+    current_user: User = Depends(get_current_user)
+):
+    """Ranking de uma janela qualquer (nomeada ou inicio/fim AAAA-MM-DD), calculado pelo ledger diário."""
+    if inicio or fim:
+        if not (inicio and fim):
+            raise HTTPException(400, "Informe inicio e fim")
+        dia_inicio, dia_fim = inicio[:10], fim[:10]
+    else:
+        dia_inicio, dia_fim = intervalo_janela(janela)
+    
+    grupos = await ranking_por_intervalo(dia_inicio, dia_fim, limite)
+    nomes = await cache_nomes_alunos.obter([g["_id"] for g in grupos])
     
     resultado = []
-    for idx, perfil in enumerate(ranking, 1):
-        aluno = await db.alunos.find_one({"id": perfil["aluno_id"]}, {"_id": 0})
-        if aluno:
-            resultado.append({
-                "posicao": idx,
-                "aluno_id": perfil["aluno_id"],
-                "aluno_nome": aluno.get("nome"),
-                "aluno_foto": aluno.get("foto_url"),
-                "pontos": perfil.get(campo_pontos, 0),
-                "nivel": perfil.get("nivel", 1),
-                "conquistas_total": perfil.get("conquistas_total", 0)
-            })
+    posicao, pontos_anterior = 0, None
+    for idx, grupo in enumerate(grupos, 1):
+        if grupo["pontos"] != pontos_anterior:
+            posicao, pontos_anterior = idx, grupo["pontos"]
+        aluno = nomes.get(grupo["_id"])
+        if not aluno:
+            continue
+        resultado.append({
+            "posicao": posicao,
+            "aluno_id": grupo["_id"],
+            "aluno_nome": aluno["nome"],
+            "aluno_foto": aluno["foto_url"],
+            "pontos": grupo["pontos"]
+        })
     
     return {
-        "periodo": periodo,
+        "inicio": dia_inicio,
+        "fim": dia_fim,
         "ranking": resultado,
         "total_participantes": len(resultado)
     }
 
-@api_router.post("/gamificacao/evento")
+@api_router.get("/gamificacao/ranking/segmento/{tipo}/{valor}")
+async def obter_ranking_segmento(
+    tipo: str,
+    valor: str,
+    periodo: str = "geral",
+    limite: int = 100,
+    cursor: Optional[str] = None,
+    aluno_id: Optional[str] = None,
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Ranking restrito a um segmento: plano, modalidade, professor ou segmento salvo.
+    
+    Paginado por `cursor`: a resposta traz `proximo_cursor` enquanto houver mais
+    itens; `total_participantes` vem só na primeira página.
+    Com `aluno_id`, também retorna a posição desse aluno no segmento.
+    """
+    if tipo not in TIPOS_SEGMENTO:
+        raise HTTPException(400, f"Tipo de segmento inválido. Use {', '.join(TIPOS_SEGMENTO)}")
+    if periodo not in CAMPOS_RANKING:
+        periodo = "geral"
+    segmento = chave_segmento(tipo, valor)
+    
+    itens, total, proximo_cursor = await ranking_segmento(segmento, periodo, limite, cursor)
+    await ranking_alunos.garantir_carregado()
+    nomes = await cache_nomes_alunos.obter([item_aluno_id for item_aluno_id, _, _ in itens])
+    
+    resultado = []
+    for item_aluno_id, pontos, posicao in itens:
+        aluno = nomes.get(item_aluno_id)
+        if not aluno:
+            continue
+        info = ranking_alunos.info.get(item_aluno_id, {})
+        resultado.append({
+            "posicao": posicao,
+            "aluno_id": item_aluno_id,
+            "aluno_nome": aluno["nome"],
+            "aluno_foto": aluno["foto_url"],
+            "pontos": pontos,
+            "nivel": info.get("nivel", 1),
+            "conquistas_total": info.get("conquistas_total", 0)
+        })
+    
+    resposta = {
+        "segmento": {"tipo": tipo, "valor": valor},
+        "periodo": periodo,
+        "ranking": resultado,
+        "total_participantes": total,
+        "proximo_cursor": proximo_cursor
+    }
+    if aluno_id:
+        posicao_aluno, pontos_aluno = await posicao_no_segmento(segmento, periodo, aluno_id)
+        resposta["aluno"] = {"aluno_id": aluno_id, "posicao": posicao_aluno, "pontos": pontos_aluno}
+    return resposta
+
+@api_router.get("/gamificacao/segmentos")
+async def listar_segmentos_ranking(
+    current_user: User = Depends(get_current_user)
+):
+    """Lista os segmentos salvos (competições com alunos escolhidos)."""
+    return await db.segmentos_ranking.find({}, {"_id": 0}).sort("nome", 1).to_list(1000)
+
+@api_router.post("/gamificacao/segmentos")
+async def criar_segmento_ranking(
+    segmento: SegmentoRankingCreate,
+    current_user: User = Depends(get_current_user)
+):
+    """Cria um segmento salvo de ranking (apenas admins)."""
+    if current_user.role != "admin":
+        raise HTTPException(403, "Apenas administradores podem criar segmentos")
+    
+    doc = segmento.model_dump()
+    doc["aluno_ids"] = list(dict.fromkeys(doc["aluno_ids"]))
+    doc["id"] = str(uuid.uuid4())
+    doc["criado_em"] = datetime.now(timezone.utc).isoformat()
+    await db.segmentos_ranking.insert_one(doc.copy())
+    await sincronizar_segmentos_alunos(doc["aluno_ids"])
+    return doc
+
+@api_router.put("/gamificacao/segmentos/{segmento_id}")
+async def atualizar_segmento_ranking(
+    segmento_id: str,
+    segmento: SegmentoRankingCreate,
+    current_user: User = Depends(get_current_user)
+):
+    """Atualiza nome e alunos de um segmento salvo (apenas admins)."""
+    if current_user.role != "admin":
+        raise HTTPException(403, "Apenas administradores podem atualizar segmentos")
+    
+    dados = segmento.model_dump()
+    dados["aluno_ids"] = list(dict.fromkeys(dados["aluno_ids"]))
+    dados["atualizado_em"] = datetime.now(timezone.utc).isoformat()
+    anterior = await db.segmentos_ranking.find_one_and_update(
+        {"id": segmento_id},
+        {"$set": dados},
+        projection={"_id": 0, "aluno_ids": 1}
+    )
+    if not anterior:
+        raise HTTPException(404, "Segmento não encontrado")
+    # Quem saiu perde a linha do segmento; quem entrou ganha
+    await sincronizar_segmentos_alunos(anterior.get("aluno_ids", []) + dados["aluno_ids"])
+    return {"message": "Segmento atualizado com sucesso"}
+
+@api_router.delete("/gamificacao/segmentos/{segmento_id}")
+async def deletar_segmento_ranking(
+    segmento_id: str,
+    current_user: User = Depends(get_current_user)
+):
+    """Remove um segmento salvo e suas linhas de ranking (apenas admins)."""
+    if current_user.role != "admin":
+        raise HTTPException(403, "Apenas administradores podem deletar segmentos")
+    
+    result = await db.segmentos_ranking.delete_one({"id": segmento_id})
+    if result.deleted_count == 0:
+        raise HTTPException(404, "Segmento não encontrado")
+    await db.ranking_segmentos.delete_many({"segmento": chave_segmento("segmento", segmento_id)})
+    return {"message": "Segmento removido com sucesso"}
+
+@api_router.post("/gamificacao/evento", status_code=202)
 async def processar_evento_gamificacao(
     evento: EventoGamificacao,
     current_user: User = Depends(get_current_user)
 ):
     """
-    Processa um evento de gamificação e atualiza pontuação/conquistas.
+    Enfileira um evento de gamificação; pontos e conquistas são processados em segundo plano.
     
     Eventos suportados:
     - checkin: Aluno fez check-in
     - treino_completo: Aluno completou treino
     - pagamento: Pagamento realizado
     - avaliacao: Nova avaliação física
-    """
-    pontos_base = {
-        "checkin": 5,
-        "treino_completo": 10,
-        "pagamento": 15,
-        "avaliacao": 20
-    }
-    
-    pontos = pontos_base.get(evento.tipo_evento, 0)
     
-    # Atualizar sequência de check-ins
-    if evento.tipo_evento == "checkin":
-        await atualizar_sequencia_checkins(evento.aluno_id)
-    
-    if pontos > 0:
-        await adicionar_pontos_aluno(
-            aluno_id=evento.aluno_id,
-            pontos=pontos,
-            motivo=f"Evento: {evento.tipo_evento}",
-            contexto=evento.dados_evento
+    Conquistas desbloqueadas chegam pelo stream de notificações (ou por conquistas-pendentes).
+    Retentativas devem reenviar a mesma `chave_idempotencia`: o evento repetido
+    não é regravado e a resposta traz o evento original com `duplicado: true`.
+    """
+    erro = erro_timestamp_evento(evento)
+    if erro:
+        raise HTTPException(400, f"Evento recusado: {erro}")
+    doc = await enfileirar_evento_gamificacao(evento)
+    return resposta_evento_enfileirado(doc)
+
+@api_router.post("/gamificacao/eventos", status_code=202)
+async def processar_eventos_gamificacao_lote(
+    eventos: List[EventoGamificacao],
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Enfileira vários eventos de uma vez (dispositivos que acumulam offline).
+    
+    A ordem da lista é a ordem de processamento por aluno. Reenviar o lote
+    inteiro é seguro quando os eventos têm `chave_idempotencia`. O `timestamp`
+    de cada evento (quando aconteceu no dispositivo) conta para sequência e
+    rankings. Eventos no futuro ou fora da retenção são recusados um a um
+    (status "recusado" com o motivo em `erro`, na mesma posição da lista); os
+    demais são enfileirados normalmente.
+    """
+    if len(eventos) > GAMIFICACAO_EVENTOS_POR_REQUISICAO:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Máximo de {GAMIFICACAO_EVENTOS_POR_REQUISICAO} eventos por requisição"
         )
-    
-    # Buscar aluno para verificar conquistas
-    aluno = await db.alunos.find_one({"id": evento.aluno_id})
-    if not aluno:
-        return {"pontos_adicionados": pontos, "novas_conquistas": [], "message": "Evento processado"}
-    
-    # Verificar conquistas
-    perfil = await db.pontuacao_alunos.find_one({"aluno_id": evento.aluno_id})
-    if not perfil:
-        perfil = await criar_perfil_gamificacao_inicial(evento.aluno_id)
-    
-    conquistas_desbloqueadas = await db.alunos_conquistas.find(
-        {"aluno_id": evento.aluno_id}
-    ).to_list(1000)
-    conquistas_ids_desbloqueadas = {c["conquista_id"] for c in conquistas_desbloqueadas}
-    
-    todas_conquistas = await db.conquistas.find({"ativo": True}).to_list(1000)
-    
-    novas_conquistas = []
-    
-    for conquista in todas_conquistas:
-        if conquista["id"] in conquistas_ids_desbloqueadas:
-            continue
-        
-        if perfil.get("nivel", 1) < conquista.get("nivel_minimo", 1):
-            continue
-        
-        prerequisitos = conquista.get("conquistas_prerequisitos", [])
-        if not all(p in conquistas_ids_desbloqueadas for p in prerequisitos):
-            continue
-        
-        if await verificar_criterio_conquista(evento.aluno_id, conquista.get("criterio", {})):
-            nova_conquista = await desbloquear_conquista(
-                evento.aluno_id, 
-                aluno.get("nome", "Aluno"), 
-                conquista
-            )
-            novas_conquistas.append(nova_conquista)
-            conquistas_ids_desbloqueadas.add(conquista["id"])
-    
+    agora = datetime.now(timezone.utc)
+    erros = [erro_timestamp_evento(evento, agora) for evento in eventos]
+    docs = iter(await enfileirar_eventos_gamificacao([e for e, erro in zip(eventos, erros) if not erro]))
+    respostas = [
+        resposta_evento_recusado(erro) if erro else resposta_evento_enfileirado(next(docs))
+        for erro in erros
+    ]
     return {
-        "pontos_adicionados": pontos,
-        "novas_conquistas": novas_conquistas,
-        "message": "Evento processado com sucesso"
+        "eventos": respostas,
+        "enfileirados": sum(1 for r in respostas if r["status"] != "recusado" and not r["duplicado"]),
+        "duplicados": sum(1 for r in respostas if r["duplicado"]),
+        "recusados": sum(1 for r in respostas if r["status"] == "recusado")
     }
 
+@api_router.get("/gamificacao/evento/{evento_id}")
+async def obter_evento_gamificacao(
+    evento_id: str,
+    current_user: User = Depends(get_current_user)
+):
+    """Status de processamento de um evento enfileirado."""
+    evento = await db.eventos_gamificacao.find_one({"id": evento_id}, {"_id": 0})
+    if not evento:
+        raise HTTPException(404, "Evento não encontrado")
+    return evento
+
+@api_router.get("/gamificacao/eventos/falhos")
+async def listar_eventos_falhos(
+    limit: int = 100,
+    current_user: User = Depends(get_current_user)
+):
+    """Eventos que esgotaram as tentativas (dead-letter)."""
+    if current_user.role != "admin":
+        raise HTTPException(403, "Apenas administradores podem consultar eventos falhos")
+    return await db.eventos_gamificacao.find(
+        {"status": "falhou"}, {"_id": 0}
+    ).sort("criado_em", 1).limit(limit).to_list(limit)
+
+@api_router.post("/gamificacao/eventos/falhos/reprocessar")
+async def reprocessar_eventos_falhos(
+    current_user: User = Depends(get_current_user)
+):
+    """Devolve os eventos falhos para a fila."""
+    if current_user.role != "admin":
+        raise HTTPException(403, "Apenas administradores podem reprocessar eventos")
+    result = await db.eventos_gamificacao.update_many(
+        {"status": "falhou"},
+        {"$set": {
+            "status": "pendente",
+            "tentativas": 0,
+            "proxima_tentativa": datetime.now(timezone.utc).isoformat()
+        }}
+    )
+    _gamificacao_sinal.set()
+    return {"reenfileirados": result.modified_count}
+
 @api_router.get("/gamificacao/estatisticas")
 async def obter_estatisticas_gamificacao(
     current_user: User = Depends(get_current_user)
 ):
     """Retorna estatísticas gerais do sistema de gamificação."""
+    doc = await db.estatisticas_gamificacao.find_one({"_id": ESTATISTICAS_ID})
+    if not doc or "reconciliado_em" not in doc:
+        doc = await reconciliar_estatisticas_gamificacao()
     
-    total_conquistas = await db.conquistas.count_documents({"ativo": True})
-    total_desbloqueadas = await db.alunos_conquistas.count_documents({})
+    total_conquistas = len(await catalogo_conquistas.obter())
+    return montar_estatisticas_gamificacao(doc, total_conquistas)
+
+@api_router.get("/gamificacao/estatisticas/historico")
+async def obter_historico_estatisticas_gamificacao(
+    dias: int = 30,
+    current_user: User = Depends(get_current_user)
+):
+    """Retratos diários das estatísticas (gravados a cada reconciliação)."""
+    inicio = (dia_local(datetime.now(timezone.utc)) - timedelta(days=dias)).isoformat()
+    return await db.estatisticas_gamificacao_diarias.find(
+        {"dia": {"$gte": inicio}}, {"_id": 0}
+    ).sort("dia", 1).to_list(dias + 1)
+
+@api_router.post("/gamificacao/estatisticas/reconciliar")
+async def reconciliar_estatisticas_endpoint(
+    current_user: User = Depends(get_current_user)
+):
+    """Recalcula as estatísticas imediatamente."""
+    if current_user.role != "admin":
+        raise HTTPException(403, "Apenas administradores podem reconciliar estatísticas")
+    doc = await reconciliar_estatisticas_gamificacao()
+    return montar_estatisticas_gamificacao(doc, len(await catalogo_conquistas.obter()))
+
+@api_router.post("/gamificacao/contadores/reconstruir")
+async def reconstruir_contadores_gamificacao(
+    current_user: User = Depends(get_current_user)
+):
+    """Reconstrói os contadores de todos os alunos a partir do histórico (em segundo plano)."""
+    if current_user.role != "admin":
+        raise HTTPException(403, "Apenas administradores podem reconstruir contadores")
     
-    # Top 5 conquistas mais desbloqueadas
-    pipeline_top = [
-        {"$group": {"_id": "$conquista_id", "count": {"$sum": 1}, "nome": {"$first": "$conquista_nome"}}},
-        {"$sort": {"count": -1}},
-        {"$limit": 5}
-    ]
-    top_conquistas = await db.alunos_conquistas.aggregate(pipeline_top).to_list(5)
+    return await iniciar_job_gamificacao("reconstruir_contadores", job_reconstruir_contadores)
+
+@api_router.post("/gamificacao/conquistas/backfill")
+async def backfill_conquistas(
+    request: BackfillConquistasRequest,
+    current_user: User = Depends(get_current_user)
+):
+    """Avalia conquistas (novas ou todas) para todos os alunos, em segundo plano."""
+    if current_user.role != "admin":
+        raise HTTPException(403, "Apenas administradores podem executar o backfill de conquistas")
+    
+    if request.conquista_ids:
+        ativas = await db.conquistas.distinct("id", {"id": {"$in": request.conquista_ids}, "ativo": True})
+        invalidas = [cid for cid in request.conquista_ids if cid not in set(ativas)]
+        if invalidas:
+            raise HTTPException(400, f"Conquistas inexistentes ou inativas: {', '.join(invalidas)}")
+    
+    return await iniciar_job_gamificacao(
+        "backfill_conquistas",
+        lambda job_id: job_backfill_conquistas(job_id, request.conquista_ids),
+        {"conquista_ids": request.conquista_ids}
+    )
+
+class AvaliarCriterioRequest(BaseModel):
+    criterio: dict
+    aluno_id: Optional[str] = None  # sem aluno: avalia todos os alunos de uma vez
+
+@api_router.post("/gamificacao/criterios/avaliar")
+async def avaliar_criterio_endpoint(
+    request: AvaliarCriterioRequest,
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Testa um critério antes de salvar a conquista.
     
-    # Média de pontos por aluno
-    pipeline_media = [
-        {"$group": {"_id": None, "media": {"$avg": "$pontos_totais"}}}
+    Com aluno_id, diz se ele atende; sem aluno_id, conta quantos alunos
+    atendem (apenas as folhas de agregação são avaliadas nesse modo).
+    """
+    if current_user.role != "admin":
+        raise HTTPException(403, "Apenas administradores podem avaliar critérios")
+    validar_criterio(request.criterio)
+    
+    if request.aluno_id:
+        return {
+            "aluno_id": request.aluno_id,
+            "atende": await verificar_criterio_conquista(request.aluno_id, request.criterio)
+        }
+    
+    agregacoes = await calcular_agregacoes([request.criterio], None)
+    alunos = [
+        aluno_id for aluno_id, valores in agregacoes.items()
+        if avaliar_criterio(request.criterio, {"agregacoes": valores})
     ]
-    media_result = await db.pontuacao_alunos.aggregate(pipeline_media).to_list(1)
-    media_pontos = media_result[0]["media"] if media_result else 0
+    return {"total_alunos": len(alunos), "amostra": alunos[:20]}
+
+@api_router.post("/gamificacao/sequencias/reconstruir")
+async def reconstruir_sequencias_gamificacao(
+    current_user: User = Depends(get_current_user)
+):
+    """Reconstrói as sequências de check-in de todos os alunos a partir do histórico (em segundo plano)."""
+    if current_user.role != "admin":
+        raise HTTPException(403, "Apenas administradores podem reconstruir sequências")
     
-    alunos_participando = await db.pontuacao_alunos.count_documents({"pontos_totais": {"$gt": 0}})
+    return await iniciar_job_gamificacao("reconstruir_sequencias", reconstruir_sequencias_checkins)
+
+@api_router.post("/gamificacao/segmentos/reconstruir")
+async def reconstruir_segmentos_gamificacao(
+    current_user: User = Depends(get_current_user)
+):
+    """Recalcula a participação de todos os alunos nos segmentos de ranking (em segundo plano)."""
+    if current_user.role != "admin":
+        raise HTTPException(403, "Apenas administradores podem reconstruir segmentos")
     
-    return {
-        "total_conquistas": total_conquistas,
-        "total_desbloqueadas": total_desbloqueadas,
-        "top_conquistas": top_conquistas,
-        "media_pontos_por_aluno": round(media_pontos, 2) if media_pontos else 0,
-        "alunos_participando": alunos_participando
-    }
+    return await iniciar_job_gamificacao("reconstruir_segmentos", job_reconstruir_segmentos)
+
+@api_router.get("/gamificacao/jobs/{job_id}")
+async def obter_job_gamificacao(
+    job_id: str,
+    current_user: User = Depends(get_current_user)
+):
+    """Retorna o status de um job de manutenção da gamificação."""
+    job = await db.jobs_gamificacao.find_one({"id": job_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(404, "Job não encontrado")
+    return job
 
 @api_router.post("/gamificacao/aluno/{aluno_id}/marcar-notificacao-vista")
 async def marcar_notificacoes_vistas(
@@ -3432,6 +7637,54 @@ async def marcar_notificacoes_vistas(
     )
     return {"message": "Notificações marcadas como vistas"}
 
+@api_router.post("/gamificacao/aluno/{aluno_id}/notificacoes/token")
+async def criar_token_notificacoes(
+    aluno_id: str,
+    current_user: User = Depends(get_current_user)
+):
+    """Token de curta duração para abrir o stream de notificações do aluno."""
+    return {"token": criar_token_stream(aluno_id), "expira_em_segundos": STREAM_TOKEN_EXPIRE_SECONDS}
+
+@api_router.get("/gamificacao/aluno/{aluno_id}/notificacoes/stream")
+async def stream_notificacoes_aluno(aluno_id: str, token: str, request: Request):
+    """
+    Stream SSE com conquistas desbloqueadas e subidas de nível do aluno.
+    
+    EventSource não envia cabeçalhos: o parâmetro `token` é o token curto de
+    POST .../notificacoes/token (nunca o JWT de login, que ficaria em logs de
+    acesso e no histórico). Ao conectar, as conquistas ainda não visualizadas
+    são reenviadas; o cliente deduplica pelo `id` do evento.
+    """
+    validar_token_stream(token, aluno_id)
+    
+    async def gerar():
+        # Assina só quando o stream começa (cliente que cai antes não deixa fila órfã),
+        # e antes de ler as pendentes para não perder desbloqueios nesse intervalo
+        fila = barramento_notificacoes.assinar(aluno_id)
+        try:
+            pendentes = await db.alunos_conquistas.find(
+                {"aluno_id": aluno_id, "visualizado": False}, {"_id": 0}
+            ).to_list(100)
+            for registro in pendentes:
+                yield formatar_evento_sse(notificacao_conquista(registro))
+            while True:
+                try:
+                    notificacao = await asyncio.wait_for(fila.get(), timeout=NOTIFICACOES_HEARTBEAT_SEGUNDOS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": ping\n\n"
+                    continue
+                yield formatar_evento_sse(notificacao)
+        finally:
+            barramento_notificacoes.cancelar(aluno_id, fila)
+    
+    return StreamingResponse(
+        gerar(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @api_router.get("/gamificacao/aluno/{aluno_id}/conquistas-pendentes")
 async def obter_conquistas_pendentes(
     aluno_id: str,
@@ -3443,6 +7696,34 @@ async def obter_conquistas_pendentes(
     ).to_list(100)
     return conquistas
 
+# Include router (depois de todas as rotas, inclusive as de gamificação)
+app.include_router(api_router)
+
+@app.on_event("startup")
+async def iniciar_workers_whatsapp():
+    global provedor_whatsapp
+    provedor_whatsapp = criar_provedor_whatsapp()
+    for indice in range(WHATSAPP_WORKERS):
+        _whatsapp_workers.append(asyncio.create_task(worker_whatsapp(indice)))
+    logger.info(f"{WHATSAPP_WORKERS} workers de WhatsApp iniciados (provedor: {WHATSAPP_PROVEDOR})")
+
+@app.on_event("startup")
+async def iniciar_workers_gamificacao():
+    for indice in range(GAMIFICACAO_WORKERS):
+        _gamificacao_workers.append(asyncio.create_task(worker_gamificacao(indice)))
+    logger.info(f"{GAMIFICACAO_WORKERS} workers de gamificação iniciados")
+    global _estatisticas_tarefa, _notificacoes_tarefa
+    _estatisticas_tarefa = asyncio.create_task(loop_reconciliacao_estatisticas())
+    if NOTIFICACOES_CHANGE_STREAM:
+        _notificacoes_tarefa = asyncio.create_task(escutar_notificacoes_change_stream())
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for tarefa in _whatsapp_workers + _gamificacao_workers:
+        tarefa.cancel()
+    for tarefa in (_estatisticas_tarefa, _notificacoes_tarefa):
+        if tarefa is not None:
+            tarefa.cancel()
+    if _pdf_executor is not None:
+        _pdf_executor.shutdown(wait=False, cancel_futures=True)
     client.close()
@@ -1,14 +1,19 @@
 import React, { useEffect, useState } from 'react';
-import { X, Trophy, Sparkles } from 'lucide-react';
+import { X, Trophy, Sparkles, TrendingUp } from 'lucide-react';
 import { useAuth } from '../contexts/AuthContext';
-import api from '../api/axios';
+import api, { API } from '../api/axios';
+
+const RECONEXAO_MS = 3000;
 
 /**
  * ConquistaNotificacao - Componente de Notificação de Conquistas
  * 
- * Exibe uma notificação toast quando o aluno desbloqueia uma nova conquista.
- * Busca periodicamente por conquistas não visualizadas e as exibe em destaque.
+ * Exibe uma notificação toast quando o aluno desbloqueia uma nova conquista
+ * ou sobe de nível. Os eventos chegam por SSE (EventSource); cada conexão usa
+ * um token curto pedido à API e, ao conectar, o servidor reenvia as
+ * conquistas não visualizadas.
  */
+
 const ConquistaNotificacao = () => {
     const [conquistas, setConquistas] = useState([]);
     const [currentIndex, setCurrentIndex] = useState(0);
@@ -16,30 +21,61 @@ const ConquistaNotificacao = () => {
     const { user } = useAuth();
 
     useEffect(() => {
-        if (user?.id) {
-            checkConquistas();
-            // Verificar a cada 30 segundos
-            const interval = setInterval(checkConquistas, 30000);
-            return () => clearInterval(interval);
-        }
-    }, [user?.id]);
+        if (!user?.id) return undefined;
 
-    const checkConquistas = async () => {
-        try {
-            const response = await api.get(`/gamificacao/aluno/${user.id}/conquistas-pendentes`);
-            if (response.data && response.data.length > 0) {
-                setConquistas(response.data);
-                setIsVisible(true);
+        let source = null;
+        let reconexao = null;
+        let encerrado = false;
+        const adicionar = (item) => {
+            // Reconexões reenviam pendentes: deduplicar pelo id do evento
+            setConquistas((atuais) => (
+                atuais.some((atual) => atual.id === item.id) ? atuais : [...atuais, item]
+            ));
+            setIsVisible(true);
+        };
+        const agendarReconexao = () => {
+            if (!encerrado) reconexao = setTimeout(conectar, RECONEXAO_MS);
+        };
+        // O stream recebe um token curto (vai na URL); cada conexão pede um novo
+        const conectar = async () => {
+            let token;
+            try {
+                const response = await api.post(`/gamificacao/aluno/${user.id}/notificacoes/token`);
+                token = response.data.token;
+            } catch (error) {
+                agendarReconexao();
+                return;
             }
-        } catch (error) {
-            // Silenciar erros - feature opcional
-        }
-    };
+            if (encerrado) return;
+            source = new EventSource(
+                `${API}/gamificacao/aluno/${user.id}/notificacoes/stream?token=${encodeURIComponent(token)}`
+            );
+            source.addEventListener('conquista', (event) => {
+                const notificacao = JSON.parse(event.data);
+                adicionar({ ...notificacao.dados, tipo: 'conquista' });
+            });
+            source.addEventListener('nivel', (event) => {
+                const notificacao = JSON.parse(event.data);
+                adicionar({ ...notificacao.dados, id: notificacao.id, tipo: 'nivel' });
+            });
+            // A reconexão automática do EventSource reusaria o token vencido
+            source.onerror = () => {
+                source.close();
+                agendarReconexao();
+            };
+        };
+        conectar();
+        return () => {
+            encerrado = true;
+            clearTimeout(reconexao);
+            if (source) source.close();
+        };
+    }, [user?.id]);
 
     const handleDismiss = async () => {
         // Marcar como visualizada
         try {
-            if (conquistas[currentIndex]) {
+            if (conquistas[currentIndex]?.tipo === 'conquista') {
                 await api.post(`/gamificacao/aluno/${user.id}/marcar-notificacao-vista`, [
                     conquistas[currentIndex].conquista_id
                 ]);
@@ -61,6 +97,7 @@ const ConquistaNotificacao = () => {
     if (!isVisible || conquistas.length === 0) return null;
 
     const conquista = conquistas[currentIndex];
+    const subiuNivel = conquista.tipo === 'nivel';
 
     return (
         <div className="fixed bottom-4 right-4 z-50 animate-slideIn">
@@ -70,10 +107,14 @@ const ConquistaNotificacao = () => {
                     <div className="flex items-start justify-between mb-4">
                         <div className="flex items-center gap-2">
                             <div className="bg-yellow-100 p-2 rounded-full">
-                                <Trophy className="h-5 w-5 text-yellow-600" />
+                                {subiuNivel ? (
+                                    <TrendingUp className="h-5 w-5 text-yellow-600" />
+                                ) : (
+                                    <Trophy className="h-5 w-5 text-yellow-600" />
+                                )}
                             </div>
                             <span className="text-sm font-medium text-yellow-600">
-                                Conquista Desbloqueada!
+                                {subiuNivel ? 'Novo Nível!' : 'Conquista Desbloqueada!'}
                             </span>
                         </div>
                         <button
@@ -85,30 +126,42 @@ const ConquistaNotificacao = () => {
                     </div>
 
                     {/* Conteúdo */}
-                    <div className="text-center py-4">
-                        <div className="text-6xl mb-3 animate-bounce">
-                            {conquista.conquista_icone}
+                    {subiuNivel ? (
+                        <div className="text-center py-4">
+                            <div className="text-6xl mb-3 animate-bounce">⬆️</div>
+                            <h3 className="text-xl font-bold text-gray-900 mb-1">
+                                Nível {conquista.nivel}
+                            </h3>
+                            <p className="text-sm text-gray-500">
+                                {conquista.xp_atual} / {conquista.xp_proximo_nivel} XP para o próximo nível
+                            </p>
                         </div>
-                        <h3 className="text-xl font-bold text-gray-900 mb-1">
-                            {conquista.conquista_nome}
-                        </h3>
-                        <div className="flex items-center justify-center gap-3 mt-3">
-                            <span className="bg-yellow-100 text-yellow-700 px-3 py-1 rounded-full text-sm font-medium">
-                                +{conquista.pontos_ganhos} pontos
-                            </span>
-                            {conquista.xp_ganhos > 0 && (
-                                <span className="bg-purple-100 text-purple-700 px-3 py-1 rounded-full text-sm font-medium flex items-center gap-1">
-                                    <Sparkles className="h-3 w-3" />
-                                    +{conquista.xp_ganhos} XP
+                    ) : (
+                        <div className="text-center py-4">
+                            <div className="text-6xl mb-3 animate-bounce">
+                                {conquista.conquista_icone}
+                            </div>
+                            <h3 className="text-xl font-bold text-gray-900 mb-1">
+                                {conquista.conquista_nome}
+                            </h3>
+                            <div className="flex items-center justify-center gap-3 mt-3">
+                                <span className="bg-yellow-100 text-yellow-700 px-3 py-1 rounded-full text-sm font-medium">
+                                    +{conquista.pontos_ganhos} pontos
                                 </span>
-                            )}
+                                {conquista.xp_ganhos > 0 && (
+                                    <span className="bg-purple-100 text-purple-700 px-3 py-1 rounded-full text-sm font-medium flex items-center gap-1">
+                                        <Sparkles className="h-3 w-3" />
+                                        +{conquista.xp_ganhos} XP
+                                    </span>
+                                )}
+                            </div>
                         </div>
-                    </div>
+                    )}
 
                     {/* Footer com contador */}
                     {conquistas.length > 1 && (
                         <div className="text-center text-sm text-gray-500 pt-2 border-t">
-                            {currentIndex + 1} de {conquistas.length} conquistas
+                            {currentIndex + 1} de {conquistas.length} notificações
                         </div>
                     )}
 
@@ -117,7 +170,7 @@ const ConquistaNotificacao = () => {
                         onClick={handleDismiss}
                         className="w-full mt-4 bg-gradient-to-r from-yellow-400 to-orange-500 text-white py-2 rounded-lg font-medium hover:from-yellow-500 hover:to-orange-600 transition-all"
                     >
-                        {currentIndex < conquistas.length - 1 ? 'Próxima Conquista →' : 'Fechar'}
+                        {currentIndex < conquistas.length - 1 ? 'Próxima →' : 'Fechar'}
                     </button>
                 </div>
             </div>
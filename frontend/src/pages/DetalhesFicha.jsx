@@ -30,18 +30,16 @@ const DetalhesFicha = () => {
       });
       setFicha(response.data);
       
-      // Fetch exercise details
-      const exerciciosIds = response.data.exercicios.map(e => e.exercicio_id);
+      // Exercise details come hydrated in the ficha response
       const detalhes = {};
-      for (const exId of exerciciosIds) {
-        try {
-          const exRes = await axios.get(`${API_URL}/api/exercicios/${exId}`, {
-            headers: { Authorization: `Bearer ${token}` }
-          });
-          detalhes[exId] = exRes.data;
-        } catch (e) {
-          console.error(`Erro ao buscar exercício ${exId}`);
-        }
+      for (const ex of response.data.exercicios) {
+        detalhes[ex.exercicio_id] = {
+          nome: ex.exercicio_nome,
+          grupo_muscular: ex.grupo_muscular,
+          equipamento: ex.equipamento,
+          video_url: ex.video_url,
+          imagem_url: ex.imagem_url
+        };
       }
       setExerciciosDetalhes(detalhes);
     } catch (error) {
@@ -24,6 +24,7 @@ const RegistrarTreino = () => {
   const [fichas, setFichas] = useState([]);
   const [selectedFicha, setSelectedFicha] = useState(null);
   const [exerciciosDetalhes, setExerciciosDetalhes] = useState({});
+  const [recomendacoes, setRecomendacoes] = useState({});
   
   // Timer
   const [timerRunning, setTimerRunning] = useState(false);
@@ -70,33 +71,42 @@ const RegistrarTreino = () => {
 
   const fetchFichaDetalhes = async (id) => {
     try {
-      const response = await axios.get(`${API_URL}/api/fichas/${id}`, {
-        headers: { Authorization: `Bearer ${token}` }
-      });
+      const headers = { Authorization: `Bearer ${token}` };
+      const [response, recomendacoesRes] = await Promise.all([
+        axios.get(`${API_URL}/api/fichas/${id}`, { headers }),
+        // Suggestions are optional: the form still works without them
+        axios.get(`${API_URL}/api/fichas/${id}/recomendacoes`, { headers }).catch(() => null)
+      ]);
       setSelectedFicha(response.data);
       setAlunoId(response.data.aluno_id);
       
-      // Fetch exercise details and initialize form
+      const sugestoes = {};
+      for (const rec of recomendacoesRes?.data?.recomendacoes || []) {
+        sugestoes[rec.exercicio_id] = rec;
+      }
+      setRecomendacoes(sugestoes);
+      
+      // Exercise details come hydrated in the ficha response; initialize form
       const detalhes = {};
       const realizados = [];
       
       for (const ex of response.data.exercicios) {
-        try {
-          const exRes = await axios.get(`${API_URL}/api/exercicios/${ex.exercicio_id}`, {
-            headers: { Authorization: `Bearer ${token}` }
-          });
-          detalhes[ex.exercicio_id] = exRes.data;
-        } catch (e) {
-          console.error(`Erro ao buscar exercício ${ex.exercicio_id}`);
-        }
+        detalhes[ex.exercicio_id] = {
+          nome: ex.exercicio_nome,
+          grupo_muscular: ex.grupo_muscular,
+          equipamento: ex.equipamento,
+          video_url: ex.video_url,
+          imagem_url: ex.imagem_url
+        };
         
-        // Initialize series
+        // Initialize series, prefilled with the suggested load/reps when available
+        const sugestao = sugestoes[ex.exercicio_id];
         const series = [];
         for (let i = 1; i <= ex.series; i++) {
           series.push({
             numero_serie: i,
-            repeticoes: parseInt(ex.repeticoes.split('-')[0]) || 10,
-            carga: parseFloat(ex.carga) || 0,
+            repeticoes: sugestao?.repeticoes_sugeridas ?? (parseInt(ex.repeticoes.split('-')[0]) || 10),
+            carga: sugestao?.carga_sugerida ?? (parseFloat(ex.carga) || 0),
             concluida: false
           });
         }
@@ -270,6 +280,7 @@ const RegistrarTreino = () => {
             {exerciciosRealizados.map((ex, exIndex) => {
               const detalhe = exerciciosDetalhes[ex.exercicio_id];
               const fichaEx = selectedFicha.exercicios[exIndex];
+              const sugestao = recomendacoes[ex.exercicio_id];
               
               return (
                 <div 
@@ -293,6 +304,12 @@ const RegistrarTreino = () => {
                       <p className="text-sm text-gray-500">
                         {fichaEx?.series}x{fichaEx?.repeticoes} • {fichaEx?.carga || 'Livre'} • Descanso: {fichaEx?.descanso || '60s'}
                       </p>
+                      {sugestao?.carga_sugerida != null && (
+                        <p className="text-xs text-blue-600">
+                          Sugestão: {sugestao.carga_sugerida} kg
+                          {sugestao.repeticoes_sugeridas ? ` x ${sugestao.repeticoes_sugeridas}` : ''} • {sugestao.motivo}
+                        </p>
+                      )}
                     </div>
                     {ex.realizado && <Check className="text-green-600" size={24} />}
                   </div>
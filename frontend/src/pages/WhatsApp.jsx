@@ -56,7 +56,11 @@ const WhatsApp = () => {
     }
 
     try {
-      await api.post('/whatsapp/enviar', formData);
+      // Todos os alunos ativos selecionados: o servidor expande o segmento
+      const payload = formData.destinatarios.length === alunos.length
+        ? { mensagem: formData.mensagem, segmento: { status: 'ativo' } }
+        : formData;
+      await api.post('/whatsapp/enviar', payload);
       setSuccess(`Mensagem enviada para ${formData.destinatarios.length} aluno(s)!`);
       await loadData();
       setDialogOpen(false);
@@ -207,7 +211,7 @@ const WhatsApp = () => {
                 <div className="flex items-start justify-between mb-2">
                   <div className="flex items-center gap-2">
                     <MessageSquare className="h-5 w-5 text-green-600" />
-                    <span className="font-medium">{msg.destinatarios.length} destinatário(s)</span>
+                    <span className="font-medium">{msg.total_destinatarios || msg.destinatarios.length} destinatário(s)</span>
                   </div>
                   <div className="flex items-center gap-2 text-sm text-gray-500">
                     <Clock className="h-4 w-4" />
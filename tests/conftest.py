@@ -0,0 +1,48 @@
+import os
+import sys
+from pathlib import Path
+
+import mongomock.collection
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+# server.py lê a configuração do ambiente na importação; o cliente real nunca conecta
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "testes")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+# mongomock relê o documento pelo _id depois do update: com projeção {"_id": 0} e
+# ReturnDocument.AFTER devolve None. O MongoDB real não tem esse problema.
+_find_one_and_update = mongomock.collection.Collection.find_one_and_update
+
+
+def _find_one_and_update_sem_id(self, filter, update, *args, projection=None, **kwargs):
+    documento = _find_one_and_update(self, filter, update, *args, **kwargs)
+    if documento is None or projection is None:
+        return documento
+    campos = {campo for campo, incluir in projection.items() if incluir and campo != "_id"}
+    if campos:
+        documento = {campo: valor for campo, valor in documento.items() if campo in campos or campo == "_id"}
+    else:
+        documento = {campo: valor for campo, valor in documento.items() if projection.get(campo, 1)}
+    if projection.get("_id", 1) == 0:
+        documento.pop("_id", None)
+    return documento
+
+
+mongomock.collection.Collection.find_one_and_update = _find_one_and_update_sem_id
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """Banco em memória (mongomock-motor) no lugar do MongoDB do servidor."""
+    banco = AsyncMongoMockClient()["testes"]
+    monkeypatch.setattr(server, "db", banco)
+    return banco
@@ -0,0 +1,17 @@
+import os
+
+import contratos_pdf
+
+
+def test_limpar_cache_remove_os_menos_usados(tmp_path):
+    for i in range(4):
+        arquivo = tmp_path / f"{i}.pdf"
+        arquivo.write_bytes(b"%PDF")
+        os.utime(arquivo, (1000 + i, 1000 + i))
+    (tmp_path / "x.123.tmp").write_bytes(b"")
+    # Acerto no cache renova o mais antigo
+    os.utime(tmp_path / "0.pdf", (2000, 2000))
+
+    assert contratos_pdf.limpar_cache(str(tmp_path), 2) == 2
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["0.pdf", "3.pdf", "x.123.tmp"]
+    assert contratos_pdf.limpar_cache(str(tmp_path), 2) == 0
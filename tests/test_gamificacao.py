@@ -0,0 +1,395 @@
+import asyncio
+from datetime import date, datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+import server
+
+
+# ==================== NÍVEIS ====================
+
+def test_nivel_por_xp_abaixo_do_primeiro_limiar():
+    assert server.nivel_por_xp(0) == 1
+    assert server.nivel_por_xp(server.xp_para_nivel(1) - 1) == 1
+
+
+@pytest.mark.parametrize("nivel", range(1, 40))
+def test_nivel_por_xp_na_fronteira(nivel):
+    limiar = server.xp_para_nivel(nivel)
+    assert server.nivel_por_xp(limiar - 1) == nivel
+    assert server.nivel_por_xp(limiar) == nivel + 1
+
+
+def test_nivel_por_xp_limitado_a_100():
+    assert server.nivel_por_xp(10 ** 30) == 100
+
+
+# ==================== CRITÉRIOS ====================
+
+def test_avaliar_criterio_simples():
+    stats = {"checkins_total": 10, "pagamentos_em_dia": 0}
+    assert server.avaliar_criterio({"tipo": "checkins_total", "quantidade": 10}, stats)
+    assert not server.avaliar_criterio({"tipo": "checkins_total", "quantidade": 11}, stats)
+    assert not server.avaliar_criterio({"tipo": "pagamentos_dia", "quantidade": 0}, stats)
+    assert not server.avaliar_criterio({"tipo": "easter_egg"}, stats)
+
+
+def test_avaliar_criterio_combinadores():
+    stats = {"checkins_total": 5, "treinos_total": 1}
+    checkins = {"tipo": "checkins_total", "quantidade": 5}
+    treinos = {"tipo": "treinos_total", "quantidade": 3}
+    assert not server.avaliar_criterio({"tipo": "e", "criterios": [checkins, treinos]}, stats)
+    assert server.avaliar_criterio({"tipo": "ou", "criterios": [checkins, treinos]}, stats)
+    assert not server.avaliar_criterio({"tipo": "e", "criterios": []}, stats)
+
+
+def test_avaliar_criterio_agregacao_usa_a_chave_compilada():
+    criterio = {"tipo": "agregacao", "colecao": "checkins", "operacao": "dias_distintos", "minimo": 3}
+    chave = server.compilar_folha(criterio)["chave"]
+    assert server.avaliar_criterio(criterio, {"agregacoes": {chave: 3}})
+    assert not server.avaliar_criterio(criterio, {"agregacoes": {chave: 2}})
+    assert not server.avaliar_criterio(criterio, {})
+
+
+def test_compilar_folha_reaproveita_criterios_iguais():
+    a = {"tipo": "agregacao", "colecao": "registros_treino", "operacao": "contar", "minimo": 1, "janela": "mes_atual"}
+    b = {"janela": "mes_atual", "minimo": 1, "operacao": "contar", "colecao": "registros_treino", "tipo": "agregacao"}
+    assert server.compilar_folha(a) is server.compilar_folha(b)
+    assert server.compilar_folha(a)["campo_data"] == "data_treino"
+
+
+def test_compilar_folha_operacoes():
+    base = {"tipo": "agregacao", "colecao": "pagamentos", "minimo": 1}
+    somar = server.compilar_folha({**base, "operacao": "somar", "campo": "valor"})
+    assert somar["grupo"] == [{"$group": {"_id": "$aluno_id", "valor": {"$sum": "$valor"}}}]
+    distintos = server.compilar_folha({**base, "operacao": "dias_distintos"})
+    assert len(distintos["grupo"]) == 2
+    assert distintos["grupo"][0]["$group"]["_id"]["dia"] == {"$substr": ["$data_pagamento", 0, 10]}
+
+
+def test_compilar_folha_ignora_o_limiar():
+    base = {"tipo": "agregacao", "colecao": "checkins", "operacao": "contar", "janela": "semana_atual"}
+    assert server.compilar_folha({**base, "minimo": 3}) is server.compilar_folha({**base, "minimo": 5})
+    assert server.chave_folha({**base, "minimo": 3}) != server.chave_folha({**base, "janela": "mes_atual"})
+
+
+def test_compilar_folha_dias_distintos_no_fuso_local():
+    compilado = server.compilar_folha({"tipo": "agregacao", "colecao": "checkins", "operacao": "dias_distintos"})
+    dia = compilado["grupo"][0]["$group"]["_id"]["dia"]
+    assert dia["$dateToString"]["timezone"] == server.FUSO_GAMIFICACAO
+    assert dia["$dateToString"]["date"] == {"$toDate": "$data_hora"}
+
+
+def test_pipeline_criterio_janela_comeca_na_meia_noite_local():
+    checkins = server.compilar_folha({"tipo": "agregacao", "colecao": "checkins", "operacao": "contar", "janela": "mes_atual"})
+    pagamentos = server.compilar_folha({"tipo": "agregacao", "colecao": "pagamentos", "operacao": "contar", "janela": "mes_atual"})
+    inicio = server.dia_local(datetime.now(timezone.utc)).replace(day=1)
+
+    match = server.pipeline_criterio(checkins, ["a1"])[0]["$match"]
+    assert match["$and"][1] == {"data_hora": {"$gte": server.inicio_dia_local_utc(inicio).isoformat()}}
+    assert server.inicio_dia_local_utc(date(2026, 3, 1)).isoformat() == "2026-03-01T03:00:00+00:00"
+    assert server.pipeline_criterio(pagamentos, None)[0]["$match"] == {"data_pagamento": {"$gte": inicio.isoformat()}}
+
+
+def test_compilar_folha_cache_limitado(monkeypatch):
+    monkeypatch.setattr(server, "CRITERIOS_COMPILADOS_MAX", 3)
+    for dias in range(1, 10):
+        server.compilar_folha({"tipo": "agregacao", "colecao": "checkins", "operacao": "contar", "janela_dias": dias})
+    assert len(server._criterios_compilados) == 3
+
+
+def test_contar_pagamentos_em_dia_para_no_primeiro_atraso():
+    pagamentos = [
+        {"data_pagamento": "2026-03-05", "data_vencimento": "2026-03-10"},
+        {"data_pagamento": "2026-02-10", "data_vencimento": "2026-02-10"},
+        {"data_pagamento": "2026-01-15", "data_vencimento": "2026-01-10"},
+        {"data_pagamento": "2025-12-01", "data_vencimento": "2025-12-10"},
+    ]
+    assert server.contar_pagamentos_em_dia(pagamentos) == 2
+
+
+# ==================== ENFILEIRAMENTO ====================
+
+@pytest.mark.anyio
+async def test_lote_recusa_so_os_eventos_fora_do_prazo(db):
+    agora = datetime.now(timezone.utc)
+    usuario = server.User(email="admin@teste.com", nome="Admin", role="admin")
+    eventos = [
+        server.EventoGamificacao(tipo_evento="checkin", aluno_id="a1", timestamp=agora - timedelta(days=30)),
+        server.EventoGamificacao(tipo_evento="checkin", aluno_id="a1", timestamp=agora - timedelta(hours=1)),
+        server.EventoGamificacao(tipo_evento="checkin", aluno_id="a1", timestamp=agora + timedelta(hours=1)),
+    ]
+
+    resposta = await server.processar_eventos_gamificacao_lote(eventos, current_user=usuario)
+
+    assert [e["status"] for e in resposta["eventos"]] == ["recusado", "pendente", "recusado"]
+    assert resposta["eventos"][0]["erro"].startswith("timestamp anterior")
+    assert resposta["eventos"][2]["erro"] == "timestamp no futuro"
+    assert (resposta["enfileirados"], resposta["duplicados"], resposta["recusados"]) == (1, 0, 2)
+    gravado = await db.eventos_gamificacao.find_one({}, {"_id": 0})
+    assert gravado["id"] == resposta["eventos"][1]["evento_id"]
+    assert await db.eventos_gamificacao.count_documents({}) == 1
+
+
+# ==================== BACKFILL ====================
+
+@pytest.mark.anyio
+async def test_backfill_recusa_conquistas_inativas_ou_desconhecidas(db):
+    usuario = server.User(email="admin@teste.com", nome="Admin", role="admin")
+    await db.conquistas.insert_many([{"id": "c1", "ativo": True}, {"id": "c2", "ativo": False}])
+
+    with pytest.raises(server.HTTPException) as erro:
+        await server.backfill_conquistas(
+            server.BackfillConquistasRequest(conquista_ids=["c1", "c2", "c3"]), current_user=usuario
+        )
+    assert erro.value.status_code == 400
+    assert erro.value.detail.endswith("c2, c3")
+
+
+@pytest.mark.anyio
+async def test_backfill_registra_conquista_desativada_antes_da_execucao(db):
+    await db.conquistas.insert_many([
+        {"id": "c1", "ativo": True, "nivel_minimo": 100},
+        {"id": "c2", "ativo": False},
+    ])
+
+    resultado = await server.job_backfill_conquistas("job1", ["c1", "c2"])
+
+    # nivel_minimo não limita o backfill: o catálogo inteiro é avaliado
+    assert resultado["conquistas_avaliadas"] == 1
+    assert resultado["conquistas_ignoradas"] == ["c2"]
+
+
+# ==================== JANELAS ====================
+
+def test_janelas_usam_o_dia_local():
+    # 01:30 UTC de 1º de março ainda é 28 de fevereiro em São Paulo
+    quando = datetime(2026, 3, 1, 1, 30, tzinfo=timezone.utc)
+    assert server.chave_mes(quando) == "2026-02"
+    assert server.chave_semana(quando) == "2026-W09"
+    assert server.chave_mes(date(2026, 3, 1)) == "2026-03"
+    assert server.intervalo_janela("mes_atual", quando) == ("2026-02-01", "2026-02-28")
+
+
+class MadrugadaDePrimeiroDeMarco(datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return cls(2026, 3, 1, 1, 30, tzinfo=timezone.utc)
+
+
+@pytest.mark.anyio
+async def test_retrato_diario_usa_o_dia_local(db, monkeypatch):
+    monkeypatch.setattr(server, "datetime", MadrugadaDePrimeiroDeMarco)
+
+    await server.reconciliar_estatisticas_gamificacao()
+
+    retrato = await db.estatisticas_gamificacao_diarias.find_one({}, {"_id": 0})
+    assert retrato["dia"] == "2026-02-28"
+
+
+# ==================== FILA DE EVENTOS ====================
+
+def evento(id_: str, minuto: int, **campos) -> dict:
+    criado_em = datetime(2026, 1, 1, 12, minuto, tzinfo=timezone.utc).isoformat()
+    return {
+        "id": id_,
+        "aluno_id": "a1",
+        "tipo_evento": "checkin",
+        "dados_evento": {},
+        "timestamp": criado_em,
+        "criado_em": criado_em,
+        "status": "pendente",
+        "tentativas": 0,
+        "proxima_tentativa": criado_em,
+        **campos
+    }
+
+
+@pytest.fixture
+def aplicados(monkeypatch):
+    """Substitui a aplicação dos eventos; registra os lotes e falha se `falhar` for True."""
+    lotes = []
+
+    async def aplicar(aluno_id, eventos):
+        lotes.append([e["id"] for e in eventos])
+        if aplicar.falhar:
+            raise RuntimeError("falha simulada")
+        return []
+
+    aplicar.falhar = False
+    aplicar.lotes = lotes
+    monkeypatch.setattr(server, "aplicar_eventos_gamificacao", aplicar)
+    return aplicar
+
+
+async def status_eventos(db) -> dict:
+    return {e["id"]: e async for e in db.eventos_gamificacao.find({}, {"_id": 0})}
+
+
+@pytest.mark.anyio
+async def test_processar_eventos_em_ordem_de_criacao(db, aplicados):
+    await db.eventos_gamificacao.insert_many([evento("e3", 3), evento("e1", 1), evento("e2", 2)])
+
+    assert await server.processar_eventos_aluno("a1") == 3
+
+    assert aplicados.lotes == [["e1", "e2", "e3"]]
+    eventos = await status_eventos(db)
+    assert {e["status"] for e in eventos.values()} == {"processado"}
+    assert eventos["e3"]["conquistas_desbloqueadas"] == []
+
+
+@pytest.mark.anyio
+async def test_evento_aguardando_retentativa_bloqueia_os_seguintes(db, aplicados):
+    futuro = (datetime.now(timezone.utc) + timedelta(minutes=5)).isoformat()
+    await db.eventos_gamificacao.insert_many([
+        evento("e1", 1),
+        evento("e2", 2, tentativas=1, proxima_tentativa=futuro),
+        evento("e3", 3),
+    ])
+
+    assert await server.processar_eventos_aluno("a1") == 1
+
+    assert aplicados.lotes == [["e1"]]
+    eventos = await status_eventos(db)
+    assert eventos["e2"]["status"] == "pendente"
+    assert eventos["e3"]["status"] == "pendente"
+
+
+@pytest.mark.anyio
+async def test_falha_reagenda_com_backoff_e_segura_os_posteriores(db, aplicados, monkeypatch):
+    monkeypatch.setattr(server, "GAMIFICACAO_LOTE_EVENTOS", 1)
+    await db.eventos_gamificacao.insert_many([evento("e1", 1, tentativas=2), evento("e2", 2)])
+    aplicados.falhar = True
+
+    antes = datetime.now(timezone.utc)
+    assert await server.processar_eventos_aluno("a1") == 0
+
+    eventos = await status_eventos(db)
+    falho = eventos["e1"]
+    assert falho["status"] == "pendente"
+    assert falho["tentativas"] == 3
+    assert falho["erro"] == "falha simulada"
+    espera = datetime.fromisoformat(falho["proxima_tentativa"]) - antes
+    assert timedelta(seconds=server.GAMIFICACAO_BACKOFF_SEGUNDOS * 4) <= espera < timedelta(
+        seconds=server.GAMIFICACAO_BACKOFF_SEGUNDOS * 4 + 5
+    )
+    # O evento seguinte espera pelo que falhou, mantendo a ordem
+    assert eventos["e2"]["proxima_tentativa"] == falho["proxima_tentativa"]
+    assert await server.processar_eventos_aluno("a1") == 0
+
+
+@pytest.mark.anyio
+async def test_falha_sem_tentativas_restantes_vai_para_dead_letter(db, aplicados):
+    await db.eventos_gamificacao.insert_one(
+        evento("e1", 1, tentativas=server.GAMIFICACAO_MAX_TENTATIVAS - 1)
+    )
+    aplicados.falhar = True
+
+    await server.processar_eventos_aluno("a1")
+
+    falho = (await status_eventos(db))["e1"]
+    assert falho["status"] == "falhou"
+    assert falho["tentativas"] == server.GAMIFICACAO_MAX_TENTATIVAS
+
+
+# ==================== DESBLOQUEIO ====================
+
+@pytest.mark.anyio
+async def test_expressao_de_nivel_igual_a_nivel_por_xp(db):
+    valores = set(range(0, 3000, 7))
+    for nivel in range(1, 60):
+        limiar = server.xp_para_nivel(nivel)
+        valores.update({limiar - 1, limiar, limiar + 1})
+    valores.add(10 ** 15)
+    await db.niveis.insert_many([{"xp": xp} for xp in valores])
+
+    resultado = await db.niveis.aggregate([
+        {"$project": {"_id": 0, "xp": 1, "nivel": server.expressao_nivel_por_xp("$xp")}}
+    ]).to_list(None)
+
+    divergentes = [(r["xp"], r["nivel"]) for r in resultado if r["nivel"] != server.nivel_por_xp(r["xp"])]
+    assert divergentes == []
+
+
+def conquista(id_: str, pontos: int) -> dict:
+    return {"id": id_, "nome": f"Conquista {id_}", "pontos": pontos, "xp_bonus": 0}
+
+
+@pytest.mark.anyio
+async def test_desbloquear_conquistas_num_update_do_perfil(db, monkeypatch):
+    publicadas = []
+    monkeypatch.setattr(server.barramento_notificacoes, "publicar", publicadas.append)
+    await server.criar_perfil_gamificacao_inicial("a1")
+
+    registros = await server.desbloquear_conquistas("a1", "Ana", [conquista("c1", 60), conquista("c2", 100)])
+
+    assert [r["conquista_id"] for r in registros] == ["c1", "c2"]
+    perfil = await db.pontuacao_alunos.find_one({"aluno_id": "a1"}, {"_id": 0})
+    assert perfil["pontos_totais"] == 160
+    assert perfil["conquistas_ids"] == ["c1", "c2"]
+    assert perfil["conquistas_total"] == 2
+    # 160 XP: passou dos limiares de 100 e 150
+    assert perfil["nivel"] == 3
+    assert perfil["xp_proximo_nivel"] == 225
+    assert perfil["progresso_nivel_percent"] == 71.11
+    estatisticas = await db.estatisticas_gamificacao.find_one({"_id": server.ESTATISTICAS_ID})
+    assert estatisticas["total_desbloqueadas"] == 2
+    assert estatisticas["soma_pontos"] == 160
+    assert estatisticas["alunos_participando"] == 1
+    assert [n["tipo"] for n in publicadas] == ["conquista", "conquista", "nivel"]
+    assert publicadas[-1]["dados"]["nivel_anterior"] == 1
+
+
+@pytest.mark.anyio
+async def test_desbloqueio_repetido_nao_pontua_de_novo(db):
+    await db.alunos_conquistas.create_index([("aluno_id", 1), ("conquista_id", 1)], unique=True)
+    await server.desbloquear_conquistas("a1", "Ana", [conquista("c1", 60)])
+
+    assert await server.desbloquear_conquistas("a1", "Ana", [conquista("c1", 60)]) == []
+
+    perfil = await db.pontuacao_alunos.find_one({"aluno_id": "a1"}, {"_id": 0})
+    assert perfil["pontos_totais"] == 60
+    assert perfil["nivel"] == 1
+
+
+# ==================== NOTIFICAÇÕES ====================
+
+def test_token_do_stream_vale_so_para_o_aluno():
+    token = server.criar_token_stream("a1")
+    server.validar_token_stream(token, "a1")
+    with pytest.raises(server.HTTPException):
+        server.validar_token_stream(token, "a2")
+    with pytest.raises(server.HTTPException):
+        server.validar_token_stream(server.create_access_token({"sub": "u1"}), "a1")
+
+
+def test_token_do_stream_invalido():
+    with pytest.raises(server.HTTPException):
+        server.validar_token_stream("nao-e-um-jwt", "a1")
+
+
+@pytest.mark.anyio
+async def test_token_do_stream_nao_autentica_a_api(db):
+    credenciais = SimpleNamespace(credentials=server.criar_token_stream("a1"))
+    with pytest.raises(server.HTTPException):
+        await server.get_current_user(credenciais)
+
+
+@pytest.mark.anyio
+async def test_stream_so_assina_quando_comeca(db, monkeypatch):
+    barramento = server.BarramentoNotificacoes()
+    monkeypatch.setattr(server, "barramento_notificacoes", barramento)
+
+    resposta = await server.stream_notificacoes_aluno("a1", server.criar_token_stream("a1"), None)
+    # Cliente que cai antes da primeira leitura não deixa fila para trás
+    assert not barramento._assinantes
+
+    eventos = resposta.body_iterator
+    primeiro = asyncio.ensure_future(eventos.__anext__())
+    while not barramento._assinantes:
+        await asyncio.sleep(0)
+    barramento.publicar(server.montar_notificacao("a1", "nivel", {"nivel": 2}))
+    assert "event: nivel" in await primeiro
+    await eventos.aclose()
+    assert not barramento._assinantes
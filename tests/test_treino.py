@@ -0,0 +1,178 @@
+import math
+from types import SimpleNamespace
+
+import pytest
+
+import analytics_treino
+import server
+
+
+# ==================== CATÁLOGO DE EXERCÍCIOS ====================
+
+class ExerciciosCriadosDuranteALeitura:
+    """Coleção que, na primeira leitura, cria um exercício e invalida o catálogo no meio dela."""
+
+    def __init__(self, colecao, catalogo):
+        self.colecao = colecao
+        self.catalogo = catalogo
+        self.leituras = 0
+
+    async def find(self, *args):
+        self.leituras += 1
+        async for exercicio in self.colecao.find(*args):
+            yield exercicio
+        if self.leituras == 1:
+            await self.colecao.insert_one({"id": "ex2", "nome": "Remada"})
+            self.catalogo.invalidar()
+
+
+@pytest.mark.anyio
+async def test_catalogo_descarta_leitura_que_cruzou_invalidacao(db, monkeypatch):
+    await db.exercicios.insert_one({"id": "ex1", "nome": "Supino"})
+    catalogo = server.CatalogoExercicios()
+    exercicios = ExerciciosCriadosDuranteALeitura(db.exercicios, catalogo)
+    monkeypatch.setattr(server, "db", SimpleNamespace(exercicios=exercicios))
+
+    assert set(await catalogo.obter(["ex1"])) == {"ex1"}
+    assert (await catalogo.obter_um("ex2"))["nome"] == "Remada"
+    assert exercicios.leituras == 2
+
+
+@pytest.mark.anyio
+async def test_catalogo_recarga_por_id_desconhecido_e_limitada(db):
+    await db.exercicios.insert_one({"id": "ex1", "nome": "Supino"})
+    catalogo = server.CatalogoExercicios()
+    await catalogo.obter(["ex1"])
+    await db.exercicios.insert_one({"id": "ex2", "nome": "Remada"})
+
+    # Criado por outro processo (sem invalidar): espera a recarga mínima
+    assert await catalogo.obter_um("ex2") is None
+    catalogo.invalidar()
+    assert (await catalogo.obter_um("ex2"))["nome"] == "Remada"
+
+
+# ==================== ANALYTICS ====================
+
+def colunas_supino() -> analytics_treino.ColunasTreino:
+    colunas = analytics_treino.ColunasTreino()
+    colunas.adicionar_lote([
+        # Segundas-feiras de duas semanas seguidas
+        {"aluno_id": "a1", "data_treino": "2026-01-05T10:00:00+00:00", "exercicio_id": "supino",
+         "repeticoes": [10, 10], "cargas": [50, 50]},
+        {"aluno_id": "a1", "data_treino": "2026-01-12T10:00:00+00:00", "exercicio_id": "supino",
+         "repeticoes": [10], "cargas": [60]},
+        # Sem séries: ignorado
+        {"aluno_id": "a1", "data_treino": "2026-01-12T10:00:00+00:00", "exercicio_id": "remada"},
+    ])
+    return colunas
+
+
+def test_analisar_sem_dados():
+    resultado = analytics_treino.analisar(analytics_treino.ColunasTreino(), {})
+    assert resultado["totais"] == {"alunos": 0, "sessoes_exercicio": 0, "series": 0, "volume": 0.0}
+    assert resultado["volume_por_grupo"] == []
+
+
+def test_analisar_totais_e_volume_por_grupo():
+    resultado = analytics_treino.analisar(colunas_supino(), {"supino": "peito"})
+
+    assert resultado["totais"] == {"alunos": 1, "sessoes_exercicio": 2, "series": 3, "volume": 1600.0}
+    semanas = [(linha["semana"], linha["volume"], linha["variacao_volume_pct"]) for linha in resultado["volume_por_grupo"]]
+    assert semanas == [("2026-01-05", 1000.0, None), ("2026-01-12", 600.0, -40.0)]
+    assert {linha["grupo_muscular"] for linha in resultado["volume_por_grupo"]} == {"peito"}
+    assert resultado["volume_por_grupo"][0]["carga_media"] == 50.0
+
+
+def test_analisar_tendencia_de_1rm():
+    resultado = analytics_treino.analisar(colunas_supino(), {}, formula="epley")
+
+    tendencia = [(linha["semana"], linha["e1rm"], linha["variacao_pct"]) for linha in resultado["e1rm_por_exercicio"]]
+    assert tendencia == [("2026-01-05", 66.67, None), ("2026-01-12", 80.0, 20.0)]
+    assert resultado["volume_por_grupo"][0]["grupo_muscular"] == analytics_treino.GRUPO_DESCONHECIDO
+
+
+def test_estimar_1rm_ignora_series_fora_da_faixa():
+    estimado = analytics_treino.estimar_1rm([100, 100, 0], [1, 15, 5], "brzycki")
+    assert estimado[0] == 100
+    assert math.isnan(estimado[1]) and math.isnan(estimado[2])
+    with pytest.raises(ValueError):
+        analytics_treino.estimar_1rm([100], [5], "lombardi")
+
+
+# ==================== RECORDES ====================
+
+def marca(valor, repeticoes, data):
+    return {"valor": valor, "repeticoes": repeticoes, "data_treino": data, "registro_id": data}
+
+
+def test_mesclar_marcas_sem_anteriores():
+    novas = {"carga": marca(50, 5, "2026-01-02"), "repeticoes_por_carga": {"50": 5}}
+    assert server.mesclar_marcas(None, novas) is novas
+
+
+def test_mesclar_marcas_fica_com_o_maior_de_cada_tipo():
+    atual = {
+        "carga": marca(60, 3, "2026-01-01"),
+        "e1rm": marca(70, 5, "2026-01-01"),
+        "repeticoes_por_carga": {"60": 3, "40": 12},
+    }
+    novas = {
+        "carga": marca(60, 5, "2026-01-08"),
+        "repeticoes_por_carga": {"60": 5, "40": 10, "50": 8},
+    }
+
+    mescladas = server.mesclar_marcas(atual, novas)
+
+    # Mesma carga: mais repetições vencem, como no $max do banco
+    assert mescladas["carga"]["repeticoes"] == 5
+    assert mescladas["e1rm"] == atual["e1rm"]
+    assert mescladas["repeticoes_por_carga"] == {"60": 5, "40": 12, "50": 8}
+    assert atual["repeticoes_por_carga"] == {"60": 3, "40": 12}
+
+
+# ==================== RECOMENDAÇÃO DE CARGA ====================
+
+PRESCRICAO = {"exercicio_id": "supino", "series": 3, "repeticoes": "8-12", "carga": "40kg"}
+
+
+def sessao(carga, repeticoes, data="2026-01-10"):
+    return {"data_treino": data, "carga": carga, "repeticoes": repeticoes}
+
+
+def test_recomendar_sem_historico_usa_a_ficha():
+    recomendacao = server.recomendar_exercicio(PRESCRICAO, [])
+    assert recomendacao["acao"] == "sem_historico"
+    assert recomendacao["carga_sugerida"] == 40.0
+    assert recomendacao["repeticoes_sugeridas"] == 8
+
+
+def test_recomendar_aumenta_carga_no_topo_da_faixa():
+    recomendacao = server.recomendar_exercicio(PRESCRICAO, [sessao(40, [12, 12, 12])])
+    assert recomendacao["acao"] == "aumentar_carga"
+    assert recomendacao["carga_sugerida"] == 41.0
+    assert recomendacao["repeticoes_sugeridas"] == 8
+
+
+def test_recomendar_topo_da_faixa_exige_todas_as_series():
+    recomendacao = server.recomendar_exercicio(PRESCRICAO, [sessao(40, [12, 12])])
+    assert recomendacao["acao"] == "aumentar_repeticoes"
+    assert recomendacao["repeticoes_sugeridas"] == 12
+
+
+def test_recomendar_mantem_carga_abaixo_da_faixa():
+    recomendacao = server.recomendar_exercicio(PRESCRICAO, [sessao(40, [8, 7, 6]), sessao(35, [10, 10, 10])])
+    assert recomendacao["acao"] == "manter"
+    assert recomendacao["carga_sugerida"] == 40
+
+
+def test_recomendar_reduz_carga_apos_estagnacao():
+    sessoes = [sessao(40, [7, 6, 6], "2026-01-10"), sessao(40, [7, 7, 6], "2026-01-07")]
+    recomendacao = server.recomendar_exercicio(PRESCRICAO, sessoes)
+    assert recomendacao["acao"] == "reduzir_carga"
+    assert recomendacao["carga_sugerida"] == 36.0
+
+
+def test_recomendar_sem_faixa_numerica_mantem():
+    recomendacao = server.recomendar_exercicio({**PRESCRICAO, "repeticoes": "AMRAP"}, [sessao(40, [15])])
+    assert recomendacao["acao"] == "manter"
+    assert recomendacao["repeticoes_sugeridas"] is None
@@ -0,0 +1,98 @@
+import pytest
+
+import server
+
+
+class ProvedorFalso(server.ProvedorWhatsApp):
+    def __init__(self):
+        self.enviadas = []
+
+    async def enviar(self, telefone: str, mensagem: str) -> str:
+        self.enviadas.append(telefone)
+        return f"SM{len(self.enviadas)}"
+
+
+@pytest.fixture
+def provedor(monkeypatch):
+    provedor = ProvedorFalso()
+    monkeypatch.setattr(server, "provedor_whatsapp", provedor)
+    return provedor
+
+
+async def preparar(db, **campos) -> dict:
+    await db.mensagens_whatsapp.insert_one(
+        {"id": "c1", "total_destinatarios": 1, "enviados": 0, "falhas": 0, "status": "enfileirada"}
+    )
+    mensagem = {
+        "id": "m1", "campanha_id": "c1", "telefone": "5511999990000", "mensagem": "Olá",
+        "status": "enviando", "tentativas": 0, **campos
+    }
+    await db.whatsapp_outbox.insert_one(dict(mensagem))
+    return mensagem
+
+
+@pytest.mark.anyio
+async def test_entrega_grava_o_id_do_provedor(db, provedor):
+    mensagem = await preparar(db)
+
+    await server.entregar_mensagem_whatsapp(mensagem)
+
+    gravada = await db.whatsapp_outbox.find_one({"id": "m1"}, {"_id": 0})
+    assert gravada["status"] == "enviada"
+    assert gravada["provedor_id"] == "SM1"
+    assert (await db.mensagens_whatsapp.find_one({"id": "c1"}))["enviados"] == 1
+
+
+@pytest.mark.anyio
+async def test_mensagem_reivindicada_com_id_do_provedor_nao_e_reenviada(db, provedor):
+    # Worker anterior caiu depois de o provedor aceitar o envio
+    mensagem = await preparar(db, provedor_id="SM0")
+
+    await server.entregar_mensagem_whatsapp(mensagem)
+    await server.entregar_mensagem_whatsapp(mensagem)
+
+    assert provedor.enviadas == []
+    gravada = await db.whatsapp_outbox.find_one({"id": "m1"}, {"_id": 0})
+    assert gravada["status"] == "enviada"
+    assert gravada["provedor_id"] == "SM0"
+    assert (await db.mensagens_whatsapp.find_one({"id": "c1"}))["enviados"] == 1
+
+
+@pytest.mark.anyio
+async def test_retomar_mensagem_presa_conta_como_tentativa(db):
+    presa_desde = (server.datetime.now(server.timezone.utc) - server.timedelta(hours=1)).isoformat()
+    await preparar(db, travado_em=presa_desde, tentativas=1)
+
+    mensagem = await server.reivindicar_mensagem_whatsapp()
+
+    assert mensagem["tentativas"] == 2
+    assert mensagem["status"] == "enviando"
+    # Mensagem pronta na fila (não presa) não ganha tentativa ao ser reivindicada
+    await db.whatsapp_outbox.insert_one({
+        "id": "m2", "campanha_id": "c1", "status": "pendente", "tentativas": 0,
+        "proxima_tentativa": presa_desde
+    })
+    assert (await server.reivindicar_mensagem_whatsapp())["tentativas"] == 0
+
+
+@pytest.mark.anyio
+async def test_mensagem_que_sempre_trava_vai_para_falhou(db, provedor):
+    presa_desde = (server.datetime.now(server.timezone.utc) - server.timedelta(hours=1)).isoformat()
+    await preparar(db, travado_em=presa_desde, tentativas=server.WHATSAPP_MAX_TENTATIVAS - 1)
+
+    await server.entregar_mensagem_whatsapp(await server.reivindicar_mensagem_whatsapp())
+
+    assert provedor.enviadas == []
+    assert (await db.whatsapp_outbox.find_one({"id": "m1"}))["status"] == "falhou"
+    campanha = await db.mensagens_whatsapp.find_one({"id": "c1"})
+    assert campanha["falhas"] == 1
+    assert campanha["status"] == "concluida_com_falhas"
+
+
+@pytest.mark.anyio
+async def test_provedor_fake_guarda_so_as_ultimas(monkeypatch):
+    monkeypatch.setattr(server, "WHATSAPP_FAKE_HISTORICO", 3)
+    provedor = server.ProvedorWhatsAppFake()
+    for i in range(5):
+        await provedor.enviar(str(i), "Olá")
+    assert [m["telefone"] for m in provedor.enviadas] == ["2", "3", "4"]